@@ -6,11 +6,334 @@ given that we don't know in advance what the topics are likely to be
 chose dbscan as the algorithm to discover topics
 """
 from ygcursors import ygcursors
+import ygdb
 import yglog
 import json
 import math
 import argparse
 import datetime
+import heapq
+import time
+import os
+import sys
+import cPickle
+import multiprocessing
+from array import array
+from itertools import izip
+
+HYDRATE_BATCH = 1000 # number of tweet ids to fetch per query
+STATE_VERSION = 2    # format of the ygincremental state file
+WATERMARK_LAG = 300  # seconds of similarity rows to read again in case they committed late
+SNAPSHOT_VERSION = 1 # format of the --snapshot file
+OUTPUTS = ('clusters', 'tweets', 'stats', 'best', 'interesting', 'keywords', 'delta')
+TASKS_PER_WORKER = 4 # small components are sent to the workers in about this many groups per worker
+
+# (dbscan, tweetids) inherited by the worker processes
+# set by ygdbscan.dbscan_workers before the workers are forked
+shared = None
+
+def dbscan_shared(positions):
+    """
+    worker process version of ygdbscan.dbscan for the tweets at the given
+    positions in tweetids: these must be whole connected components in their original order
+    returns the clusters as (position, root, members in the order they were added)
+    and the noise tweets as (position, tweet id)
+    """
+    dbscan, tweetids = shared
+    dbscan.tweetids = [tweetids[p] for p in positions]
+    where = dict(izip(dbscan.tweetids, positions))
+    dbscan.clusters = {}
+    dbscan.clustered = {}
+    dbscan.noise = {}
+    dbscan.addorder = []
+    dbscan.dbscan()
+    clusters = []
+    for root, tweetid in dbscan.addorder:
+        if tweetid == root:
+            clusters.append((where[root], root, []))
+        clusters[-1][2].append(tweetid)
+    noise = [(where[tweetid], tweetid) for tweetid in dbscan.noise]
+    return clusters, noise
+
+def no_change():
+    """
+    empty ygincremental delta
+    """
+    return {'appeared': [], 'grew': {}, 'shrank': {}, 'disappeared': [], 'merged': {}, 'split': {}}
+
+class ygneighbours(object):
+    """
+    similarity graph held in compressed sparse row form
+
+    edges are collected with add and then build sorts each tweet's
+    neighbours once: most similar first as get_neighbours always returned them
+    neighbour ids and similarities are kept in flat arrays with an offset per tweet
+    """
+    def __init__(self, epsilon):
+        self.epsilon = epsilon
+        self.order = {}             # tweet ids seen in the edges
+        self.edges1 = array('l')    # raw edges in the order they were added
+        self.edges2 = array('l')
+        self.edgesims = array('d')
+        self.index = {}             # tweet id -> node number
+        self.offsets = array('l', [0])
+        self.neighbourids = array('l')
+        self.similarities = array('d')
+
+    def add(self, id1, id2, similarity):
+        if id1 not in self.order: self.order[id1] = True
+        if id2 not in self.order: self.order[id2] = True
+        self.edges1.append(id1)
+        self.edges2.append(id2)
+        self.edgesims.append(similarity)
+
+    def tweetids(self):
+        """
+        tweet ids in ascending order: dbscan scans them in this order so the
+        oldest tweet that can start a cluster does and every mode gives the same clusters
+        """
+        return sorted(self.order)
+
+    def build(self):
+        """
+        turn the raw edges into sorted neighbour lists
+        both directions of each edge are stored
+        """
+        nodes = self.order.keys()
+        self.index = dict((tweetid, node) for node, tweetid in enumerate(nodes))
+        index = self.index
+        degree = array('l', [0]) * (len(nodes) + 1)
+        for id1, id2 in izip(self.edges1, self.edges2):
+            degree[index[id1] + 1] += 1
+            degree[index[id2] + 1] += 1
+        for node in xrange(len(nodes)):
+            degree[node + 1] += degree[node]
+
+        # group the edges by tweet keeping the order they were added in
+        fill = array('l', degree)
+        rawids = array('l', [0]) * len(self.edges1) * 2
+        rawsims = array('d', [0.0]) * len(self.edges1) * 2
+        for id1, id2, sim in izip(self.edges1, self.edges2, self.edgesims):
+            node1 = index[id1]
+            rawids[fill[node1]] = id2
+            rawsims[fill[node1]] = sim
+            fill[node1] += 1
+            node2 = index[id2]
+            rawids[fill[node2]] = id1
+            rawsims[fill[node2]] = sim
+            fill[node2] += 1
+
+        self.offsets = array('l', [0])
+        self.neighbourids = array('l')
+        self.similarities = array('d')
+        for node in xrange(len(nodes)):
+            # later edges between the same two tweets replace earlier ones
+            edges = {}
+            for k in xrange(degree[node], degree[node+1]):
+                edges[rawids[k]] = rawsims[k]
+            candidates = {}
+            for tweetid, sim in edges.iteritems():
+                if sim >= self.epsilon:
+                    candidates[tweetid] = sim
+            for tweetid in sorted(candidates,key=candidates.__getitem__,reverse=True):
+                self.neighbourids.append(tweetid)
+                self.similarities.append(candidates[tweetid])
+            self.offsets.append(len(self.neighbourids))
+
+        self.edges1 = array('l')
+        self.edges2 = array('l')
+        self.edgesims = array('d')
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, tweetid):
+        return tweetid in self.index
+
+    def neighbours(self, tweetid):
+        """
+        neighbours most similar first followed by the tweet itself
+        """
+        node = self.index[tweetid]
+        neighbours = self.neighbourids[self.offsets[node]:self.offsets[node+1]].tolist()
+        neighbours.append(tweetid)
+        return neighbours
+
+    def neighbour_similarities(self, tweetid):
+        """
+        (neighbour, similarity) in the same order as neighbours
+        the tweet itself comes last with a similarity of None
+        """
+        node = self.index[tweetid]
+        start, end = self.offsets[node], self.offsets[node+1]
+        pairs = zip(self.neighbourids[start:end], self.similarities[start:end])
+        pairs.append((tweetid, None))
+        return pairs
+
+    def similarity(self, id1, id2):
+        """
+        similarity of two tweets or None if they aren't neighbours
+        scans id1's neighbours so use neighbour_similarities to go through them all
+        """
+        node = self.index.get(id1)
+        if node is None: return None
+        for k in xrange(self.offsets[node], self.offsets[node+1]):
+            if self.neighbourids[k] == id2:
+                return self.similarities[k]
+        return None
+
+class ygthresholds(ygneighbours):
+    """
+    ygneighbours for a run of epsilons from the highest to the lowest
+
+    the graph is built once at the lowest epsilon from each pair's highest
+    similarity and as each tweet's neighbours are kept most similar first its
+    neighbours at a higher epsilon are the start of them. lower moves the end
+    of each tweet's neighbours on over the edges a lower epsilon lets in
+    so the one graph grows as the epsilon goes down
+    """
+    def __init__(self, epsilon):
+        ygneighbours.__init__(self, epsilon)
+        self.ends = array('l')      # end of each tweet's neighbours at the current epsilon
+        self.active = {}            # tweets with neighbours at the current epsilon
+        self.cursor = 0             # edges let in so far
+
+    def build(self):
+        """
+        as ygneighbours.build but the edges are kept most similar first for lower
+        add the edges least similar first so the highest similarity of a pair is kept
+        """
+        pending = (self.edges1[::-1], self.edges2[::-1], self.edgesims[::-1])
+        ygneighbours.build(self)
+        self.pending1, self.pending2, self.pendingsims = pending
+        self.ends = array('l', self.offsets[:-1])
+        self.active = {}
+        self.cursor = 0
+        self.epsilon = None
+
+    def lower(self, epsilon):
+        """
+        let in the edges with a similarity of at least epsilon
+        epsilon can only go down
+        """
+        if self.epsilon is not None and epsilon > self.epsilon:
+            raise(Exception("ygthresholds.lower: epsilon {} is above {}".format(epsilon, self.epsilon)))
+        self.epsilon = epsilon
+        touched = set()
+        sims = self.pendingsims
+        cursor = self.cursor
+        while cursor < len(sims) and sims[cursor] >= epsilon:
+            touched.add(self.pending1[cursor])
+            touched.add(self.pending2[cursor])
+            cursor += 1
+        self.cursor = cursor
+
+        for tweetid in touched:
+            node = self.index[tweetid]
+            end, stop = self.ends[node], self.offsets[node+1]
+            while end < stop and self.similarities[end] >= epsilon:
+                end += 1
+            self.ends[node] = end
+            if end > self.offsets[node]: self.active[tweetid] = True
+
+    def tweetids(self):
+        return sorted(self.active)
+
+    def __len__(self):
+        return len(self.active)
+
+    def __contains__(self, tweetid):
+        return tweetid in self.active
+
+    def neighbours(self, tweetid):
+        node = self.index[tweetid]
+        neighbours = self.neighbourids[self.offsets[node]:self.ends[node]].tolist()
+        neighbours.append(tweetid)
+        return neighbours
+
+    def neighbour_similarities(self, tweetid):
+        node = self.index[tweetid]
+        start, end = self.offsets[node], self.ends[node]
+        pairs = zip(self.neighbourids[start:end], self.similarities[start:end])
+        pairs.append((tweetid, None))
+        return pairs
+
+    def similarity(self, id1, id2):
+        if id1 not in self.active: return None
+        node = self.index[id1]
+        for k in xrange(self.offsets[node], self.ends[node]):
+            if self.neighbourids[k] == id2:
+                return self.similarities[k]
+        return None
+
+class ygadjacency(object):
+    """
+    similarity graph that can have edges added and removed between runs
+
+    offers the same lookups as ygneighbours so ygdbscan can use either one
+    edges are kept as a dict of neighbour similarities per tweet
+    """
+    def __init__(self, epsilon):
+        self.epsilon = epsilon
+        self.edges = {}     # tweet id -> {neighbour id: similarity}
+
+    def add(self, id1, id2, similarity):
+        """
+        add, change or remove (if below epsilon) an edge
+        returns True if the graph changed
+        """
+        if id1 == id2: return False
+        if similarity < self.epsilon:
+            return self.remove(id1, id2)
+        if self.edges.get(id1, {}).get(id2) == similarity: return False
+        self.edges.setdefault(id1, {})[id2] = similarity
+        self.edges.setdefault(id2, {})[id1] = similarity
+        return True
+
+    def remove(self, id1, id2):
+        if id2 not in self.edges.get(id1, {}): return False
+        for a, b in ((id1, id2), (id2, id1)):
+            del self.edges[a][b]
+            if len(self.edges[a]) == 0: del self.edges[a]
+        return True
+
+    def drop(self, tweetid):
+        """
+        remove a tweet and its edges returning the ids of its old neighbours
+        """
+        neighbours = self.edges.pop(tweetid, {}).keys()
+        for n in neighbours:
+            del self.edges[n][tweetid]
+            if len(self.edges[n]) == 0: del self.edges[n]
+        return neighbours
+
+    def degree(self, tweetid):
+        return len(self.edges.get(tweetid, ()))
+
+    def tweetids(self):
+        return self.edges.keys()
+
+    def __len__(self):
+        return len(self.edges)
+
+    def __contains__(self, tweetid):
+        return tweetid in self.edges
+
+    def neighbours(self, tweetid):
+        """
+        neighbours most similar first followed by the tweet itself
+        """
+        edges = self.edges[tweetid]
+        neighbours = sorted(edges, key=lambda n: (-edges[n], n))
+        neighbours.append(tweetid)
+        return neighbours
+
+    def neighbour_similarities(self, tweetid):
+        edges = self.edges[tweetid]
+        return [(n, edges.get(n)) for n in self.neighbours(tweetid)]
+
+    def similarity(self, id1, id2):
+        return self.edges.get(id1, {}).get(id2)
 
 class ygdbscan(ygcursors):
     """
@@ -26,6 +349,14 @@ class ygdbscan(ygcursors):
         self.epsilon = args.epsilon # neighbours must be more similar than this
         self.minsz = args.minsz     # smallest number of neighbours allowed
         self.daysback = args.daysback # how far back to look for root tweets
+        self.tweetcache = {}   # features data by tweet id (see hydrate)
+        self.termcache = {}    # tweetwords (term, num) lists by tweet id (see load_terms)
+        self.workers = getattr(args, 'workers', 0) # processes for dbscan_workers
+        self.addorder = None   # (cluster, tweet id) in the order add2cluster saw them if wanted
+        self.toptweet = None   # features data for the best tweet (see get_output)
+        self.termsbylimit = {} # clusterterms by number of keywords
+        self.snapshotkey = None
+        self.delta = no_change()
 
     def inc_cluster(self, tweetid):
         self.lastcluster = tweetid
@@ -36,22 +367,22 @@ class ygdbscan(ygcursors):
         yglog.vprint("cluster",self.lastcluster,"now has",tweetid)
         self.clusters[self.lastcluster][tweetid] = True
         self.clustered[tweetid] = True
+        if self.addorder is not None:
+            self.addorder.append((self.lastcluster, tweetid))
 
     def in_cluster(self, tweetid):
         if tweetid in self.clustered: return True
         return False
 
     def get_neighbours(self, id1):
-        if id1 not in self.pairs: 
+        if id1 not in self.graph: 
             raise(Exception("ygdbscan.get_neighbours: missing {} in pairs".format(id1)))
-        candidates = {}
-        for tweetid, sim in self.pairs[id1].iteritems():
-            if sim >= self.epsilon:
-                candidates[tweetid] = sim
+        return self.graph.neighbours(id1)
 
-        neighbours = sorted(candidates,key=candidates.__getitem__,reverse=True)
-        neighbours.append(id1)
-        return neighbours
+    def get_neighbour_similarities(self, id1):
+        if id1 not in self.graph:
+            raise(Exception("ygdbscan.get_neighbour_similarities: missing {} in pairs".format(id1)))
+        return self.graph.neighbour_similarities(id1)
 
     def dbscan(self):
         """
@@ -70,16 +401,20 @@ class ygdbscan(ygcursors):
             else:
                 self.inc_cluster(id1)
                 neighbourlist = neighbours
+                # same contents as neighbourlist for quick membership checks
+                queued = set(neighbourlist)
                 while len(neighbourlist) > 0:
                     n = neighbourlist.pop()
+                    queued.discard(n)
                     if n in seen: continue
                     seen[n] = True
                     newneighbours = self.get_neighbours(n)
                     if len(newneighbours) <= self.minsz:
                         continue
                     for nn in newneighbours:
-                        if nn not in neighbourlist:
+                        if nn not in queued:
                             neighbourlist.append(nn)
+                            queued.add(nn)
                     if not self.in_cluster(n):
                         self.add2cluster(n)
 
@@ -88,10 +423,102 @@ class ygdbscan(ygcursors):
         initializes data and runs dbscan algorithm 
         """
         self.tweetids = self.initpairs(daysback=self.daysback)
-        self.dbscan()
+        if self.workers > 1:
+            self.dbscan_workers(self.workers)
+        else:
+            self.dbscan()
         self.get_clustertweets()
         self.get_stats()
 
+    def components(self):
+        """
+        split the positions in self.tweetids into the connected components of self.graph
+        each component is walked a tweet at a time with set operations on its
+        neighbour lists so the work per edge is done in C
+        components are listed in the order of their first tweet
+        """
+        graph = self.graph
+        index = graph.index
+        offsets = graph.offsets
+        neighbourids = graph.neighbourids
+        where = dict((tweetid, p) for p, tweetid in enumerate(self.tweetids))
+        seen = set()
+        ordered = []
+        for tweetid in self.tweetids:
+            if tweetid in seen: continue
+            seen.add(tweetid)
+            component = [tweetid]
+            stack = [tweetid]
+            while stack:
+                node = index[stack.pop()]
+                # difference only looks up the new set's members in seen
+                new = set(neighbourids[offsets[node]:offsets[node+1]]).difference(seen)
+                if new:
+                    seen.update(new)
+                    component.extend(new)
+                    stack.extend(new)
+            ordered.append(sorted(where[t] for t in component))
+        return ordered
+
+    def dbscan_workers(self, workers):
+        """
+        dbscan run separately on each connected component by a pool of worker processes
+        a cluster can never leave its component so this gives the same clusters and
+        noise as dbscan: results are put back together in the order dbscan would make them
+        """
+        global shared
+        start = time.time()
+        components = self.components()
+        tasksize = max(1, len(self.tweetids) // (workers * TASKS_PER_WORKER))
+        tasks = []
+        batch = []
+        for component in components:
+            if len(component) >= tasksize:
+                tasks.append(component)
+                continue
+            batch.extend(component)
+            if len(batch) >= tasksize:
+                tasks.append(sorted(batch))
+                batch = []
+        if len(batch) > 0: tasks.append(sorted(batch))
+        tasks.sort(key=len, reverse=True)
+        yglog.vprint(len(components),"components in",len(tasks),"tasks")
+
+        shared = (self, self.tweetids)
+        # don't let the workers inherit our db connection
+        self.closedb()
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(dbscan_shared, tasks, 1)
+        finally:
+            pool.close()
+            pool.join()
+            shared = None
+
+        clusters = []
+        noise = []
+        for taskclusters, tasknoise in results:
+            clusters.extend(taskclusters)
+            noise.extend(tasknoise)
+        clusters.sort()
+        noise.sort()
+        self.clusters = {}
+        self.clustered = {}
+        self.noise = {}
+        for p, root, members in clusters:
+            self.lastcluster = root
+            self.clusters[root] = {}
+            for tweetid in members:
+                self.clusters[root][tweetid] = True
+                self.clustered[tweetid] = True
+        for p, tweetid in noise:
+            self.noise[tweetid] = True
+        sys.stderr.write(
+            "ygdbscan: {} components {} tasks {} workers {:.3f}s\n".format(
+                len(components), len(tasks), workers, time.time() - start
+            )
+        )
+
     def get_interesting(self, percentile=None, minscore=None, scorekey='maxscores'):
         """
         given a minimum score and key to search in return the top tweets for each cluster found
@@ -123,7 +550,8 @@ class ygdbscan(ygcursors):
             if score >= minscore:
                 clusterid = stats['clusterids'][clidx]
                 twidx = stats['besttweetidx'][clidx]
-                interesting[clusterid] = clustertweets[clusterid][twidx]
+                # copied so the count doesn't show up in the tweets output
+                interesting[clusterid] = dict(clustertweets[clusterid][twidx])
                 interesting[clusterid]['count'] = len(clustertweets[clusterid])
         return interesting
 
@@ -209,128 +637,698 @@ class ygdbscan(ygcursors):
                 'toptweet': toptweet
         }
                     
+    def load_terms(self, tweetids):
+        """
+        loads tweetwords term counts for the given tweet ids into self.termcache
+        a few "in (...)" queries are used rather than one query per tweet
+        terms for each tweet are kept in term order
+        """
+        missing = sorted(set(tweetid for tweetid in tweetids if tweetid not in self.termcache))
+        for tweetid in missing:
+            self.termcache[tweetid] = []
+        get = self.getcursor()
+        for start in xrange(0, len(missing), HYDRATE_BATCH):
+            batch = missing[start:start+HYDRATE_BATCH]
+            get.execute(
+                "select id,term,num from tweetwords where id in ({}) "
+                "order by id,term".format(",".join(["%s"] * len(batch))),
+                batch
+            )
+            for row in get:
+                tweetid, term, num = row
+                self.termcache[tweetid].append((term, num))
+        get.close()
+
     def get_clusterterms(self, limit):
         """
         what are the most important words for this cluster?
+        a tweet's terms count once for every root in the cluster it neighbours
         """
-        # get all terms for all clusters
-        clusterterms = {}
-        orderedterms = {}
+        start = time.time()
+        neighbourlists = {}
+        tweetids = set()
         for cluster,tweets in self.clusters.iteritems():
-            clusterterms[cluster] = {}
-            for rootid in tweets:
-                neighbours = self.get_neighbours(rootid)
-                for tweetid in neighbours:
-                    get = self.getcursor()
-                    get.execute(
-                        "select term,num from tweetwords "
-                        "where id=%s",
-                        (tweetid,)
-                    )
-                    for row in get:
-                        term, num = row
-                        if term not in clusterterms[cluster]:
-                            clusterterms[cluster][term] = 0
-                        clusterterms[cluster][term] += num
-                    get.close()
-            # ensure we are sorted by frequency
-            orderedterms[cluster] = sorted(clusterterms[cluster],
-                            key=clusterterms[cluster].__getitem__,reverse=True)
-        # get the short list
+            neighbourlists[cluster] = [self.get_neighbours(rootid) for rootid in tweets]
+            for neighbours in neighbourlists[cluster]:
+                tweetids.update(neighbours)
+        self.load_terms(tweetids)
+
+        # get the short list for each cluster
         candidates = {}
-        for cluster,terms in orderedterms.iteritems():
-            candidates[cluster] = {}
-            count = limit if len(terms) >= limit else len(terms)
-            for i in xrange(count):
-                candidates[cluster][terms[i]] = clusterterms[cluster][terms[i]]
-                
+        for cluster, neighbourlist in neighbourlists.iteritems():
+            clusterterms = {}
+            for neighbours in neighbourlist:
+                for tweetid in neighbours:
+                    for term, num in self.termcache[tweetid]:
+                        if term not in clusterterms:
+                            clusterterms[term] = 0
+                        clusterterms[term] += num
+            top = heapq.nlargest(limit, clusterterms, key=clusterterms.__getitem__)
+            candidates[cluster] = dict((term, clusterterms[term]) for term in top)
+
+        yglog.vprint("keywords for",len(candidates),"clusters",
+            len(tweetids),"tweets in",time.time() - start,"s")
         self.clusterterms = candidates
-                    
+
+    def hydrate(self, tweetids):
+        """
+        loads features data for the given tweet ids into self.tweetcache
+        using a few "in (...)" queries instead of one query per tweet
+        ids already in the cache are not fetched again
+        """
+        missing = sorted(set(tweetid for tweetid in tweetids if tweetid not in self.tweetcache))
+        get = self.getcursor()
+        for start in xrange(0, len(missing), HYDRATE_BATCH):
+            batch = missing[start:start+HYDRATE_BATCH]
+            get.execute(
+                "select id,created_at,rawtext,combined_count,retweet_count,"
+                    "favorite_count,user "
+                "from features where id in ({})".format(",".join(["%s"] * len(batch))),
+                batch
+            )
+            for row in get:
+                tweetid, created_at, rawtext, combined_count, retweet_count, \
+                    favorite_count, screen_name = row
+                self.tweetcache[tweetid] = {
+                    'created_at': '{:%Y-%m-%d %H:%M:%S}'.format(created_at),
+                    'rawtext': rawtext,
+                    'combined_count': combined_count,
+                    'retweet_count': retweet_count,
+                    'favorite_count': favorite_count,
+                    'screen_name': screen_name,
+                }
+        get.close()
+        yglog.vprint("hydrated",len(missing),"tweets",len(self.tweetcache),"in cache")
+
     def get_clustertweets(self):
         """
         get tweet data for clusters
+
+        each tweet is listed once per cluster: root and root_similarity are for
+        the first root it was found next to and roots has the similarity
+        to every root in the cluster that has it as a neighbour
         """
-        clustertweets = {}
+        clusterneighbours = {}
+        tweetids = set()
         for cl,tweets in self.clusters.iteritems():
-            clustertweets[cl] = []
+            clusterneighbours[cl] = []
             for rootid in tweets:
                 yglog.vprint("root",rootid,"for cluster",cl)
-                neighbours = self.get_neighbours(rootid)
-                for tweetid in neighbours:
+                neighbours = self.get_neighbour_similarities(rootid)
+                clusterneighbours[cl].append((rootid, neighbours))
+                tweetids.update([tweetid for tweetid, similarity in neighbours])
+        self.hydrate(tweetids)
+
+        clustertweets = {}
+        for cl, rootneighbours in clusterneighbours.iteritems():
+            clustertweets[cl] = []
+            entries = {}
+            for rootid, neighbours in rootneighbours:
+                for tweetid, root_similarity in neighbours:
                     yglog.vprint(rootid,"neighbour",tweetid)
-                    get = self.getcursor()
-                    get.execute(
-                        "select created_at,rawtext,combined_count,retweet_count,"
-                            "favorite_count,user "
-                        "from features where id=%s ",
-                        (tweetid,)
-                    )
-                    row = get.fetchone()
-                    get.close()
-                    if row is None: continue
-                    try:
-                        root_similarity = self.pairs[rootid][tweetid]
-                    except:
-                        root_similarity = None
-                    tweet = list(row)
-                    created_at = '{:%Y-%m-%d %H:%M:%S}'.format(tweet.pop(0))
-                    clustertweets[cl].append({
+                    if tweetid not in self.tweetcache: continue
+                    if tweetid in entries:
+                        entries[tweetid]['roots'][rootid] = root_similarity
+                        continue
+                    tweet = self.tweetcache[tweetid]
+                    entries[tweetid] = {
                         'root': rootid,
+                        'roots': {rootid: root_similarity},
                         'epsilon': self.epsilon,
                         'minsz': self.minsz,
                         'root_similarity': root_similarity,
                         'id': tweetid,
-                        'words': tweet.pop(0),
-                        'combined_count': tweet.pop(0),
-                        'retweet_count': tweet.pop(0),
-                        'favorite_count': tweet.pop(0),
-                        'screen_name': tweet.pop(0),
-                        'created_at': created_at,
-                    })
+                        'words': tweet['rawtext'],
+                        'combined_count': tweet['combined_count'],
+                        'retweet_count': tweet['retweet_count'],
+                        'favorite_count': tweet['favorite_count'],
+                        'screen_name': tweet['screen_name'],
+                        'created_at': tweet['created_at'],
+                    }
+                    clustertweets[cl].append(entries[tweetid])
         self.clustertweets = clustertweets
 
+    def params(self):
+        return {'epsilon': self.epsilon, 'minsz': self.minsz, 'daysback': self.daysback}
+
+    def table_created(self):
+        get = self.getcursor()
+        get.execute(
+            "select create_time from information_schema.tables "
+            "where table_schema = database() and table_name = 'similarity'"
+        )
+        row = get.fetchone()
+        get.close()
+        return row[0] if row else None
+
+    def watermark(self):
+        """
+        what the clusters depend on: the settings, the daysback window
+        and the newest row in similarity (see the added column)
+        """
+        get = self.getcursor()
+        get.execute("select max(added) from similarity")
+        added = get.fetchone()[0]
+        get.close()
+        key = self.params()
+        key.update({
+            'mode': self.__class__.__name__,
+            'minid': self.get_minid(self.daysback),
+            'added': added,
+            'created': self.table_created(),
+        })
+        return key
+
+    def load_snapshot(self, path, keywords=None):
+        """
+        use the results saved by save_snapshot if nothing has changed since
+        returns True if the snapshot could be used
+        """
+        self.snapshotkey = self.watermark()
+        if not os.path.isfile(path): return False
+        with open(path, 'rb') as fh:
+            snapshot = cPickle.load(fh)
+        if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('key') != self.snapshotkey:
+            return False
+        if keywords > 0 and keywords not in snapshot['clusterterms']:
+            return False
+        self.clusters = snapshot['clusters']
+        self.clustertweets = snapshot['clustertweets']
+        self.stats = snapshot['stats']
+        self.toptweet = snapshot['toptweet']
+        self.clusterterms = snapshot['clusterterms'].get(keywords)
+        self.termsbylimit = snapshot['clusterterms']
+        yglog.vprint("using cluster snapshot",path,"from",self.snapshotkey['added'])
+        return True
+
+    def save_snapshot(self, path):
+        """
+        save the cluster results keyed by the watermark taken before they were made
+        so rows added during the run will cause the next run to start over
+        """
+        tmp = path + '.new'
+        with open(tmp, 'wb') as fh:
+            cPickle.dump({
+                'version': SNAPSHOT_VERSION,
+                'key': self.snapshotkey,
+                'clusters': self.clusters,
+                'clustertweets': self.clustertweets,
+                'stats': self.stats,
+                'toptweet': self.toptweet,
+                'clusterterms': self.termsbylimit,
+            }, fh, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+
+    def get_output(self, name, percentile=None, keywords=None):
+        """
+        the json data for one of the outputs listed in OUTPUTS
+        """
+        if name == 'clusters':
+            return self.clusters
+        if name == 'tweets':
+            return self.clustertweets
+        if name == 'stats':
+            return self.stats
+        if name == 'best':
+            if self.toptweet is None: self.toptweet = self.get_toptweet()
+            return {
+                'clusterid': self.stats['topcluster'],
+                'tweetid': self.stats['toptweet'],
+                'tweetdata': self.toptweet,
+            }
+        if name == 'interesting':
+            return self.get_interesting(percentile)
+        if name == 'keywords':
+            if keywords not in self.termsbylimit:
+                self.get_clusterterms(keywords)
+                self.termsbylimit[keywords] = self.clusterterms
+            return self.termsbylimit[keywords]
+        if name == 'delta':
+            return self.delta
+        raise(Exception("ygdbscan.get_output: unknown output {}".format(name)))
+
+    def get_minid(self, daysback=2):
+        """
+        smallest tweet id newer than daysback
+        """
+        get = self.getcursor()
+        get.execute(
+            "select min(id) from features where created_at > now() - interval %s day",
+            (daysback,)
+        )
+        row = get.fetchone()
+        get.close()
+        return row[0]
+
     def initpairs(self, daysback=2):
         """
-        loads all pairs from similarity into memory 
+        loads all pairs from similarity into memory as a ygneighbours graph
         this is used to determine if two tweets are related
         score is sum of jaccard similarity plus number of links shared
         set daysback to expand number of pairs used for cluster
         """
-        getpairs = self.getcursor()
-        getpairs.execute(
-            "select min(id) from features where created_at > now() - interval %s day",
-            (daysback,)
-        )
-        row = getpairs.fetchone()
-        minid = row[0]
+        minid = self.get_minid(daysback)
         yglog.vprint("starting with id",minid)
+        getpairs = self.getcursor()
         getpairs.execute(
             "select id1,id2,jaccard+links sim from similarity where id1 > %s and jaccard+links >= %s",
             (minid,self.epsilon)
         )
-        pairs = {}
+        graph = ygneighbours(self.epsilon)
         i = 0
         for row in getpairs:
             id1,id2,similarity = row
             i += 1
-            if id1 not in pairs:
-                pairs[id1] = {}
-            if id2 not in pairs:
-                pairs[id2] = {}
-            pairs[id1][id2] = similarity
-            pairs[id2][id1] = similarity
+            graph.add(id1, id2, similarity)
         yglog.vprint("found",i,"rows in similarity")
         getpairs.close()
-        self.pairs = pairs
-        yglog.vprint(len(self.pairs.keys()),"keys in self.pairs")
-        return self.pairs.keys()
+        graph.build()
+        self.graph = graph
+        yglog.vprint(len(graph),"tweets in self.graph")
+        return graph.tweetids()
+
+class ygincremental(ygdbscan):
+    """
+    dbscan that carries its clusters over from one run to the next
+
+    the similarity graph and clusters are kept in a state file: a full copy
+    followed by the changes each run made since (see save_state)
+    each run drops tweets older than daysback, reads only the similarity rows
+    added since the last run and reruns dbscan on just the connected parts of
+    the graph that changed
+
+    clusters can't reach outside their connected part of the graph and tweets
+    are scanned in the same order as ygdbscan so the clusters are the same as a
+    batch run would make: a cluster's id is the tweet it was started from
+    """
+    def __init__(self, args, statefile):
+        super(ygincremental, self).__init__(args)
+        self.statefile = statefile
+        self.graph = ygadjacency(self.epsilon)
+        self.labels = {}       # clustered tweet id -> cluster id
+        self.members = {}      # cluster id -> set of tweet ids
+        self.watermark = None  # db time of the last similarity read
+        self.created = None    # when the similarity table was made (ygsim --clean remakes it)
+        self.basesize = 0      # bytes of the full copy at the start of the state file
+        self.end = None        # end of the last complete change, None to write a full copy
+        self.reclustered = 0   # tweets dbscan was run on
+
+    def load_state(self):
+        """
+        returns True if there was a state file made with the same settings
+        """
+        if not os.path.isfile(self.statefile): return False
+        with open(self.statefile, 'rb') as fh:
+            state = cPickle.load(fh)
+            if state.get('version') != STATE_VERSION or state.get('params') != self.params():
+                sys.stderr.write("ygincremental: {} has different settings, rebuilding\n".format(self.statefile))
+                return False
+            if state.get('created') != self.created:
+                sys.stderr.write("ygincremental: similarity table was remade, rebuilding\n")
+                return False
+            self.watermark = state['watermark']
+            self.graph.edges = state['edges']
+            self.members = state['members']
+            self.labels = {}
+            for cl, members in self.members.iteritems():
+                for tweetid in members:
+                    self.labels[tweetid] = cl
+            self.basesize = self.end = fh.tell()
+            while True:
+                try:
+                    change = cPickle.load(fh)
+                except EOFError:
+                    break
+                except Exception as e:
+                    # a run that died while appending: its change is dropped (see save_state)
+                    sys.stderr.write("ygincremental: ignoring a partly written change: {}\n".format(e))
+                    break
+                self.replay(change)
+                self.end = fh.tell()
+        return True
+
+    def replay(self, change):
+        """
+        apply a change recorded by save_state
+        """
+        for tweetid in change['expired']:
+            self.graph.drop(tweetid)
+        for id1, id2, sim in change['edges']:
+            self.graph.add(id1, id2, sim)
+        self.set_clusters(change['clusters'])
+        self.watermark = change['watermark']
+
+    def set_clusters(self, clusters):
+        """
+        apply a dict of cluster id -> members (None for a cluster that has gone)
+        """
+        for cl, members in clusters.iteritems():
+            for tweetid in self.members.pop(cl, ()):
+                if self.labels.get(tweetid) == cl: del self.labels[tweetid]
+        for cl, members in clusters.iteritems():
+            if members is None: continue
+            self.members[cl] = set(members)
+            for tweetid in members:
+                self.labels[tweetid] = cl
+
+    def save_state(self, change):
+        """
+        append this run's change to the state file
+        the whole state is written beside the old one and swapped in instead when
+        there is no usable state file or the changes have grown bigger than the full copy
+        a change that was only partly written is cut off before appending
+        returns the number of bytes written
+        """
+        if self.end is not None and self.end - self.basesize <= self.basesize:
+            with open(self.statefile, 'r+b') as fh:
+                fh.seek(self.end)
+                fh.truncate()
+                cPickle.dump(change, fh, cPickle.HIGHEST_PROTOCOL)
+                written = fh.tell() - self.end
+                self.end = fh.tell()
+            return written
+
+        tmp = self.statefile + '.new'
+        with open(tmp, 'wb') as fh:
+            cPickle.dump({
+                'version': STATE_VERSION,
+                'params': self.params(),
+                'created': self.created,
+                'watermark': self.watermark,
+                'edges': self.graph.edges,
+                'members': self.members,
+            }, fh, cPickle.HIGHEST_PROTOCOL)
+            self.basesize = self.end = fh.tell()
+        os.rename(tmp, self.statefile)
+        return self.basesize
+
+    def expire(self, minid):
+        """
+        drop tweets that are now older than daysback
+        returns the dropped tweets and their neighbours and a list of the dropped tweets
+        """
+        changed = set()
+        expired = []
+        if minid is None: return changed, expired
+        for tweetid in [t for t in self.graph.edges if t <= minid]:
+            changed.update(self.graph.drop(tweetid))
+            changed.add(tweetid)
+            expired.append(tweetid)
+        yglog.vprint("expired tweets up to",minid)
+        return changed, expired
+
+    def load_changes(self, minid, rebuild=False):
+        """
+        apply similarity rows added since the watermark to the graph
+        rows that fell below epsilon remove their edge
+        rows from a little before the watermark are read again in case they committed late
+        returns the tweets whose neighbours changed, the number of rows read
+        and the rows that changed the graph
+        """
+        get = self.getcursor()
+        get.execute("select now()")
+        now = get.fetchone()[0]
+        if rebuild or self.watermark is None:
+            get.execute(
+                "select id1,id2,jaccard+links sim from similarity where id1 > %s and jaccard+links >= %s",
+                (minid,self.epsilon)
+            )
+        else:
+            get.execute(
+                "select id1,id2,jaccard+links sim from similarity "
+                "where added >= %s - interval %s second and id1 > %s",
+                (self.watermark,WATERMARK_LAG,minid)
+            )
+        changed = set()
+        edges = []
+        rows = 0
+        for id1, id2, sim in get:
+            rows += 1
+            if id2 <= minid: continue
+            if self.graph.add(id1, id2, sim):
+                changed.add(id1)
+                changed.add(id2)
+                edges.append((id1, id2, sim))
+        get.close()
+        self.watermark = now
+        return changed, rows, edges
+
+    def affected(self, changed):
+        """
+        tweets in the connected parts of the graph that have a changed tweet
+        in ascending order as ygneighbours.tweetids gives them
+        """
+        edges = self.graph.edges
+        seen = set(t for t in changed if t in edges)
+        queue = list(seen)
+        while len(queue) > 0:
+            for n in edges[queue.pop()]:
+                if n in seen: continue
+                seen.add(n)
+                queue.append(n)
+        return sorted(seen)
+
+    def recluster(self, changed):
+        """
+        rerun dbscan on the parts of the graph with changed tweets
+        and record what happened to their clusters in self.delta
+        returns the ids of the clusters that were there before and
+        a dict of cluster id -> members (None if it has gone) for save_state
+        """
+        region = self.affected(changed)
+        self.reclustered = len(region)
+        old = set(self.labels[t] for t in changed if t in self.labels)
+        old.update(self.labels[t] for t in region if t in self.labels)
+
+        self.tweetids = region
+        self.clusters = {}
+        self.clustered = {}
+        self.noise = {}
+        self.dbscan()
+
+        previous = {}
+        before = {}
+        for cl in old:
+            before[cl] = len(self.members[cl])
+            for tweetid in self.members[cl]:
+                previous[tweetid] = cl
+        clusters = dict.fromkeys(old)
+        after = {}
+        came_from = {}
+        for cl, members in self.clusters.iteritems():
+            clusters[cl] = sorted(members)
+            after[cl] = len(members)
+            for tweetid in members:
+                if tweetid in previous:
+                    came_from.setdefault(cl, {})
+                    came_from[cl][previous[tweetid]] = came_from[cl].get(previous[tweetid], 0) + 1
+        self.set_clusters(clusters)
+
+        delta = no_change()
+        for cl in sorted(old):
+            if cl in after:
+                if after[cl] > before[cl]: delta['grew'][cl] = [before[cl], after[cl]]
+                elif after[cl] < before[cl]: delta['shrank'][cl] = [before[cl], after[cl]]
+                continue
+            delta['disappeared'].append(cl)
+            for label in sorted(came_from):
+                if cl in came_from[label]:
+                    delta['merged'][cl] = label
+                    break
+        for label in sorted(after):
+            if label in old: continue
+            delta['appeared'].append(label)
+            if label in came_from:
+                sources = came_from[label]
+                delta['split'][label] = min(sources, key=lambda cl: (-sources[cl], cl))
+        self.delta = delta
+        return old, clusters
+
+    def run(self):
+        """
+        update the clusters from the last run and save them for the next one
+        """
+        start = time.time()
+        self.created = self.table_created()
+        rebuild = not self.load_state()
+        if rebuild:
+            self.graph = ygadjacency(self.epsilon)
+            self.labels = {}
+            self.members = {}
+            self.watermark = None
+            self.end = None
+        minid = self.get_minid(self.daysback)
+        yglog.vprint("starting with id",minid)
+        changed, expired = self.expire(minid)
+        added, rows, edges = self.load_changes(minid, rebuild)
+        changed.update(added)
+        touched, clusters = self.recluster(changed)
+        written = self.save_state({
+            'watermark': self.watermark,
+            'expired': expired,
+            'edges': edges,
+            'clusters': clusters,
+        })
+
+        self.clusters = {}
+        for cl, members in self.members.iteritems():
+            self.clusters[cl] = dict.fromkeys(members, True)
+        self.clustered = dict.fromkeys(self.labels, True)
+        self.tweetids = self.graph.tweetids()
+        sys.stderr.write(
+            "ygincremental: {} run read {} rows, {} tweets changed, {} of {} clusters touched, "
+            "{} tweets reclustered, {} bytes saved in {:.3f}s\n".format(
+                'full' if rebuild else 'incremental', rows, len(changed),
+                len(touched | set(self.delta['appeared'])), len(self.clusters),
+                self.reclustered, written, time.time() - start
+            )
+        )
+        self.get_clustertweets()
+        self.get_stats()
+
+class ygsweep(ygdbscan):
+    """
+    cluster with every combination of a grid of epsilon, minsz and daysback values
+
+    similarity is read once at the lowest epsilon and the longest daysback
+    and sorted most similar first. for each daysback one ygthresholds graph is
+    built and grown from the highest epsilon to the lowest, and each setting
+    runs the same dbscan as a batch ygcluster.py run on it
+    """
+    def __init__(self, args, epsilons, minszs, daysbacks):
+        super(ygsweep, self).__init__(args)
+        self.epsilons = sorted(set(epsilons), reverse=True)
+        self.minszs = sorted(set(minszs))
+        self.daysbacks = sorted(set(daysbacks))
+        self.minids = {}
+        self.results = []
+
+    def load(self):
+        """
+        read the widest window of similarity once and sort it most similar first
+        id1 decides which daysback windows a row is in and a pair is a
+        neighbour at an epsilon if any of its rows in the window pass it
+        """
+        for daysback in self.daysbacks:
+            self.minids[daysback] = self.get_minid(daysback)
+        minid = self.minids[self.daysbacks[-1]]
+        get = self.getcursor()
+        get.execute(
+            "select id1,id2,jaccard+links sim from similarity where id1 > %s and jaccard+links >= %s",
+            (minid,self.epsilons[-1])
+        )
+        edges1 = array('l')
+        edges2 = array('l')
+        edgesims = array('d')
+        for id1, id2, sim in get:
+            edges1.append(id1)
+            edges2.append(id2)
+            edgesims.append(sim)
+        get.close()
+        order = sorted(xrange(len(edgesims)), key=edgesims.__getitem__, reverse=True)
+        self.edges1 = array('l', (edges1[k] for k in order))
+        self.edges2 = array('l', (edges2[k] for k in order))
+        self.edgesims = array('d', (edgesims[k] for k in order))
+        yglog.vprint("sweep loaded",len(self.edgesims),"edges from",minid)
+
+    def graph_for(self, minid):
+        """
+        ygthresholds graph of the rows newer than minid ready to be lowered
+        through the epsilons
+        """
+        graph = ygthresholds(self.epsilons[-1])
+        for k in xrange(len(self.edgesims) - 1, -1, -1):
+            if minid is not None and self.edges1[k] <= minid: continue
+            graph.add(self.edges1[k], self.edges2[k], self.edgesims[k])
+        graph.build()
+        return graph
+
+    def stats(self, tweets, labels, previous):
+        """
+        cluster counts and sizes, noise ratio and stability
+        labels and previous are the cluster of each clustered tweet
+        at this epsilon and at the next higher one
+        """
+        sizes = {}
+        for cl in labels.itervalues():
+            sizes[cl] = sizes.get(cl, 0) + 1
+        sizelist = sorted(sizes.itervalues())
+        stability = None
+        if previous is not None and len(labels) > 0:
+            pieces = {}
+            for tweetid, cl in labels.iteritems():
+                before = previous.get(tweetid)
+                if before is None: continue
+                key = (cl, before)
+                pieces[key] = pieces.get(key, 0) + 1
+            biggest = {}
+            for (cl, before), count in pieces.iteritems():
+                if count > biggest.get(cl, 0): biggest[cl] = count
+            stability = float(sum(biggest.itervalues())) / len(labels)
+        return {
+            'tweets': tweets,
+            'clusters': len(sizelist),
+            'clustered': len(labels),
+            'maxsize': sizelist[-1] if sizelist else 0,
+            'medsize': sizelist[len(sizelist)//2] if sizelist else 0,
+            'meansize': float(len(labels)) / len(sizelist) if sizelist else 0.0,
+            'noise': 1.0 - float(len(labels)) / tweets if tweets else 0.0,
+            'stability': stability,
+        }
+
+    def sweep(self, daysback):
+        """
+        stats for each epsilon and minsz, the graph is built once and
+        grown by the edges each lower epsilon lets in
+        stability is the share of clustered tweets whose cluster at this epsilon
+        came from one cluster at the next higher epsilon
+        """
+        minid = self.minids[daysback]
+        previous = dict.fromkeys(self.minszs)
+        results = []
+        self.graph = self.graph_for(minid)
+        for epsilon in self.epsilons:
+            self.epsilon = epsilon
+            self.graph.lower(epsilon)
+            for minsz in self.minszs:
+                self.minsz = minsz
+                self.tweetids = self.graph.tweetids()
+                self.clusters = {}
+                self.clustered = {}
+                self.noise = {}
+                self.dbscan()
+                labels = {}
+                for cl, members in self.clusters.iteritems():
+                    for tweetid in members:
+                        labels[tweetid] = cl
+                stats = self.stats(len(self.graph), labels, previous[minsz])
+                previous[minsz] = labels
+                stats['epsilon'] = epsilon
+                stats['minsz'] = minsz
+                stats['daysback'] = daysback
+                results.append(stats)
+        return results
+
+    def run(self):
+        start = time.time()
+        self.load()
+        loaded = time.time()
+        self.results = []
+        for daysback in self.daysbacks:
+            self.results.extend(self.sweep(daysback))
+        self.results.sort(key=lambda r: (r['daysback'], r['minsz'], -r['epsilon']))
+        sys.stderr.write(
+            "ygsweep: {} settings, {} edges, load {:.3f}s sweep {:.3f}s\n".format(
+                len(self.results), len(self.edgesims), loaded - start, time.time() - loaded
+            )
+        )
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         "use dbscan algorithm to make a group of clusters from processed tweet data"
     )
-    parser.add_argument('--epsilon',type=float,required=True,help="smallest similarity score to use")
-    parser.add_argument('--minsz',type=int,required=True,help="minimum number of neighbours to have to use tweet")
+    parser.add_argument('--epsilon',type=float,help="smallest similarity score to use")
+    parser.add_argument('--minsz',type=int,help="minimum number of neighbours to have to use tweet")
     parser.add_argument('--verbose',action='store_true',help="show debug messages")
     parser.add_argument('--clusters',action='store_true',help="json dump cluster tweetids")
     parser.add_argument('--tweets',action='store_true',help="json dump tweets in clusters")
@@ -339,26 +1337,78 @@ if __name__ == '__main__':
     parser.add_argument('--interesting',type=float,help="json dump top tweets based on percentile")
     parser.add_argument('--keywords',type=int,help="json dump top N keywords for clusters")
     parser.add_argument('--daysback',type=int,default=2,help="base clusters on tweets newer than this")
+    parser.add_argument('--incremental',help="state file: update the clusters from the last run instead of starting over")
+    parser.add_argument('--delta',action='store_true',help="json dump clusters that appeared, grew or disappeared (needs --incremental)")
+    parser.add_argument('--out',action='append',default=[],metavar='NAME=FILE',
+        help="also write an output ({}) to FILE, can be repeated".format(', '.join(OUTPUTS)))
+    parser.add_argument('--snapshot',help="reuse the clusters saved in this file if similarity has not changed")
+    parser.add_argument('--workers',type=int,default=0,help="run dbscan on the graph's connected components in this many processes")
+    parser.add_argument('--sweep',action='store_true',help="json dump cluster stats for a grid of settings")
+    parser.add_argument('--epsilons',help="comma separated epsilons for --sweep (default --epsilon)")
+    parser.add_argument('--minszs',help="comma separated minsz values for --sweep (default --minsz)")
+    parser.add_argument('--daysbacks',help="comma separated daysback values for --sweep (default --daysback)")
     args = parser.parse_args()
     yglog.verbose = args.verbose
 
-    with ygdbscan(args) as dbscan:
-        dbscan.run()
-        if args.clusters: 
-            print json.dumps(dbscan.clusters, indent=4)
-        if args.tweets:
-            print json.dumps(dbscan.clustertweets, indent=4)
-        if args.stats:
-            print json.dumps(dbscan.stats, indent=4)
-        if args.best:
-            print json.dumps({
-                'clusterid': dbscan.stats['topcluster'],
-                'tweetid': dbscan.stats['toptweet'],
-                'tweetdata': dbscan.get_toptweet(),
-            }, indent=4)
-        if args.interesting is not None:
-            print json.dumps(dbscan.get_interesting(args.interesting), indent=4, sort_keys=True)
-        if args.keywords > 0:
-            dbscan.get_clusterterms(args.keywords)
-            print json.dumps(dbscan.clusterterms, indent=4)
+    if args.sweep:
+        def grid(values, default, cast):
+            if values: return [cast(v) for v in values.split(',')]
+            if default is None: parser.error("--sweep needs a value or list for each setting")
+            return [default]
+        epsilons = grid(args.epsilons, args.epsilon, float)
+        minszs = grid(args.minszs, args.minsz, int)
+        daysbacks = grid(args.daysbacks, args.daysback, int)
+        args.epsilon = min(epsilons)
+        args.minsz = min(minszs)
+        with ygsweep(args, epsilons, minszs, daysbacks) as sweep:
+            sweep.run()
+            print json.dumps(sweep.results, indent=4, sort_keys=True)
+        sys.stderr.write(ygdb.pool.report())
+        sys.exit(0)
+    if args.epsilon is None or args.minsz is None:
+        parser.error("--epsilon and --minsz are required")
+
+    outfiles = []
+    for out in args.out:
+        name, sep, path = out.partition('=')
+        if name not in OUTPUTS or path == '':
+            parser.error("--out expects NAME=FILE with NAME one of {}".format(', '.join(OUTPUTS)))
+        if name == 'keywords' and not args.keywords > 0:
+            parser.error("--out keywords=FILE needs --keywords N")
+        if name == 'delta' and not args.incremental:
+            parser.error("--out delta=FILE needs --incremental")
+        outfiles.append((name, path))
+
+    printed = {
+        'delta': args.delta and args.incremental,
+        'clusters': args.clusters,
+        'tweets': args.tweets,
+        'stats': args.stats,
+        'best': args.best,
+        'interesting': args.interesting is not None,
+        'keywords': args.keywords > 0,
+    }
+    sortkeys = ('interesting', 'delta')
+
+    if args.incremental:
+        dbscan = ygincremental(args, args.incremental)
+    else:
+        dbscan = ygdbscan(args)
 
+    with dbscan:
+        fresh = args.snapshot is None or not dbscan.load_snapshot(args.snapshot, args.keywords)
+        if fresh:
+            dbscan.run()
+        for name in ('delta',) + OUTPUTS[:-1]:
+            if not printed[name]: continue
+            data = dbscan.get_output(name, args.interesting, args.keywords)
+            print json.dumps(data, indent=4, sort_keys=name in sortkeys)
+        for name, path in outfiles:
+            data = dbscan.get_output(name, args.interesting, args.keywords)
+            with open(path + '.new', 'w') as fh:
+                json.dump(data, fh, indent=4, sort_keys=name in sortkeys)
+                fh.write("\n")
+            os.rename(path + '.new', path)
+        if fresh and args.snapshot:
+            dbscan.save_snapshot(args.snapshot)
+    sys.stderr.write(ygdb.pool.report())
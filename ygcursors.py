@@ -1,6 +1,7 @@
 """
 author: Cal Woodruff, cwoodruf@sfu.ca
 basic mixin class to standardize db access
+connections come from the process wide ygdb.pool and go back to it when closed
 """
 import ygdb
 
@@ -11,11 +12,11 @@ class ygcursors(object):
 
     def opendb(self):
         self.closedb()
-        self.conn = ygdb.conn()
+        self.conn = ygdb.pool.acquire()
 
     def closedb(self):
         if self.conn is not None:
-            self.conn.close()
+            ygdb.pool.release(self.conn)
             self.conn = None
 
     def getcursor(self):
@@ -27,6 +28,10 @@ class ygcursors(object):
         if self.conn is None: return
         self.conn.commit()
 
+    def _rollback(self):
+        if self.conn is None: return
+        self.conn.rollback()
+
     # allows for the use of the "with" keyword
     def __enter__(self):
         return self
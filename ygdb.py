@@ -1,23 +1,195 @@
 """
 author: Cal Woodruff, cwoodruf@sfu.ca
 connect to mysql db ygnews
+
+ygcursors gets its connections from the process wide pool rather than
+opening a new one each time, see ygpool
 """
 from ygsecrets import ygnewsdb
 import MySQLdb
-connection = None
+import threading
+import weakref
+import time
+import os
+
+SESSION = "set session transaction isolation level repeatable read"
+POOL_SIZE = ygnewsdb.get('poolsize', 8) # most connections open at once per process
+POOL_TIMEOUT = 60                       # seconds to wait for a free connection
+PING_AFTER = 30                         # seconds idle before a connection is pinged
 
 def conn(db=ygnewsdb):
-    global connection
-    connection = MySQLdb.connect(
-        host=db['host'], 
-        port=db['port'], 
-        db=db['db'], 
-        user=db['user'], 
-        passwd=db['pw']
+    """
+    open a new connection, the session setup is sent with the connect
+    """
+    return MySQLdb.connect(
+        host=db['host'],
+        port=db['port'],
+        db=db['db'],
+        user=db['user'],
+        passwd=db['pw'],
+        init_command=SESSION
     )
-    cursor = connection.cursor()
-    cursor.execute("set session transaction isolation level repeatable read")
-    return connection
+
+class ygpool(object):
+    """
+    process wide pool of connections used by ygcursors
+
+    at most size connections are open at once, acquire waits for one
+    to be released when they are all in use
+    released connections are rolled back (as closing them used to do) and kept
+    connections idle for more than PING_AFTER seconds are pinged before being
+    handed out again and replaced if they have gone away
+    connections handed out are only weakly referenced so one dropped without
+    being released is closed as it always was and stops counting as in use
+    a forked process starts with an empty pool and never touches its parent's
+    connections as they share the parent's sockets
+    """
+    def __init__(self, size=POOL_SIZE, timeout=POOL_TIMEOUT, connect=None):
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.connect = connect # defaults to conn
+        self.setup()
+
+    def setup(self):
+        self.pid = os.getpid()
+        self.lock = threading.Condition()
+        self.idle = []    # (connection, time released)
+        self.busy = {}    # id(connection): weakref to connection
+        self.inherited = []
+        self.stats = {
+            'created': 0, 'acquired': 0, 'reused': 0, 'waits': 0, 'waited': 0.0,
+            'pings': 0, 'reconnects': 0, 'discarded': 0,
+        }
+
+    def forked(self):
+        """
+        start over if this is a child of the process that made the pool
+        """
+        if os.getpid() == self.pid: return
+        # closing them would close the parent's connections too so just keep them
+        inherited = self.inherited + [c for c, released in self.idle]
+        inherited += [ref() for ref in self.busy.values() if isinstance(ref, weakref.ref) and ref() is not None]
+        self.setup()
+        self.inherited = inherited
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+    def acquire(self):
+        """
+        a connection from the pool or a new one
+        """
+        self.forked()
+        with self.lock:
+            start = None
+            while len(self.idle) == 0 and len(self.busy) >= self.size:
+                if start is None:
+                    start = time.time()
+                    self.stats['waits'] += 1
+                remaining = self.timeout - (time.time() - start)
+                if remaining <= 0:
+                    raise(Exception("ygdb.ygpool.acquire: no free connection after {}s ({} in use)".format(
+                        self.timeout, len(self.busy)
+                    )))
+                self.lock.wait(remaining)
+            if start is not None: self.stats['waited'] += time.time() - start
+            idle = self.idle.pop() if len(self.idle) else None
+            # hold the place of the connection while it is checked or made
+            placeholder = object()
+            self.busy[id(placeholder)] = placeholder
+
+        try:
+            c = None
+            if idle is not None:
+                c, released = idle
+                if time.time() - released > PING_AFTER and not self.alive(c):
+                    self.discard(c)
+                    self.count('reconnects')
+                    c = None
+                else:
+                    self.count('reused')
+            if c is None:
+                c = conn() if self.connect is None else self.connect()
+                self.count('created')
+        finally:
+            with self.lock:
+                del self.busy[id(placeholder)]
+                if c is not None: self.busy[id(c)] = weakref.ref(c, self.dropped(id(c)))
+                self.stats['acquired'] += 1 if c is not None else 0
+                self.lock.notify()
+        return c
+
+    def dropped(self, key):
+        """
+        weakref callback for a connection that was never released
+        """
+        def callback(ref):
+            with self.lock:
+                if self.busy.get(key) is ref:
+                    del self.busy[key]
+                    self.lock.notify()
+        return callback
+
+    def alive(self, c):
+        self.count('pings')
+        try:
+            c.ping()
+            return True
+        except Exception:
+            return False
+
+    def discard(self, c):
+        self.count('discarded')
+        try:
+            c.close()
+        except Exception:
+            pass
+
+    def release(self, c):
+        """
+        give back a connection from acquire, anything not committed is rolled back
+        """
+        self.forked()
+        if any(c is i for i in self.inherited): return
+        with self.lock:
+            ours = self.busy.pop(id(c), None) is not None
+        if not ours:
+            # not from this pool so it just gets closed like before
+            self.discard(c)
+            return
+        try:
+            c.rollback()
+            ok = True
+        except Exception:
+            ok = False
+        with self.lock:
+            if ok: self.idle.append((c, time.time()))
+            self.lock.notify()
+        if not ok: self.discard(c)
+
+    def closeall(self):
+        """
+        close the idle connections
+        """
+        self.forked()
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for c, released in idle:
+            self.discard(c)
+
+    def report(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['idle'] = len(self.idle)
+            stats['busy'] = len(self.busy)
+        return (
+            "ygdb: {acquired} connections acquired {created} created {reused} reused "
+            "{reconnects} reconnects {waits} waits {waited:.3f}s waiting {idle} idle {busy} in use\n"
+        ).format(**stats)
+
+pool = ygpool()
 
 if __name__ == '__main__':
     c = conn()
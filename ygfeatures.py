@@ -14,6 +14,7 @@ produce relatively simple grammar in a "headline" style
 concatenate text from subtweets with the tweet text 
 """
 from ygcursors import ygcursors
+from ygtokens import ygtokenizer
 import yglog
 import sys
 import json
@@ -21,6 +22,60 @@ import re
 import time
 import traceback
 import argparse
+import multiprocessing
+
+BATCH_SIZE = 200 # tweets saved per transaction by scan_tweets
+RETRIES = 3      # times a batch is tried again before giving up
+
+def scan_shard(args):
+    """
+    worker process for ygfeatures.scan_workers: scans the tweets in one shard
+    and returns the number of tweets scanned
+    """
+    ip, thread, shard, shards, batchsize = args
+    with ygfeatures(ip=ip, thread=thread) as feat:
+        feat.shard = (shard, shards)
+        feat.batchsize = batchsize
+        return feat.scan_tweets()
+
+def refresh_counts(upd, counts):
+    """
+    counts only refresh used by ygimport for tweets whose retweet/favorite counts
+    are all that changed: updates their features rows and the users' running totals
+    without tokenizing them again (tweets not scanned yet are left to scan_tweets)
+    counts is a dict of tweet id: (retweet_count, favorite_count)
+    returns the number of rows changed
+    """
+    if len(counts) == 0: return 0
+    ids = sorted(counts)
+    upd.execute(
+        "select id,user,retweet_count,favorite_count,combined_count from features where id in ({})".format(
+            ",".join(["%s" for i in ids])
+        ),
+        tuple(ids)
+    )
+    rows = []
+    userdeltas = {}
+    for tweetid, user, retweets, favorites, combined in upd.fetchall():
+        newretweets, newfavorites = counts[tweetid]
+        if (retweets, favorites) == (newretweets, newfavorites): continue
+        rows.append((newretweets, newfavorites, newretweets + newfavorites, tweetid))
+        if user is not None and combined is not None:
+            userdeltas[user] = userdeltas.get(user, 0) + newretweets + newfavorites - combined
+    if len(rows) == 0: return 0
+
+    upd.executemany(
+        "update features set retweet_count=%s,favorite_count=%s,combined_count=%s where id=%s",
+        rows
+    )
+    userrows = [(userdeltas[user], user) for user in sorted(userdeltas) if userdeltas[user] != 0]
+    if len(userrows):
+        upd.executemany(
+            "update users set combined_sum=combined_sum+%s,"
+            "combined_av=if(combined_num>0,combined_sum/combined_num,null) where screen_name=%s",
+            userrows
+        )
+    return len(rows) + len(userrows)
 
 class ygfeatures(ygcursors):
     """
@@ -44,6 +99,24 @@ class ygfeatures(ygcursors):
             self.thread = int(thread)
         except:
             self.thread = None
+        self.tokenizer = None # made by scan_tweets with the cliches from the db
+        self.shard = None     # (shard, shards): only scan tweets where id mod shards = shard
+        self.batchsize = BATCH_SIZE
+        self.pending = self.no_pending()
+        self.batches = 0
+        self.retries = 0
+
+    def no_pending(self):
+        """
+        empty buffers for rows waiting to be written by flush
+        """
+        return {
+            'links': [],
+            'tweetwords': [],
+            'tweetbigrams': [],
+            'features': {}, # rows by column list
+            'scanned': [],
+        }
 
     def reset_features(self):
         """
@@ -54,6 +127,9 @@ class ygfeatures(ygcursors):
         rem.execute("delete from tweetwords")
         rem.execute("delete from tweetbigrams")
         rem.execute("delete from links")
+        rem.execute("delete from words")
+        rem.execute("delete from bigrams")
+        rem.execute("update users set combined_sum=0, combined_num=0")
         rem.execute("update tweets set scanned=0")
         rem.close()
         self._commit()
@@ -72,6 +148,21 @@ class ygfeatures(ygcursors):
         get.close()
         return stopwords
         
+    def get_cliches(self):
+        """
+        phrases from the cliches table that should be treated as one word
+        returns a list (empty if there is no cliches table)
+        """
+        get = self.getcursor()
+        try:
+            get.execute("select phrase from cliches")
+            cliches = [row[0] for row in get]
+        except Exception as e:
+            yglog.vprint("no cliches table:",e)
+            cliches = []
+        get.close()
+        return cliches
+
     def save_entities(self, data):
         """
         extracts the entities section of data and updates links
@@ -93,58 +184,190 @@ class ygfeatures(ygcursors):
 
         yglog.vprint("links", links)
 
-        if len(links) == 0: return
-
-        ins = self.getcursor()
-        ins.executemany(
-            "insert ignore into links (id,link,source) values (%s,%s,%s) ",
-            links
-        )
-        ins.close()
-        self._commit()
+        self.pending['links'].extend(links)
         
     def save_features(self, features):
         """
-        saves specific items from data listed in features
+        queues specific items from data listed in features
         """
         fieldnames = ",".join(features.keys())
-        placeholders = ",".join(["%s" for f in range(len(features))])
-        fieldvals = tuple(features.values())
-        upd = self.getcursor()
-        upd.execute(
-            "insert ignore into features ({}) values ({})".format(fieldnames,placeholders), 
-            fieldvals
-        )
-        upd.execute(
-            "update features set retweet_count=%s,favorite_count=%s,combined_count=%s where id=%s",
-            (features['retweet_count'],features['favorite_count'],features['combined_count'],features['id'])
-        )
-        upd.close()
-        self._commit()
+        self.pending['features'].setdefault(fieldnames, []).append(tuple(features.values()))
         
     def save_wordstats(self, tweetid, grams):
         """
-        given a dict of tuples lists by table
-        insert them all into the db
+        given a dict of term counts by table
+        queue them all for the db
         """
         for table, termdict in grams.iteritems():
             termlist = []
             for term, num in termdict.iteritems():
                 termlist.append((tweetid, term, num))
-            ins = self.getcursor()
-            yglog.vprint("saving to",table)
+            yglog.vprint("queued for",table)
             yglog.vprint(termlist)
+            self.pending[table].extend(termlist)
+
+    def count_deltas(self, get):
+        """
+        work out how the queued rows change words and bigrams and read the
+        features rows the batch may change, must be called before the rows are written
+
+        words and bigrams count the tweets a term is in: a rescan replaces rows
+        but never removes them so only new (id, term) pairs add to the count
+        returns (term deltas by summary table, (user, combined_count) by existing features id)
+        """
+        pending = self.pending
+        termdeltas = {}
+        for table, summary in (('tweetwords', 'words'), ('tweetbigrams', 'bigrams')):
+            rows = pending[table]
+            if len(rows) == 0: continue
+            ids = sorted(set([row[0] for row in rows]))
+            get.execute(
+                "select id,term from {} where id in ({})".format(table, ",".join(["%s" for i in ids])),
+                tuple(ids)
+            )
+            existing = set([(tweetid, term) for tweetid, term in get])
+            deltas = {}
+            for tweetid, term, num in rows:
+                if (tweetid, term) in existing: continue
+                existing.add((tweetid, term))
+                deltas[term] = deltas.get(term, 0) + 1
+            termdeltas[summary] = deltas
+        return termdeltas, self.features_counts(get)
+
+    def features_counts(self, get):
+        """
+        (user, combined_count) by id for the features rows of the queued tweets
+        """
+        ids = set()
+        for fieldnames, rows in self.pending['features'].iteritems():
+            idcol = fieldnames.split(",").index('id')
+            ids.update([row[idcol] for row in rows])
+        if len(ids) == 0: return {}
+        ids = sorted(ids)
+        get.execute(
+            "select id,user,combined_count from features where id in ({})".format(
+                ",".join(["%s" for i in ids])
+            ),
+            tuple(ids)
+        )
+        return dict([(tweetid, (user, count)) for tweetid, user, count in get])
+
+    def user_deltas(self, get, before):
+        """
+        users keep the sum and count of their tweets' combined_count
+        compares the features rows after the write with those from before it
+        so a tweet whose features were ignored (see features_words_idx) counts for nothing
+        returns [sum, count] deltas by user
+        """
+        userdeltas = {}
+        for tweetid, (user, count) in self.features_counts(get).iteritems():
+            if user is None: continue
+            delta = userdeltas.setdefault(user, [0, 0])
+            if tweetid in before:
+                delta[0] += count - before[tweetid][1]
+            else:
+                delta[0] += count
+                delta[1] += 1
+        return userdeltas
+
+    def apply_deltas(self, upd, termdeltas, userdeltas):
+        """
+        add the changes from count_deltas and user_deltas to words, bigrams and users
+        rows are changed in sorted order so concurrent batches lock them in the same order
+        """
+        for summary, deltas in termdeltas.iteritems():
+            if len(deltas) == 0: continue
+            upd.executemany(
+                "insert into {} (term,num) values (%s,%s) "
+                "on duplicate key update num=num+values(num)".format(summary),
+                sorted(deltas.iteritems())
+            )
+        if len(userdeltas) > 0:
+            upd.executemany(
+                "update users set combined_sum=combined_sum+%s,combined_num=combined_num+%s,"
+                "combined_av=if(combined_num>0,combined_sum/combined_num,null) where screen_name=%s",
+                [(userdeltas[user][0], userdeltas[user][1], user) for user in sorted(userdeltas)]
+            )
+
+    def write_pending(self):
+        """
+        one multi-row statement per table for the queued rows
+        (MySQLdb's executemany turns an insert or replace into a single statement)
+        except for the features counts which are updated a row at a time
+        words, bigrams and users are brought up to date in the same transaction
+        """
+        pending = self.pending
+        ins = self.getcursor()
+        termdeltas, before = self.count_deltas(ins)
+        if len(pending['links']) > 0:
+            ins.executemany(
+                "insert ignore into links (id,link,source) values (%s,%s,%s) ",
+                pending['links']
+            )
+        for table in ('tweetwords', 'tweetbigrams'):
+            if len(pending[table]) == 0: continue
             ins.executemany(
                 "replace into {} (id, term, num) values (%s,%s,%s) ".format(table),
-                termlist
+                pending[table]
             )
-            ins.close()
-            self._commit()
-                
-        
+        for fieldnames, rows in pending['features'].iteritems():
+            placeholders = ",".join(["%s" for f in fieldnames.split(",")])
+            # a tweet whose words match another's is ignored, as is an existing one
+            ins.executemany(
+                "insert ignore into features ({}) values ({})".format(fieldnames,placeholders),
+                rows
+            )
+            # and existing features only get their counts updated
+            fields = fieldnames.split(",")
+            cols = [fields.index(f) for f in ('retweet_count', 'favorite_count', 'combined_count', 'id')]
+            ins.executemany(
+                "update features set retweet_count=%s,favorite_count=%s,combined_count=%s where id=%s",
+                [tuple([row[col] for col in cols]) for row in rows]
+            )
+        if len(pending['scanned']) > 0:
+            ins.execute(
+                "update tweets set scanned=1 where id in ({})".format(
+                    ",".join(["%s" for tweetid in pending['scanned']])
+                ),
+                tuple(pending['scanned'])
+            )
+        self.apply_deltas(ins, termdeltas, self.user_deltas(ins, before))
+        ins.close()
+
+    def flush(self):
+        """
+        write everything queued in one transaction
+        a batch that fails is rolled back and tried again on a fresh connection
+        tweets are only marked scanned in the same transaction as their features
+        """
+        pending = self.pending
+        if sum([len(rows) for rows in pending.itervalues()]) == 0: return
+        for attempt in xrange(RETRIES + 1):
+            try:
+                self.write_pending()
+                self._commit()
+                break
+            except Exception as e:
+                try:
+                    self._rollback()
+                except:
+                    self.conn = None
+                if attempt == RETRIES:
+                    # the batch was rolled back so its tweets are still unscanned
+                    # (links is MyISAM and keeps its rows but they are insert ignored next time)
+                    self.pending = self.no_pending()
+                    raise(Exception("ygfeatures.flush: batch failed {} times: {}".format(attempt + 1, e)))
+                sys.stderr.write("ygfeatures.flush error: {} (retrying)\n".format(e))
+                self.retries += 1
+                self.closedb()
+                time.sleep(attempt + 1)
+        self.batches += 1
+        self.pending = self.no_pending()
+
+
     def extract_and_save_features(self, data, stopwords):
         """
-        does some basic cleanup of the tweet text 
+        does some basic cleanup of the tweet text (see ygtokens)
         saves a bag of words list for each tweet
         these include emails, user ids and hash tags
         also makes and saves bigrams
@@ -164,42 +387,11 @@ class ygfeatures(ygcursors):
                 rawtext += " "
                 rawtext += data['retweeted_status']['text'].encode('ascii','replace')
         yglog.vprint(rawtext)
-        words = rawtext.lower()
-        words = re.sub(r'https?://\S*','',words)
-        words = re.sub(r'&amp;','and',words)
-        words = re.sub(r'&quot;','"',words)
-        words = re.sub(r'&nbsp;',' ',words)
-        words = re.sub(r'"', ' ', words)
-        words = re.sub(r"'", ' ', words)
-        words = re.sub(r'[!?\.]+',' ',words) # may want to tag end of sentence? - clash with 'replace's ?s
-        words = re.sub(r'[,;:\-\~\$\%\^\&\*\(\)\{\}\[\]\|\\<>/]', ' ', words)
-        words = re.sub(r'\s+', ' ', words)
-        # a cliches table ?
-        words = re.sub(r'need to know','need_to_know', words)
-        wordlist = words.split()
+        if self.tokenizer is None: self.tokenizer = ygtokenizer()
+        wordlist = self.tokenizer.words(rawtext)
         yglog.vprint(tweetid,wordlist)
 
-        tweetbigrams = {}
-        tweetwords = {}
-        savedterms= {}
-        WORDWEIGHT = 1
-        BIGRAMWEIGHT = 2
-        prevword = None
-
-        for word in wordlist:
-            if word in stopwords: continue
-
-            savedterms[word] = WORDWEIGHT
-
-            if prevword is not None:
-                bigram = "{} {}".format(prevword, word)
-                if bigram not in tweetbigrams: tweetbigrams[bigram] = 0
-                tweetbigrams[bigram] += 1
-                savedterms[bigram] = BIGRAMWEIGHT
-
-            if word not in tweetwords: tweetwords[word] = 0
-            tweetwords[word] += 1
-            prevword = word
+        tweetwords, tweetbigrams, savedterms = self.tokenizer.count(wordlist, stopwords)
 
         self.save_wordstats(data['id'], {'tweetbigrams':tweetbigrams, 'tweetwords':tweetwords})
 
@@ -219,15 +411,44 @@ class ygfeatures(ygcursors):
         self.save_features(features)
 
     def set_scanned(self, data):
-        upd = self.getcursor()
-        upd.execute("update tweets set scanned=1 where id=%s", (data['id'],))
-        upd.close()
-        self._commit()
+        self.pending['scanned'].append(data['id'])
+
+    def check(self):
+        """
+        count the words, bigrams and users whose running totals
+        don't match a full recount from tweetwords, tweetbigrams and features
+        """
+        get = self.getcursor()
+        drift = {}
+        for table, summary in (('tweetwords', 'words'), ('tweetbigrams', 'bigrams')):
+            get.execute(
+                "select count(*) from {1} a left join "
+                "(select term,count(*) num from {0} group by term) b on a.term=b.term "
+                "where a.num != ifnull(b.num,0)".format(table, summary)
+            )
+            wrong = get.fetchone()[0]
+            get.execute(
+                "select count(*) from (select distinct term from {0}) b "
+                "left join {1} a on a.term=b.term where a.term is null".format(table, summary)
+            )
+            drift[summary] = wrong + get.fetchone()[0]
+        get.execute(
+            "select count(*) from users a,(select user,ifnull(sum(combined_count),0) csum,"
+            "count(combined_count) cnum from features group by user) b "
+            "where a.screen_name=b.user and (a.combined_sum != b.csum or a.combined_num != b.cnum)"
+        )
+        drift['users'] = get.fetchone()[0]
+        get.close()
+        return drift
 
     def summarize(self):
         """
-        rebuilds the words and bigrams tables based on individual tweet data
-        generally this is faster than doing the updates individually
+        rebuilds the words and bigrams tables and the users' running totals
+        based on individual tweet data
+
+        scanning keeps these up to date as it goes (see count_deltas) and ygpurge
+        takes off what it removes so this is only needed as a consistency check
+        or to set things up for the first time
 
         this would work better as a stored procedure
         """
@@ -252,22 +473,79 @@ class ygfeatures(ygcursors):
             "where combined_count is null"
         )
         replace.execute(
-            "update users a,(select user,avg(combined_count) cav "
-            "from features group by user) b set a.combined_av=b.cav where a.screen_name=b.user"
+            "update users set combined_sum=0, combined_num=0"
+        )
+        replace.execute(
+            "update users a,(select user,ifnull(sum(combined_count),0) csum,count(combined_count) cnum,"
+            "avg(combined_count) cav from features group by user) b "
+            "set a.combined_sum=b.csum,a.combined_num=b.cnum,a.combined_av=b.cav where a.screen_name=b.user"
         )
         replace.close()
         self._commit()
 
-    def scan_tweets(self, clean=False):
+    def assign(self, ips, threads=1):
+        """
+        share the unscanned tweets that have no owner among ips and threads by tweet id
+        so each node can run ygfeatures.py --ip=... --thread=... on its part
+        returns the number of tweets assigned
+        """
+        for ip in ips:
+            if re.match(r'^[\w\.\-]+$', ip) is None:
+                raise(Exception("ygfeatures.assign: bad ip {}".format(ip)))
+        shards = len(ips) * threads
+        upd = self.getcursor()
+        upd.execute(
+            "update tweets set "
+            "processing_ip=elt(floor(mod(id,%s)/%s)+1,{}),"
+            "processing_thread=mod(mod(id,%s),%s) "
+            "where scanned = 0 and processing_ip is null".format(",".join(["%s" for ip in ips])),
+            tuple([shards, threads] + list(ips) + [shards, threads])
+        )
+        assigned = upd.rowcount
+        upd.close()
+        self._commit()
+        return assigned
+
+    def scan_workers(self, workers, clean=False, summarize=False):
+        """
+        scan_tweets split over a pool of worker processes by tweet id
+        each worker uses its own db connection
+        set summarize to rebuild the summary tables once at the end
+        """
+        start = time.time()
+        if clean: self.reset_features()
+        # don't let the workers inherit our db connection
+        self.closedb()
+        shards = [(self.ip, self.thread, shard, workers, self.batchsize) for shard in xrange(workers)]
+        pool = multiprocessing.Pool(workers)
+        try:
+            counts = pool.map(scan_shard, shards, 1)
+        finally:
+            pool.close()
+            pool.join()
+        tweetcount = sum(counts)
+        if tweetcount > 0 and summarize: self.summarize()
+        elapsed = time.time() - start
+        sys.stderr.write(
+            "ygfeatures: {} tweets in {:.3f}s ({:.1f} tweets/s) with {} workers\n".format(
+                tweetcount, elapsed, tweetcount / max(elapsed, 1e-6), workers
+            )
+        )
+        return tweetcount
+
+    def scan_tweets(self, clean=False, summarize=False):
         """
         looks in tweets for tweets where scanned = 0
 
         will limit itself to look for tweets assigned to a specific ip or thread
-        if these are defined in the constructor
+        if these are defined in the constructor (and to one shard if self.shard is set)
+        words, bigrams and users are updated as each batch is saved
+        set summarize to rebuild them from scratch afterwards
 
         extracts features from the tweets such as favorite and retweet counts
         maps links and users to tweets
         manipulates the words in various ways
+        returns the number of tweets scanned
         """
         if clean: self.reset_features()
         ipquery = ""
@@ -275,13 +553,17 @@ class ygfeatures(ygcursors):
             ipquery += " and processing_ip='{}'".format(self.ip)
         if self.thread is not None:
             ipquery += " and processing_thread='{}'".format(self.thread)
+        if self.shard is not None:
+            ipquery += " and mod(id,{}) = {}".format(int(self.shard[1]), int(self.shard[0]))
+        start = time.time()
+        tweetcount = 0
         try:
             get = self.getcursor()
             get.execute(
                 "select user, raw from tweets where scanned = 0 {}".format(ipquery)
             )
             stopwords = self.get_stop_words()
-            tweetcount = 0
+            self.tokenizer = ygtokenizer(self.get_cliches())
             for row in get:
                 user, raw = row
                 data = json.loads(raw)
@@ -290,15 +572,30 @@ class ygfeatures(ygcursors):
                 self.extract_and_save_features(data, stopwords)
                 self.set_scanned(data)
                 tweetcount += 1
+                if tweetcount % self.batchsize == 0: self.flush()
+            self.flush()
 
             yglog.vprint("processed",tweetcount,"tweets")
-            if tweetcount > 0: self.summarize()
+            if tweetcount > 0 and summarize: self.summarize()
 
         except Exception as e:
             sys.stderr.write("ygfeatures.scan_tweets error: {}\n".format(e))
             traceback.print_tb(sys.exc_traceback)
+            # keep what was finished before the error as the tweet by tweet saves did
+            try:
+                self.flush()
+            except Exception as e:
+                sys.stderr.write("ygfeatures.scan_tweets error: {}\n".format(e))
         finally:
             get.close()
+        elapsed = time.time() - start
+        if tweetcount > 0:
+            sys.stderr.write(
+                "ygfeatures: {} tweets in {:.3f}s ({:.1f} tweets/s) {} batches {} retries\n".format(
+                    tweetcount, elapsed, tweetcount / max(elapsed, 1e-6), self.batches, self.retries
+                )
+            )
+        return tweetcount
             
 
 if __name__ == '__main__':
@@ -308,9 +605,27 @@ if __name__ == '__main__':
     parser.add_argument('--thread',help="optional thread number to find relevant tweets for this instance")
     parser.add_argument('--clean',action='store_true',help="delete data from features tables")
     parser.add_argument('--verbose',action='store_true',help="print lots of debug messages")
+    parser.add_argument('--batch',type=int,default=BATCH_SIZE,help="tweets to save per transaction")
+    parser.add_argument('--workers',type=int,default=0,help="split the tweets over this many processes")
+    parser.add_argument('--assign',help="comma separated ips to share unassigned tweets among then exit")
+    parser.add_argument('--threads',type=int,default=1,help="threads per ip for --assign")
+    parser.add_argument('--rebuild',action='store_true',help="check and rebuild words, bigrams and user totals from scratch")
     args = parser.parse_args()
 
     yglog.verbose = args.verbose
     with ygfeatures(ip=args.ip, thread=args.thread) as feat:
-        feat.scan_tweets(clean=args.clean)
+        feat.batchsize = max(1, args.batch)
+        if args.assign:
+            ips = [ip for ip in args.assign.split(',') if ip != '']
+            print "assigned",feat.assign(ips, max(1, args.threads)),"tweets"
+        elif args.workers > 1:
+            feat.scan_workers(args.workers, clean=args.clean)
+        else:
+            feat.scan_tweets(clean=args.clean)
+        if args.rebuild:
+            drift = feat.check()
+            sys.stderr.write("ygfeatures: running totals off for {} words {} bigrams {} users\n".format(
+                drift['words'], drift['bigrams'], drift['users']
+            ))
+            feat.summarize()
 
@@ -4,18 +4,110 @@ author: Cal Woodruff, cwoodruf@sfu.ca
 In stand alone mode this is a relatively simple script that reads a log 
 from ygnews.py and imports twitter data into the tweets table in the db.
 
+Logs can be in the one json record per line format ygnews.py writes by default
+(optionally gzipped) or the older pretty printed format with FEED/END markers.
+One record per line logs are read in chunks and parsed by a pool of processes.
+
 Also used by the ygnews module to save directly to the db.
 """
 import ygdb
+from ygcursors import ygcursors
+import ygfeatures
 import sys
 import os
 import re
 import json
+import time
+import hashlib
+import gzip
+import io
+import itertools
+import threading
+import argparse
+import multiprocessing
 
 conn = None
 
 NOIP = 'ygimport'
 NOTHREAD = -1
+BATCH_SIZE = 200 # about 10 timelines of 20 statuses
+IMPORT_BATCH = 2000 # statuses per transaction when importing logs
+CHUNK_SIZE = 1000   # log lines parsed at a time by each import worker
+
+# only placeholders in values so MySQLdb's executemany makes one multi-row statement
+# imported is filled in by with_imported
+TWEETSQL = (
+    "replace into tweets "
+    "(id,user,imported,created,raw,import_ip,import_thread,fingerprint,content_fingerprint) values "
+    "(%s,%s,%s,%s,%s,%s,%s,%s,%s)"
+)
+# engagement counts that change after a tweet is posted
+COUNTS = ('retweet_count', 'favorite_count', 'quote_count', 'reply_count')
+# an upsert so the running totals kept by ygfeatures survive
+USERSQL = (
+    "insert into users "
+    "(screen_name,favourites_count,followers_count,statuses_count) "
+    "values (%s,%s,%s,%s) "
+    "on duplicate key update favourites_count=values(favourites_count),"
+    "followers_count=values(followers_count),statuses_count=values(statuses_count)"
+)
+# the newest status saved for a feed, used as since_id by ygnews
+FEEDSQL = "update feeds set since_id=greatest(coalesce(since_id,0),%s) where user=%s"
+
+def with_imported(cur, rows):
+    """
+    tweets rows from parse_status with the db's current time added for imported
+    """
+    cur.execute("select now()")
+    imported = cur.fetchone()[0]
+    return [row[:2] + (imported,) + row[2:] for row in rows]
+
+def user_row(data):
+    """
+    users table row for a parsed status or None if it has no user part
+    """
+    if 'user' not in data: return None
+    user = data['user']
+    return (
+        user['screen_name'].lower(),
+        user['favourites_count'],
+        user['followers_count'],
+        user['statuses_count']
+    )
+
+def canonical(data, keys):
+    """
+    parsed json without the given keys at any depth with every dict turned
+    into a sorted list of [key, value] pairs so json.dumps gives the same text
+    for the same data (sort_keys would work too but is much slower)
+    """
+    if isinstance(data, dict):
+        return [[k, canonical(data[k], keys)] for k in sorted(data) if k not in keys]
+    if isinstance(data, list):
+        return [canonical(v, keys) for v in data]
+    return data
+
+def fingerprints(data):
+    """
+    md5s of a parsed status leaving out the embedded users (saved to users separately)
+    the first covers everything else, the second also leaves out the engagement counts
+    so if only the second matches a saved tweet only its counts have changed
+    """
+    return (
+        hashlib.md5(json.dumps(canonical(data, ('user',)))).hexdigest(),
+        hashlib.md5(json.dumps(canonical(data, ('user',) + COUNTS))).hexdigest()
+    )
+
+def parse_status(user, raw, ip=NOIP, thread=NOTHREAD, data=None):
+    """
+    everything ygwriter needs from a raw json status from the given feed:
+    (tweets row, (retweet_count, favorite_count), users row or None)
+    data is the parsed status if the caller already has it
+    """
+    if data is None: data = json.loads(raw)
+    row = (data['id'], user, data['created_at'], raw, ip, thread) + fingerprints(data)
+    counts = (int(data['retweet_count']), int(data['favorite_count']))
+    return row, counts, user_row(data)
 
 def save(tweet,ip=NOIP,thread=NOTHREAD):
     """
@@ -37,7 +129,7 @@ def save(tweet,ip=NOIP,thread=NOTHREAD):
     local = False
     if conn is None: 
         local = True;
-        conn = ygdb.conn()
+        conn = ygdb.pool.acquire()
 
     ins = conn.cursor()
     try:
@@ -47,25 +139,11 @@ def save(tweet,ip=NOIP,thread=NOTHREAD):
         data = json.loads(raw)
         tweetid = data['id']
         created = data['created_at']
-        ins.execute(
-            "replace into tweets "
-            "(id,user,imported,created,raw,import_ip,import_thread) values "
-            "(%s,%s,now(),%s,%s,%s,%s)",
-            (tweetid, tweet['user'], created, raw, ip, thread)
-        )
-        if 'user' in data:
-            user = data['user']
-            ins.execute(
-                "replace into users "
-                "(screen_name,favourites_count,followers_count,statuses_count) "
-                "values (%s,%s,%s,%s)",
-                (
-                    user['screen_name'].lower(),
-                    user['favourites_count'],
-                    user['followers_count'],
-                    user['statuses_count']
-                )
-            )
+        row = (tweetid, tweet['user'], created, raw, ip, thread) + fingerprints(data)
+        ins.execute(TWEETSQL, with_imported(ins, [row])[0])
+        userrow = user_row(data)
+        if userrow is not None:
+            ins.execute(USERSQL, userrow)
         ins.close()
         conn.commit()
         saved = True
@@ -78,60 +156,396 @@ def save(tweet,ip=NOIP,thread=NOTHREAD):
         saved = False
     finally:
         if local: 
-            conn.close()
+            ygdb.pool.release(conn)
             conn = None
     return saved
     
-def import_tweets(log):
+class ygwriter(ygcursors):
+    """
+    buffers statuses and saves them in batches over one connection
+    tweets are written with one multi-row replace
+    if a batch fails its tweets are saved one at a time so only the bad ones are lost
+
+    statuses already in tweets are compared by fingerprint: unchanged ones are
+    skipped and ones where only the retweet/favorite counts changed get their raw
+    json and the counts in features updated without being scanned again
+    each user is upserted once per writer (i.e. once per poll) from the first
+    status seen as timelines are newest first - set newest_first to False
+    when reading logs and the last status seen in each batch is used instead
+
+    the since_id of each feed in the feeds table is moved up to the newest
+    status in the same transaction as the statuses themselves
     """
-    import the given log file
+    def __init__(self, ip=NOIP, thread=NOTHREAD, batchsize=BATCH_SIZE, newest_first=True):
+        ygcursors.__init__(self)
+        self.ip = ip
+        self.thread = thread
+        self.batchsize = max(1, batchsize)
+        self.newest_first = newest_first
+        self.tweets = []
+        self.users = {}
+        self.usersdone = set()
+        self.watermarks = {}
+        self.saved = 0
+        self.refreshed = 0
+        self.unchanged = 0
+        self.rows = 0
+        self.errors = 0
+        self.batches = 0
+        self.connections = 0
+        self.started = time.time()
+
+    def opendb(self):
+        ygcursors.opendb(self)
+        self.connections += 1
+
+    def add(self, user, raw):
+        """
+        queue a raw json status from the given feed
+        returns False if the status can't be used
+        """
+        try:
+            row, counts, userrow = parse_status(user, raw, self.ip, self.thread)
+        except Exception as e:
+            sys.stderr.write("ygimport.ygwriter.add error: {} for {}\n".format(e, user))
+            self.errors += 1
+            return False
+        self.queue(user, row, counts, userrow)
+        return True
+
+    def queue(self, user, row, counts, userrow):
+        """
+        queue a status already split up by parse_status
+        """
+        self.tweets.append((row, counts))
+        if row[0] > self.watermarks.get(user, 0): self.watermarks[user] = row[0]
+        if userrow is not None:
+            if not self.newest_first:
+                self.users[userrow[0]] = userrow
+            elif userrow[0] not in self.usersdone:
+                self.usersdone.add(userrow[0])
+                self.users[userrow[0]] = userrow
+        if len(self.tweets) >= self.batchsize: self.flush()
+
+    def changes(self, get, tweets):
+        """
+        sort queued tweets into (new or changed rows, counts only rows, unchanged count)
+        if a tweet is queued more than once only the last one is kept
+        """
+        latest = {}
+        for row, counts in tweets:
+            latest[row[0]] = (row, counts)
+        ids = sorted(latest)
+        get.execute(
+            "select id,fingerprint,content_fingerprint from tweets where id in ({})".format(
+                ",".join(["%s" for i in ids])
+            ),
+            tuple(ids)
+        )
+        saved = dict((tweetid, (fingerprint, content)) for tweetid, fingerprint, content in get)
+
+        replace = []
+        refresh = []
+        unchanged = 0
+        for tweetid in ids:
+            row, counts = latest[tweetid]
+            old = saved.get(tweetid)
+            if old is None or old[1] != row[-1]:
+                replace.append(row)
+            elif old[0] != row[-2]:
+                refresh.append((row, counts))
+            else:
+                unchanged += 1
+        return replace, refresh, unchanged
+
+    def flush(self):
+        """
+        write everything queued so far
+        """
+        if len(self.tweets) == 0 and len(self.users) == 0: return
+        tweets = self.tweets
+        users = self.users
+        watermarks = self.watermarks
+        self.tweets = []
+        self.users = {}
+        self.watermarks = {}
+
+        try:
+            ins = self.getcursor()
+            replace, refresh, unchanged = self.changes(ins, tweets) if len(tweets) else ([], [], 0)
+            if len(replace):
+                ins.executemany(TWEETSQL, with_imported(ins, replace))
+            featurerows = self.refresh(ins, refresh) if len(refresh) else 0
+            self.save_users(ins, users)
+            self.save_watermarks(ins, watermarks)
+            ins.close()
+            self._commit()
+            self.saved += len(replace)
+            self.refreshed += len(refresh)
+            self.unchanged += unchanged
+            self.rows += len(replace) + len(refresh) + featurerows + len(users) + len(watermarks)
+            self.batches += 1
+        except Exception as e:
+            sys.stderr.write(
+                "ygimport.ygwriter.flush: batch of {} failed ({}) saving one at a time\n".format(
+                    len(tweets), e
+                )
+            )
+            self._reset()
+            try:
+                get = self.getcursor()
+                replace, refresh, unchanged = self.changes(get, tweets) if len(tweets) else ([], [], 0)
+                get.close()
+            except Exception as e:
+                # without the saved fingerprints every tweet has to be replaced
+                sys.stderr.write("ygimport.ygwriter.flush: can't compare with saved tweets ({})\n".format(e))
+                self._reset()
+                latest = dict((row[0], row) for row, counts in tweets)
+                replace, refresh, unchanged = [latest[tweetid] for tweetid in sorted(latest)], [], 0
+            self.unchanged += unchanged
+            for row in replace:
+                self.save_one(row)
+            for row, counts in refresh:
+                self.save_one(row, counts)
+            # tweets that failed on their own won't do any better next time
+            try:
+                ins = self.getcursor()
+                self.save_users(ins, users)
+                self.save_watermarks(ins, watermarks)
+                ins.close()
+                self._commit()
+                self.rows += len(users) + len(watermarks)
+            except Exception as e:
+                sys.stderr.write("ygimport.ygwriter.flush: users and feed since_ids not saved: {}\n".format(e))
+                self._reset()
+
+    def refresh(self, ins, refresh):
+        """
+        save tweets where only the counts changed: their raw json and fingerprint
+        and the counts in features (see ygfeatures.refresh_counts)
+        returns the number of features and users rows changed
+        """
+        ins.executemany(
+            "update tweets set raw=%s,fingerprint=%s where id=%s",
+            [(row[3], row[-2], row[0]) for row, counts in refresh]
+        )
+        return ygfeatures.refresh_counts(ins, dict((row[0], counts) for row, counts in refresh))
+
+    def save_users(self, ins, users):
+        # sorted so concurrent writers lock users rows in the same order
+        if len(users) == 0: return
+        ins.executemany(USERSQL, [users[name] for name in sorted(users)])
+
+    def save_watermarks(self, ins, watermarks):
+        if len(watermarks) == 0: return
+        ins.executemany(FEEDSQL, [(watermarks[user], user) for user in sorted(watermarks)])
+
+    def save_one(self, row, counts=None):
+        """
+        write a single tweet in its own transaction
+        with counts only its counts are refreshed as in flush
+        """
+        try:
+            ins = self.getcursor()
+            if counts is None:
+                ins.execute(TWEETSQL, with_imported(ins, [row])[0])
+                featurerows = 0
+            else:
+                featurerows = self.refresh(ins, [(row, counts)])
+            ins.close()
+            self._commit()
+            if counts is None: self.saved += 1
+            else: self.refreshed += 1
+            self.rows += 1 + featurerows
+            return True
+        except Exception as e:
+            sys.stderr.write("ygimport.ygwriter error: {} for {}\n".format(e, row[0]))
+            self.errors += 1
+            self._reset()
+            return False
+
+    def _reset(self):
+        """
+        roll back after an error and drop the connection if that fails too
+        """
+        try:
+            self._rollback()
+        except Exception:
+            try:
+                self.closedb()
+            except Exception:
+                self.conn = None
+
+    def report(self):
+        elapsed = time.time() - self.started
+        sys.stderr.write(
+            "ygimport: {} tweets saved {} counts only {} unchanged {} rows written {} errors "
+            "{} batches in {:.2f}s ({:.1f} tweets/s) {} db connections\n".format(
+                self.saved, self.refreshed, self.unchanged, self.rows, self.errors,
+                self.batches, elapsed, (self.saved + self.refreshed + self.unchanged) / max(elapsed, 1e-6),
+                self.connections
+            )
+        )
+
+    def __exit__(self, xc_type, exc_value, traceback):
+        try:
+            self.flush()
+            self.report()
+        finally:
+            self.closedb()
+
+def open_log(path):
+    """
+    open a log for reading, names ending in .gz are gunzipped
+    """
+    if path.endswith('.gz'):
+        return io.BufferedReader(gzip.open(path, 'rb'))
+    return open(path, 'r')
+
+def log_format(path):
+    """
+    'ndjson' for one json record per line or 'pretty' for the FEED/END format
+    """
+    with open_log(path) as fh:
+        for line in fh:
+            if line.strip() == '': continue
+            return 'ndjson' if line.startswith('{') else 'pretty'
+    return 'ndjson'
+
+def parse_lines(args):
+    """
+    worker for import_ndjson: parses a chunk of lines from a one record per line log
+    each line is {"feed": screen name, "status": status json}
+    returns ([(feed, row, counts, userrow), ...], number of lines that couldn't be used)
+    """
+    lines, ip, thread = args
+    records = []
+    bad = 0
+    for line in lines:
+        if line.strip() == '': continue
+        try:
+            record = json.loads(line)
+            status = record['status']
+            records.append(
+                (record['feed'],) + parse_status(record['feed'], json.dumps(status), ip, thread, status)
+            )
+        except Exception as e:
+            sys.stderr.write("ygimport.parse_lines error: {} in {}\n".format(e, line[:80]))
+            bad += 1
+    return records, bad
+
+def read_chunks(paths, size=CHUNK_SIZE):
+    """
+    lines of the given logs in lists of up to size lines
+    """
+    for path in paths:
+        with open_log(path) as fh:
+            chunk = []
+            for line in fh:
+                chunk.append(line)
+                if len(chunk) >= size:
+                    yield chunk
+                    chunk = []
+            if len(chunk): yield chunk
+
+def import_ndjson(paths, ip=NOIP, thread=NOTHREAD, workers=1, batchsize=IMPORT_BATCH):
+    """
+    bulk import one record per line logs
+    chunks of lines are parsed by workers processes while this process
+    writes the statuses in batches of batchsize with ygwriter
+    returns the number of statuses read
+    """
+    started = time.time()
+    statuses = 0
+    tasks = ((chunk, ip, thread) for chunk in read_chunks(paths))
+    pool = None
+    if workers > 1:
+        # made before ygwriter connects so the workers don't share its connection
+        pool = multiprocessing.Pool(workers)
+        # only a few chunks are read ahead of the writer
+        window = threading.BoundedSemaphore(workers * 2)
+        def bounded(tasks):
+            for task in tasks:
+                window.acquire()
+                yield task
+        results = pool.imap(parse_lines, bounded(tasks))
+    else:
+        results = itertools.imap(parse_lines, tasks)
+
+    try:
+        with ygwriter(ip, thread, batchsize, newest_first=False) as writer:
+            for records, bad in results:
+                if pool is not None: window.release()
+                writer.errors += bad
+                statuses += len(records) + bad
+                for feed, row, counts, userrow in records:
+                    writer.queue(feed, row, counts, userrow)
+        if pool is not None: pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    elapsed = time.time() - started
+    sys.stderr.write(
+        "ygimport: read {} statuses from {} logs in {:.2f}s ({:.1f} statuses/s) with {} workers\n".format(
+            statuses, len(paths), elapsed, statuses / max(elapsed, 1e-6), max(1, workers)
+        )
+    )
+    return statuses
+
+def import_tweets(log, ip=NOIP, thread=NOTHREAD, batchsize=IMPORT_BATCH):
+    """
+    import the given log file in the older pretty printed format
     it should be filled with raw twitter json interspersed with
     FEED somefeedname
     to identify the source
     Note that the twitter data usuall omits the user to save space
-    log should be compatible with something created by ygnews.py
+    log should be compatible with something created by ygnews.py --format=pretty
     """
     if not os.path.isfile(log):
         print "need a log file to import"
         sys.exit(1)
 
-    with open(log,'r') as lh:
-        started = False
-        for line in lh:
-            feed = re.match(r'^FEED (\S*)', line)
-            if feed is not None:
-                user = feed.group(1)
-                started = False
-                tweet = {'user':user, 'lines':[]}
+    with ygwriter(ip, thread, batchsize, newest_first=False) as writer:
+        with open_log(log) as lh:
+            started = False
+            user = None
+            lines = []
+            for line in lh:
+                if line.startswith('FEED'):
+                    feed = re.match(r'^FEED (\S*)', line)
+                    if feed is not None:
+                        user = feed.group(1)
+                        started = False
 
-            start = re.match(r'^{', line)
-            if start is not None:
-                started = True
-                tweet = {'user':user, 'lines':[]}
+                if line.startswith('{'):
+                    started = True
+                    lines = []
 
-            if started: tweet['lines'].append(line)
+                if started: lines.append(line)
 
-            end = re.match('^}', line)
-            if end is not None:
-                save(tweet)
-                started = False
+                if line.startswith('}') and started:
+                    writer.add(user, "".join(lines))
+                    started = False
 
 if __name__ == '__main__':
-    ip = NOIP
-    thread = NOTHREAD
-    try:
-        log = sys.argv[1]
-    except:
-        print "Usage: %s {tweet log file}" % (sys.argv[0],)
-        sys.exit(1)
-
-    try:
-        ip = sys.argv[2]
-        thread = int(sys.argv[3])
-    except:
-        pass
+    parser = argparse.ArgumentParser(description="import logs written by ygnews.py --log into the tweets table")
+    parser.add_argument('logs',nargs='+',help="log files (.gz files are gunzipped)")
+    parser.add_argument('--ip',default=NOIP,help="import_ip saved with the tweets")
+    parser.add_argument('--thread',type=int,default=NOTHREAD,help="import_thread saved with the tweets")
+    parser.add_argument('--workers',type=int,default=1,help="processes parsing one record per line logs")
+    parser.add_argument('--batch',type=int,default=IMPORT_BATCH,help="statuses written per transaction")
+    args = parser.parse_args()
 
-    conn = ygdb.conn()
-    import_tweets(log, thread, ip)
-    conn.close()
+    for log in args.logs:
+        if not os.path.isfile(log):
+            print "need a log file to import: {}".format(log)
+            sys.exit(1)
 
+    # logs are imported in the order given with runs of one record per line logs imported together
+    for fmt, logs in itertools.groupby(args.logs, log_format):
+        if fmt == 'ndjson':
+            import_ndjson(list(logs), args.ip, args.thread, args.workers, args.batch)
+        else:
+            for log in logs: import_tweets(log, args.ip, args.thread, args.batch)
@@ -0,0 +1,103 @@
+"""
+author: Cal Woodruff, cwoodruf@sfu.ca
+minhash signatures and banded locality sensitive hashing for ygvectors rows
+
+used by ygpairs to find candidate pairs without generating every pair
+of the selected tweets
+
+terms are repeated by their weight before hashing (bigrams count twice)
+so the chance of two rows sharing a minhash value is the weighted jaccard
+|intersection|/|union| - ygsim's jaccard is |intersection|/(|union|-|intersection|)
+so a ygsim epsilon e corresponds to a weighted jaccard of e/(1+e)
+"""
+import random
+
+LSH_BANDS = 64 # number of bands
+LSH_ROWS = 2   # minhash values per band
+PRIME = (1 << 61) - 1
+SEED = 20170205
+
+class yglsh(object):
+    """
+    make minhash signatures for rows of a ygvectors matrix
+    and bucket them by band to find candidate pairs
+    """
+    def __init__(self, bands=LSH_BANDS, rows=LSH_ROWS, seed=SEED):
+        self.bands = bands
+        self.rows = rows
+        rand = random.Random(seed)
+        self.coeffs = [
+            (rand.randint(1, PRIME - 1), rand.randint(0, PRIME - 1))
+            for i in xrange(bands * rows)
+        ]
+
+    @staticmethod
+    def threshold(epsilon):
+        """
+        convert a ygsim epsilon into the equivalent weighted jaccard
+        """
+        return float(epsilon)/(1.0 + float(epsilon))
+
+    def probability(self, jaccard):
+        """
+        chance a pair with the given weighted jaccard becomes a candidate
+        """
+        return 1.0 - (1.0 - float(jaccard) ** self.rows) ** self.bands
+
+    def tokens(self, vectors, i):
+        """
+        expand row i of vectors into weighted tokens
+        """
+        toks = []
+        for k in xrange(vectors.offsets[i], vectors.offsets[i+1]):
+            termid = vectors.terms[k]
+            for copy in xrange(vectors.weights[k]):
+                toks.append((termid << 4) + copy + 1)
+        return toks
+
+    def signature(self, toks):
+        """
+        minhash signature of a list of integer tokens
+        """
+        return [min([(a * x + b) % PRIME for x in toks]) for a, b in self.coeffs]
+
+    def buckets(self, vectors, rows=None):
+        """
+        returns a list of bucket lists of row numbers
+        only buckets with more than one row are returned
+        rows with no terms are never put in a bucket
+        """
+        if rows is None: rows = vectors.live_rows()
+        bands = [{} for b in xrange(self.bands)]
+        r = self.rows
+        for i in rows:
+            toks = self.tokens(vectors, i)
+            if len(toks) == 0: continue
+            sig = self.signature(toks)
+            for b in xrange(self.bands):
+                key = tuple(sig[b*r:(b+1)*r])
+                bands[b].setdefault(key, []).append(i)
+
+        buckets = []
+        for band in bands:
+            for bucket in band.itervalues():
+                if len(bucket) > 1: buckets.append(bucket)
+        return buckets
+
+    def candidates(self, vectors, ids=None):
+        """
+        set of (id1, id2) candidate pairs with id1 < id2 for the given tweet ids
+        """
+        if ids is None:
+            rows = vectors.live_rows()
+        else:
+            rows = [i for i in (vectors.row(tweetid) for tweetid in ids) if i is not None]
+        pairs = set()
+        tweetids = vectors.ids
+        for bucket in self.buckets(vectors, rows):
+            bucket = sorted(set(bucket))
+            for a in xrange(len(bucket)):
+                id1 = tweetids[bucket[a]]
+                for b in xrange(a+1, len(bucket)):
+                    pairs.add((id1, tweetids[bucket[b]]))
+        return pairs
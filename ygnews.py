@@ -8,10 +8,183 @@ from twitter import *
 import re, time, os, sys
 import json
 import argparse
+import threading
+import urlparse
+import gzip
+import calendar
+from multiprocessing.pool import ThreadPool
 from ygsecrets import tw_access_key, tw_access_secret, tw_consumer_key, tw_consumer_secret
-import ygdb
+from ygcursors import ygcursors
 import ygimport
 
+API = 'https://api.twitter.com'
+INFLIGHT = 4          # timelines fetched at once
+RATE_LIMIT = 900      # user_timeline requests allowed per window with user auth
+RATE_WINDOW = 15 * 60 # seconds
+RETRIES = 3           # tries per feed for rate limited or server errors
+BACKOFF = 30          # seconds to wait after a 429 without a reset time
+PAGE_SIZE = 200       # statuses asked for per request once a feed has a since_id
+MAX_PAGES = 16        # twitter only keeps the latest 3200 statuses of a timeline
+REFRESH = 20          # latest statuses of a feed fetched every poll to update their counts
+REFRESH_DAYS = 1      # statuses older than this are not refreshed
+CREATED = '%a %b %d %H:%M:%S +0000 %Y'
+
+class ygbucket(object):
+    """
+    token bucket shared by the threads fetching timelines
+    holds up to limit tokens and refills at limit per window seconds
+
+    once twitter's x-rate-limit headers have been seen they take over:
+    only the remaining requests (less those still in flight) are sent
+    and the bucket is refilled when twitter's window resets
+    """
+    def __init__(self, limit=RATE_LIMIT, window=RATE_WINDOW):
+        self.capacity = float(max(1, limit))
+        self.rate = self.capacity / max(1, window)
+        self.window = window
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.reset = 0
+        self.pending = 0
+        self.waited = 0.0
+        self.limited = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        block until another request can be sent
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                if self.reset and now >= self.reset:
+                    self.reset = 0
+                    self.tokens = self.capacity
+                if not self.reset:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.pending += 1
+                    return
+                if self.reset: wait = self.reset - now
+                else: wait = (1 - self.tokens) / self.rate
+                self.waited += wait
+            time.sleep(wait)
+
+    def follow(self, headers, limited=False):
+        """
+        call once for every take with the response headers (or None)
+        limited is True for a 429 response
+        """
+        try:
+            limit = int(headers.get('x-rate-limit-limit'))
+            remaining = int(headers.get('x-rate-limit-remaining'))
+            reset = float(headers.get('x-rate-limit-reset'))
+        except (AttributeError, TypeError, ValueError):
+            limit = remaining = reset = None
+
+        with self.lock:
+            self.pending -= 1
+            now = time.time()
+            if limited:
+                self.limited += 1
+                remaining = 0
+                if reset is None: reset = now + BACKOFF
+                # clocks differ a little so wait a moment past a reset time already passed
+                elif reset <= now: reset = now + 1
+            # headers from an earlier window are out of date
+            if remaining is None or reset <= now: return
+            if limit: self.capacity = float(limit)
+            self.reset = max(self.reset, min(reset, now + self.window))
+            self.tokens = min(self.tokens, max(0, remaining - self.pending))
+
+class yglogfile(object):
+    """
+    log of timelines for ygimport.py, by default one json record per line:
+        {"feed":"nytimes","status":{...}}
+    or with fmt='pretty' the original indented json between FEED and END lines
+
+    - is stdout and names ending in .gz are gzip compressed
+    the log is moved aside and a new one started when it gets bigger than
+    rotate_size bytes or a new rotate_interval seconds period starts
+    (e.g. tweets.ndjson.gz becomes tweets.20170205_120000.ndjson.gz)
+    """
+    def __init__(self, path, fmt='ndjson', rotate_size=0, rotate_interval=0):
+        self.path = path
+        self.fmt = fmt
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.fh = None
+
+    def open(self):
+        if self.path == '-':
+            self.fh = sys.stdout
+            return
+        if self.due(): self.rotate()
+        if self.path.endswith('.gz'):
+            self.fh = gzip.open(self.path, 'ab')
+        else:
+            self.fh = open(self.path, 'a')
+
+    def close(self):
+        if self.fh is not None and self.fh is not sys.stdout:
+            self.fh.close()
+        self.fh = None
+
+    def due(self):
+        """
+        True if the log on disk should be rotated before writing more
+        """
+        if not os.path.isfile(self.path): return False
+        if self.rotate_size > 0 and os.path.getsize(self.path) >= self.rotate_size: return True
+        if self.rotate_interval > 0:
+            started = int(os.path.getmtime(self.path) // self.rotate_interval)
+            return started != int(time.time() // self.rotate_interval)
+        return False
+
+    def rotate(self):
+        name = self.path
+        gz = ''
+        if name.endswith('.gz'):
+            name = name[:-3]
+            gz = '.gz'
+        base, ext = os.path.splitext(name)
+        stamp = time.strftime('%Y%m%d_%H%M%S')
+        rotated = "{}.{}{}{}".format(base, stamp, ext, gz)
+        n = 0
+        while os.path.exists(rotated):
+            n += 1
+            rotated = "{}.{}-{}{}{}".format(base, stamp, n, ext, gz)
+        os.rename(self.path, rotated)
+
+    def write(self, user, results):
+        """
+        write one timeline
+        """
+        if self.fh is None: self.open()
+        if self.fmt == 'pretty':
+            self.fh.write("\nFEED {}\n".format(user))
+            for status in results:
+                self.fh.write(json.dumps(status, indent=2))
+                self.fh.write("\n")
+            self.fh.write("\nEND {}\n".format(user))
+        else:
+            for status in results:
+                self.fh.write(json.dumps({'feed': user, 'status': status}, separators=(',', ':')))
+                self.fh.write("\n")
+
+        if self.fh is not sys.stdout and self.rotate_size > 0:
+            self.fh.flush()
+            if os.path.getsize(self.path) >= self.rotate_size:
+                self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, xc_type, exc_value, traceback):
+        self.close()
+
 class ygnews(object):
     """
     this class handles connecting to twitter and receiving tweets
@@ -21,56 +194,221 @@ class ygnews(object):
     nodes are identified by their ip and a numeric thread id
     this is used to get feeds for this particular node from the db
 
-    the application itself is currently single threaded
-    this seems to work with the given number of feeds
-    and logging to file
+    timelines are fetched by a small pool of threads with a shared
+    ygbucket keeping them inside twitter's rate limit
+    all the writing to the db or log is done by the main thread
+    as each timeline arrives so it overlaps with the other fetches
+
+    only statuses newer than the last one saved for each feed are fetched:
+    the since_id is kept in the feeds table (or a json file when logging)
+    if there are more new statuses than fit in one page the timeline is
+    paged backwards with max_id until the gap is filled
 
-    when saving to the db it would be reasonable to parallelize
-    each individual application instance
+    as retweet and favorite counts keep changing after a status is first seen
+    the first request for a feed asks for its latest refresh statuses without
+    since_id and those already saved (if under REFRESH_DAYS old) are passed
+    on again so ygimport can update their counts
     """
-    def __init__(self, ip, thread, log=None, feedlist=None):
+    def __init__(self, ip, thread, log=None, feedlist=None, batchsize=ygimport.BATCH_SIZE,
+            inflight=INFLIGHT, limit=RATE_LIMIT, window=RATE_WINDOW, api=API,
+            sincefile=None, full=False, refresh=REFRESH, logformat='ndjson', rotate_size=0, rotate_interval=0):
         """
         creates twitter helper object
         and database connection
         optionally define a log file ('-' is stdout)
         optionally define an input list of feeds
+        batchsize is the number of statuses buffered before writing to the db
+        inflight is the most timelines fetched at once
+        limit and window are the requests allowed per window seconds
+        api is the base url of the twitter api (e.g. a ygstub.py server)
+        sincefile is a json file of since_ids for when logging to file
+        full ignores the since_ids and fetches the latest page of every feed
+        refresh is the number of latest statuses fetched again for their counts (0 for none)
+        logformat, rotate_size and rotate_interval are passed on to yglogfile
         """
+        url = urlparse.urlparse(api)
         self.twitter = Twitter( 
             auth = OAuth(
                 tw_access_key,
                 tw_access_secret,
                 tw_consumer_key,
                 tw_consumer_secret
-            )
+            ),
+            domain = url.netloc,
+            secure = url.scheme == 'https'
         )
+        self.inflight = max(1, inflight)
+        self.bucket = ygbucket(limit, window)
         self.log = log
         self.feedlist = feedlist 
         self.ip = ip
         self.thread = thread 
+        self.batchsize = batchsize
+        self.sincefile = sincefile
+        self.full = full
+        self.refresh = max(0, refresh)
+        self.logformat = logformat
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.since = {}
 
     def poll(self, feedlist=None):
         """
         rotate through list of feeds and grab data from them
-        reads feeds sequentially 
+        when saving to the db one connection is used for the whole poll
+        """
+        if self.log is not None:
+            self.since = self._get_since_from_file()
+            with self._logfile() as log:
+                self._poll(
+                    self._get_feeds(feedlist),
+                    lambda user, results: self._log_status_to_file(user, results, log)
+                )
+            self._save_since_to_file()
+        else:
+            with ygimport.ygwriter(self.ip, self.thread, self.batchsize) as writer:
+                self.since = self._get_since_from_db(writer)
+                self._poll(
+                    self._get_feeds(feedlist, writer),
+                    lambda user, results: self._log_status_to_db(user, writer, results)
+                )
+
+    def _poll(self, feeds, save):
+        """
+        fetch the timelines in pool threads and call save(user, results)
+        in this thread for each one as soon as it arrives
+        """
+        started = time.time()
+        fetched = failed = statuses = refreshed = requests = size = gaps = 0
+        pool = ThreadPool(self.inflight)
+        try:
+            for user, results, error, info in pool.imap_unordered(self._get_timeline, feeds):
+                requests += info['requests']
+                size += info['bytes']
+                if error is not None:
+                    sys.stderr.write("ygnews: {} failed: {}\n".format(user, error))
+                    failed += 1
+                    continue
+                save(user, results)
+                if len(results):
+                    self.since[user] = max(self.since.get(user, 0), max(s['id'] for s in results))
+                if info['gap']:
+                    sys.stderr.write("ygnews: {} has more new statuses than could be fetched\n".format(user))
+                    gaps += 1
+                fetched += 1
+                statuses += len(results)
+                refreshed += info['refreshed']
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        elapsed = time.time() - started
+        sys.stderr.write(
+            "ygnews: {} feeds {} statuses ({} refreshed) {} failed {} gaps in {:.2f}s ({:.1f} feeds/s) "
+            "{} requests {:.1f}KB fetched "
+            "{} in flight {:.2f}s waiting for the rate limit {} rate limited\n".format(
+                fetched, statuses, refreshed, failed, gaps, elapsed, fetched / max(elapsed, 1e-6),
+                requests, size / 1024.0,
+                self.inflight, self.bucket.waited, self.bucket.limited
+            )
+        )
+
+    def _get_timeline(self, user):
+        """
+        fetch the statuses of one timeline newer than its since_id, runs in a pool thread
+        along with recent ones among its latest self.refresh statuses to update their counts
+        returns (user, statuses, error, info) where error is None if it worked
+        and info has the number of requests, bytes fetched, statuses refreshed
+        and whether a gap was left
+        """
+        info = {'requests': 0, 'bytes': 0, 'refreshed': 0, 'gap': False}
+        since = None if self.full else self.since.get(user)
+        params = {'screen_name': user}
+        if since is not None:
+            # the refresh page usually reaches back past since_id so one request does both
+            if self.refresh: params['count'] = self.refresh
+            else: params.update(since_id=since, count=PAGE_SIZE)
+
+        statuses = []
+        try:
+            while True:
+                page, size = self._user_timeline(params)
+                info['requests'] += 1
+                info['bytes'] += size
+                statuses.extend(page)
+                # a full page may not reach back to since_id
+                if since is None or len(page) < params['count']: break
+                oldest = min(s['id'] for s in page)
+                if oldest <= since: break
+                params.update(since_id=since, count=PAGE_SIZE, max_id=oldest - 1)
+                if params['max_id'] <= since: break
+                if info['requests'] >= MAX_PAGES:
+                    info['gap'] = True
+                    break
+        except TwitterHTTPError as e:
+            return user, None, "{} {}".format(e.e.code, e.response_data), info
+        except Exception as e:
+            return user, None, e, info
+        if since is not None and self.refresh:
+            statuses = self._recent(statuses, since)
+            info['refreshed'] = sum(1 for s in statuses if s['id'] <= since)
+        return user, statuses, None, info
+
+    def _recent(self, statuses, since):
+        """
+        statuses newer than since plus those up to REFRESH_DAYS old
+        so tweets that have been purged are not saved again
+        """
+        cutoff = time.time() - REFRESH_DAYS * 86400
+        recent = []
+        for status in statuses:
+            if status['id'] <= since:
+                try:
+                    if calendar.timegm(time.strptime(status['created_at'], CREATED)) < cutoff: continue
+                except (KeyError, TypeError, ValueError):
+                    continue
+            recent.append(status)
+        return recent
+
+    def _user_timeline(self, params):
+        """
+        one user_timeline request retried if rate limited or on server errors
+        returns the statuses and the size of the response in bytes
+        """
+        for attempt in xrange(RETRIES):
+            self.bucket.take()
+            try:
+                results = self.twitter.statuses.user_timeline(**params)
+            except TwitterHTTPError as e:
+                self.bucket.follow(e.e.headers, e.e.code == 429)
+                if (e.e.code == 429 or e.e.code >= 500) and attempt < RETRIES - 1: continue
+                raise
+            except Exception:
+                self.bucket.follow(None)
+                raise
+            headers = getattr(results, 'headers', None)
+            self.bucket.follow(headers)
+            try:
+                size = int(headers.get('content-length'))
+            except (AttributeError, TypeError, ValueError):
+                size = len(json.dumps(results))
+            return results, size
+
+    def _get_feeds(self, feedlist=None, db=None):
+        """
+        list of screen names from the feedlist file or the db
         """
-        feeds = []
         if feedlist is None:
             feedlist = self.feedlist
 
         if feedlist is None:
-            feeds = self._get_feeds_from_db()
+            return self._get_feeds_from_db(db)
         elif feedlist == '-' or os.path.isfile(feedlist):
-            feeds = self._get_feeds_from_file(feedlist)
+            return self._get_feeds_from_file(feedlist)
         else:
             raise(Exception("invalid feedlist identifier - is it a file?"))
 
-        if self.log is not None:
-            for user in feeds:
-                self._log_status_to_file(user)
-        else:
-            for user in feeds:
-                self._log_status_to_db(user)
-
     def _get_feeds_from_file(self, feedlist):
         """
         reads feed urls from a file one per line
@@ -99,14 +437,18 @@ class ygnews(object):
 
         return feeds
 
-    def _get_feeds_from_db(self):
+    def _get_feeds_from_db(self, db=None):
         """
         uses ygdb to get a list of feeds
         for this specific instance
+        db is an optional ygcursors object to share its connection
         """
+        if db is None:
+            with ygcursors() as db:
+                return self._get_feeds_from_db(db)
+
         feeds = []
-        conn = ygdb.conn()
-        get = conn.cursor()
+        get = db.getcursor()
         get.execute(
             "select user from feeds where ip=%s and thread=%s", 
             (self.ip, self.thread)
@@ -114,35 +456,69 @@ class ygnews(object):
         for row in get:
             feeds.append(row[0])
         get.close()
-        conn.close()
         return feeds
 
-    def _log_status_to_db(self, user):
+    def _get_since_from_db(self, db):
+        """
+        since_id of each feed in the feeds table that has one
+        """
+        since = {}
+        if self.full: return since
+        get = db.getcursor()
+        get.execute("select user, since_id from feeds where since_id is not null")
+        for user, since_id in get:
+            since[user] = int(since_id)
+        get.close()
+        return since
+
+    def _get_since_from_file(self):
+        """
+        since_ids saved by a previous run logging to file
+        """
+        if self.full or self.sincefile is None or not os.path.isfile(self.sincefile):
+            return {}
+        with open(self.sincefile) as fh:
+            return dict((user, int(since_id)) for user, since_id in json.load(fh).iteritems())
+
+    def _save_since_to_file(self):
+        if self.sincefile is None: return
+        tmp = self.sincefile + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(self.since, fh, indent=1, sort_keys=True)
+        os.rename(tmp, self.sincefile)
+
+    def _log_status_to_db(self, user, writer=None, results=None):
         """
-        uses ygimport to save the status directly to the db
+        uses a ygimport.ygwriter to save the statuses directly to the db
+        the writer buffers them so several timelines go in each batch
+        fetches the timeline if results aren't given
         """
-        results = self.twitter.statuses.user_timeline(screen_name = user)
-        tweet = {'user': user}
+        if writer is None:
+            with ygimport.ygwriter(self.ip, self.thread, self.batchsize) as writer:
+                return self._log_status_to_db(user, writer, results)
+
+        if results is None:
+            results = self.twitter.statuses.user_timeline(screen_name = user)
         for status in results:
-            tweet['lines'] = json.dumps(status)
-            ygimport.save(tweet, self.ip, self.thread)
+            writer.add(user, json.dumps(status))
 
-    def _log_status_to_file(self, user):
+    def _logfile(self):
+        return yglogfile(self.log, self.logformat, self.rotate_size, self.rotate_interval)
+
+    def _log_status_to_file(self, user, results=None, log=None):
         """
         gets timeline status for a given user
         saves the timeline to a file
         use ygimport.py to import the data from the log to the db
+        fetches the timeline if results aren't given
+        log is an open yglogfile to write to
         """
+        if log is None:
+            with self._logfile() as log:
+                return self._log_status_to_file(user, results, log)
 
-        log = None
-        if self.log == '-': 
-            log = sys.stdout
-        elif self.log is not None:
-            log = open(self.log,'a')
-
-        log.write("\nFEED {}\n".format(user))
-
-        results = self.twitter.statuses.user_timeline(screen_name = user)
+        if results is None:
+            results = self.twitter.statuses.user_timeline(screen_name = user)
         usersaved = False
         for status in results:
             # to reduce space only save user part of status once per run
@@ -151,15 +527,7 @@ class ygnews(object):
                 usersaved = True
             except:
                 pass
-            log.write(json.dumps(status, indent=2))
-            log.write("\n")
-
-        log.write("\nEND {}\n".format(user))
-
-        if self.log != '-' and log is not None:
-            log.close()
-
-        time.sleep(2)
+        log.write(user, results)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -171,12 +539,34 @@ if __name__ == '__main__':
     parser.add_argument('--thread',required=True,type=int,help="thread number for this node")
     parser.add_argument('--feeds',help='optional file name containing feeds one per line (- for stdin)')
     parser.add_argument('--log',help='optional name of log file to save data to (- for stdout)')
+    parser.add_argument('--batch',type=int,default=ygimport.BATCH_SIZE,help="statuses buffered per db write")
+    parser.add_argument('--inflight',type=int,default=INFLIGHT,help="timelines fetched at once")
+    parser.add_argument('--limit',type=int,default=RATE_LIMIT,help="requests allowed per rate limit window")
+    parser.add_argument('--window',type=int,default=RATE_WINDOW,help="rate limit window in seconds")
+    parser.add_argument('--api',default=API,help="twitter api base url (e.g. http://localhost:8080 for ygstub.py)")
+    parser.add_argument('--since',help="json file of since_ids per feed to use with --log")
+    parser.add_argument('--full',action='store_true',help="ignore since_ids and fetch the latest statuses of every feed")
+    parser.add_argument('--refresh',type=int,default=REFRESH,help="latest statuses per feed fetched again to update their counts (0 for none)")
+    parser.add_argument('--format',default='ndjson',choices=('ndjson','pretty'),help="--log format: one json record per line or the older indented json")
+    parser.add_argument('--rotate-size',type=float,default=0,help="start a new --log after this many MB")
+    parser.add_argument('--rotate-interval',type=int,default=0,help="start a new --log every this many seconds (e.g. 86400 for daily)")
     args = parser.parse_args()
     news = ygnews(
         args.ip,
         args.thread,
         log=args.log,
-        feedlist=args.feeds
+        feedlist=args.feeds,
+        batchsize=args.batch,
+        inflight=args.inflight,
+        limit=args.limit,
+        window=args.window,
+        api=args.api,
+        sincefile=args.since,
+        full=args.full,
+        refresh=args.refresh,
+        logformat=args.format,
+        rotate_size=int(args.rotate_size * 1024 * 1024),
+        rotate_interval=args.rotate_interval
     )
     news.poll()
 
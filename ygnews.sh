@@ -4,6 +4,13 @@
 YGIP=localhost
 YGTHREAD=1
 
+# latest statuses of each feed fetched again every poll to keep their
+# retweet/favorite counts current (new statuses come from the feed's since_id)
+YGREFRESH=20
+
+# processes used to extract features from new tweets
+YGWORKERS=1
+
 # parameters needed for dbscan - arrived at by observation
 YGEPSILON=0.28
 YGMINCLUSTER=3
@@ -18,10 +25,11 @@ then
 fi
 
 # grabs news from the news feeds
-time ./ygnews.py --ip=$YGIP --thread=$YGTHREAD
+time ./ygnews.py --ip=$YGIP --thread=$YGTHREAD --refresh=$YGREFRESH
 
 # extracts some useful features from the news stories
-time ./ygfeatures.py 
+# with more than one worker the new tweets are split between processes by id
+time ./ygfeatures.py --workers=$YGWORKERS
 
 if [ -f ygsim.pid ]
 then
@@ -34,15 +42,17 @@ else
     # calculates similarity between pairs of tweets and saves any non-zero results
     # as this is the most time consuming part of processing it is possible to farm 
     # this task out to multiple nodes by running multiple instances of the script
-    # however, in practice there are deadlock problems with the db - at least on my 
-    # crappy system
-    time ./ygsim.py --ip=$YGIP --thread=$YGTHREAD --epsilon=$YGEPSILON;
+    # each instance claims its batches with a single update and a lease (--lease)
+    # so batches held by an instance that dies are picked up by the others
+    time ./ygsim.py --ip=$YGIP --thread=$YGTHREAD --epsilon=$YGEPSILON --snapshot=./ygsim.snapshot;
     /bin/rm ygsim.pid) &
 fi
 
-# uses similarity results from ygsim to generate clusters using DBSCAN saving results to a file
-time ./ygcluster.py --epsilon=$YGEPSILON --minsz=$YGMINCLUSTER --daysback=1 --interesting=0.0 > ./archives/ygnews-`/bin/date +%Y%m%d_%H%M%S`.txt
-time ./ygcluster.py --epsilon=$YGEPSILON --minsz=$YGMINCLUSTER --daysback=1 --tweets > ./archives/ygnews-tweets-`/bin/date +%Y%m%d_%H%M%S`.txt
+# uses similarity results from ygsim to generate clusters using DBSCAN saving results to files
+# one run writes both archives and the clusters are reused if similarity has not changed
+YGSTAMP=`/bin/date +%Y%m%d_%H%M%S`
+time ./ygcluster.py --epsilon=$YGEPSILON --minsz=$YGMINCLUSTER --daysback=1 --snapshot=./ygcluster.snapshot \
+    --interesting=0.0 --out tweets=./archives/ygnews-tweets-$YGSTAMP.txt > ./archives/ygnews-$YGSTAMP.txt
 
 echo FINISHED $YGIP $YGTHREAD `/bin/date`
 
@@ -9,25 +9,75 @@ the way this works is:
 
 - first select a short list of tweets we are interested in based on the popularity of the tweet
 - generate an upper triangular matrix of pairs to check saving to the pairs table
+  (or with --mode=lsh only the pairs minhash/lsh thinks are likely to be similar)
 - nodes can assign themselves a group of pairs to check - there is no manager process
+  claims are leased so work held by a node that died is eventually handed out again
+- alternatively (--mode=cycle) only the sorted list of ids is saved as a cycle and nodes
+  claim ranges of the upper triangle which they turn into pairs themselves
 
 """
 from ygcursors import ygcursors
+from ygvectors import ygvectors
+from yglsh import yglsh, LSH_BANDS, LSH_ROWS
 import yglog
 import sys
 import traceback
 import re
 import argparse
 import math
+import json
+import uuid
 
 DEF_THRESHOLD = 0.5 # should be 0.0 to < 1.0
 SAVE_THRESHOLD = 10000 # how many pairs to save at a time
 MAX_TWEETS = 2000 # total maximum number of tweets to select from all sources
 PAIR_COUNT = 10000 # default number of pairs to return when a node requests a sample
+LEASE = 600 # seconds claimed pairs are held before they can be handed out again
+DEF_EPSILON = 0.28 # ygsim epsilon used to tune and check lsh candidates
+
+ALL_PAIRS = 'all' # every pair of selected tweets
+LSH_PAIRS = 'lsh' # only pairs likely to be similar plus pairs sharing links
+CYCLE_PAIRS = 'cycle' # every pair of selected tweets as ranges of a cycle (see add_cycle)
 
 def usage(parser):
     parser.print_usage()
 
+def triangle_size(n):
+    """
+    number of pairs in the upper triangle of n ids
+    """
+    return n * (n - 1) / 2
+
+def triangle_row(k, n):
+    """
+    turns a triangle index k into its (i, j) position for n ids
+    pairs are numbered row by row: (0,1) (0,2) ... (0,n-1) (1,2) ...
+    """
+    def rowstart(i):
+        return i * (2 * n - i - 1) / 2
+    b = 2 * n - 1
+    i = int((b - math.sqrt(b * b - 8 * k)) / 2)
+    # fix up any floating point error in the square root
+    while i > 0 and rowstart(i) > k: i -= 1
+    while rowstart(i + 1) <= k: i += 1
+    return i, k - rowstart(i) + i + 1
+
+def triangle_pairs(ids, start, end):
+    """
+    the pairs of ids for triangle indexes start <= k < end
+    """
+    n = len(ids)
+    pairs = []
+    if start >= end: return pairs
+    i, j = triangle_row(start, n)
+    for k in xrange(start, end):
+        pairs.append((ids[i], ids[j]))
+        j += 1
+        if j >= n:
+            i += 1
+            j = i + 1
+    return pairs
+
 class ygpairs(ygcursors):
     """
     class to set up and maintain a schedule of work
@@ -39,7 +89,8 @@ class ygpairs(ygcursors):
     this is the self.threshold property of the class
     """
 
-    def __init__(self, threshold=None, maxtweets=MAX_TWEETS, save=SAVE_THRESHOLD):
+    def __init__(self, threshold=None, maxtweets=MAX_TWEETS, save=SAVE_THRESHOLD,
+            epsilon=DEF_EPSILON, bands=LSH_BANDS, rows=LSH_ROWS):
         """
         by default create shared db connection
         set thresholds for accepting tweets
@@ -55,6 +106,8 @@ class ygpairs(ygcursors):
 
         maxtweets limits the number of tweets we'll use for comparison
         we pick the top N for each user up to a proportion based on their over threshold tweets
+
+        epsilon, bands and rows are only used when generating pairs with lsh
         """
         super(ygpairs, self).__init__()
         if threshold is None:
@@ -64,40 +117,219 @@ class ygpairs(ygcursors):
 
         self.maxtweets = maxtweets
         self.save_threshold = save
+        self.epsilon = epsilon
+        self.bands = bands
+        self.rows = rows
 
     @staticmethod
     def get_pairs(ip,thread,paircount=None):
         """
         class method that claims a group of pairs for a specific ip,thread
         returns the list of pairs to process
+        the claim never expires - use claim_pairs to get a lease
+        """
+        claim, pairs = ygpairs.claim_pairs(ip, thread, paircount, lease=None)
+        return pairs
+
+    @staticmethod
+    def claim_pairs(ip,thread,paircount=None,lease=LEASE):
+        """
+        class method that claims a group of pairs for a specific ip,thread
+
+        the claim is done with single update statements so many workers
+        can ask for pairs at the same time without stepping on each other
+        pairs whose lease ran out before complete_pairs was called
+        are handed out again before any new pairs
+
+        lease is the number of seconds to hold the pairs (None for no expiry)
+        returns a claim id and the list of pairs to process
         """
         if paircount is None: limit = PAIR_COUNT
         else: limit = int(paircount)
 
-        if limit <= 0: return []
-        yglog.vprint("get_pairs getting",limit,"pairs for",ip,thread)
+        if limit <= 0: return None, []
+        yglog.vprint("claim_pairs getting",limit,"pairs for",ip,thread)
+
+        claim = uuid.uuid4().hex
+        if lease is None: expires = "null"
+        else: expires = "now() + interval {} second".format(int(lease))
 
         conn = ygcursors()
+        upd = conn.getcursor()
+        upd.execute(
+            "update pairs set ip=%s,thread=%s,processed=now(),claim=%s,expires={} "
+            "where expires < now() order by expires limit %s".format(expires),
+            (ip, thread, claim, limit)
+        )
+        reissued = upd.rowcount
+        if reissued > 0:
+            yglog.vprint("claim_pairs reissued",reissued,"expired pairs")
+        if reissued < limit:
+            upd.execute(
+                "update pairs set ip=%s,thread=%s,processed=now(),claim=%s,expires={} "
+                "where ip is null and processed is null "
+                "order by id1,id2 limit %s".format(expires),
+                (ip, thread, claim, limit - reissued)
+            )
+        conn._commit()
+
         get = conn.getcursor()
         get.execute(
-            "select id1,id2 from pairs where ip is null and processed is null "
-            "order by id1,id2 limit %s",
-            (limit,)
+            "select id1,id2 from pairs where claim=%s order by id1,id2",
+            (claim,)
         )
-        upd = conn.getcursor()
         pairs = []
         for row in get:
             id1, id2 = row
+            pairs.append((id1,id2))
+        get.close()
+        upd.close()
+        conn.closedb()
+        return claim, pairs
+
+    @staticmethod
+    def complete_pairs(claim):
+        """
+        class method that ends the lease on a group of claimed pairs
+        once their similarities have been saved
+        """
+        if claim is None: return
+        conn = ygcursors()
+        upd = conn.getcursor()
+        upd.execute("update pairs set expires=null where claim=%s", (claim,))
+        upd.close()
+        conn._commit()
+        conn.closedb()
+
+    def add_cycle(self, ids, rangesz=PAIR_COUNT):
+        """
+        saves the sorted list of selected ids as a new cycle
+        instead of writing every pair to the pairs table
+        work is split into ranges of rangesz triangle indexes
+        that workers claim with claim_range
+        returns the cycle id
+        """
+        paircount = triangle_size(len(ids))
+        ins = self.getcursor()
+        ins.execute(
+            "insert into cycles (added,ids,idcount,paircount) values (now(),%s,%s,%s)",
+            (json.dumps(ids), len(ids), paircount)
+        )
+        cycle = ins.lastrowid
+        ranges = [
+            (cycle, start, min(start + rangesz, paircount))
+            for start in xrange(0, paircount, rangesz)
+        ]
+        ins.executemany(
+            "insert into cycle_ranges (cycle,start,end) values (%s,%s,%s)",
+            ranges
+        )
+        ins.close()
+        self._commit()
+        yglog.vprint("cycle",cycle,"has",len(ids),"ids",paircount,"pairs",len(ranges),"ranges")
+        return cycle
+
+    @staticmethod
+    def get_cycle_ids(cycle):
+        """
+        class method that returns the ordered list of ids for a cycle
+        """
+        conn = ygcursors()
+        get = conn.getcursor()
+        get.execute("select ids from cycles where cycle=%s", (cycle,))
+        row = get.fetchone()
+        get.close()
+        conn.closedb()
+        if row is None: return None
+        return json.loads(row[0])
+
+    @staticmethod
+    def claim_range(ip,thread,lease=LEASE):
+        """
+        class method that claims one range of a cycle for a specific ip,thread
+        works the same way as claim_pairs: expired ranges are handed out first
+        returns a claim id, the cycle and the start and end triangle indexes
+        or None if there is nothing left to do
+        """
+        claim = uuid.uuid4().hex
+        if lease is None: expires = "null"
+        else: expires = "now() + interval {} second".format(int(lease))
+
+        conn = ygcursors()
+        upd = conn.getcursor()
+        upd.execute(
+            "update cycle_ranges set ip=%s,thread=%s,processed=now(),claim=%s,expires={} "
+            "where expires < now() order by expires limit 1".format(expires),
+            (ip, thread, claim)
+        )
+        if upd.rowcount == 0:
             upd.execute(
-                "update pairs set ip=%s,thread=%s,processed=now() where id1=%s and id2=%s",
-                (ip, thread, id1, id2)
+                "update cycle_ranges set ip=%s,thread=%s,processed=now(),claim=%s,expires={} "
+                "where ip is null order by cycle,start limit 1".format(expires),
+                (ip, thread, claim)
             )
-            pairs.append((id1,id2))
+        conn._commit()
+        upd.execute(
+            "select cycle,start,end from cycle_ranges where claim=%s",
+            (claim,)
+        )
+        row = upd.fetchone()
+        upd.close()
+        conn.closedb()
+        if row is None: return None
+        cycle, start, end = row
+        yglog.vprint("claim_range got cycle",cycle,"range",start,end,"for",ip,thread)
+        return claim, cycle, start, end
+
+    @staticmethod
+    def complete_range(claim):
+        """
+        class method that marks a claimed range as done
+        """
+        if claim is None: return
+        conn = ygcursors()
+        upd = conn.getcursor()
+        upd.execute(
+            "update cycle_ranges set expires=null,done=now() where claim=%s",
+            (claim,)
+        )
         upd.close()
         conn._commit()
         conn.closedb()
-        return pairs
-            
+
+    def cycle_progress(self, cycle=None):
+        """
+        how far along each cycle is (or just the given cycle)
+        returns a list of dicts ordered by cycle
+        """
+        get = self.getcursor()
+        query = (
+            "select a.cycle,a.added,a.idcount,a.paircount,count(*),"
+                "sum(b.ip is not null),sum(b.done is not null),"
+                "sum(if(b.done is not null,b.end-b.start,0)) "
+            "from cycles a join cycle_ranges b on a.cycle=b.cycle "
+        )
+        if cycle is None:
+            get.execute(query + "group by a.cycle order by a.cycle")
+        else:
+            get.execute(query + "where a.cycle=%s group by a.cycle", (cycle,))
+        progress = []
+        for row in get:
+            cycle, added, idcount, paircount, ranges, claimed, done, pairsdone = row
+            progress.append({
+                'cycle': cycle,
+                'added': '{:%Y-%m-%d %H:%M:%S}'.format(added),
+                'ids': int(idcount),
+                'pairs': int(paircount),
+                'ranges': int(ranges),
+                'claimed': int(claimed),
+                'done': int(done),
+                'pairsdone': int(pairsdone),
+                'complete': int(done) == int(ranges),
+            })
+        get.close()
+        return progress
+
     def cleanup_pairs(self, cutoff=None):
         """
         removes pairs that have been processed
@@ -145,11 +377,150 @@ class ygpairs(ygcursors):
         ins.close()
         self._commit()
         
-    def add_pairs(self, th=None, mt=0):
+    def select_tweets(self, threshold, maxtweets):
+        """
+        picks the top N tweets per user based on the combined_count threshold
+        flags them in features.selected and returns their ids in ascending order
+        """
+        # want to get the top N tweets per user
+        get = self.getcursor()
+        yglog.vprint("threshold",threshold)
+        get.execute(
+            "select user,count(*) from user_features "
+            "where combined_count/combined_av > %s "
+            "group by user", (threshold,)
+        )
+        alltweets = 0
+        tweetcounts = {}
+        for row in get:
+            user, tweetcount = row
+            yglog.vprint(user, tweetcount)
+            tweetcounts[user] = int(tweetcount)
+            alltweets += int(tweetcount)
+        get.close()
+
+        ids = []
+        upd = self.getcursor()
+        upd.execute("update features set selected=null where selected is not null")
+        upd.close()
+        self._commit()
+        for user, tweetcount in tweetcounts.iteritems():
+            limit = math.ceil(float(maxtweets) * float(tweetcount)/float(alltweets))
+            yglog.vprint("user",user,"limit",limit,"out of",maxtweets,"all",alltweets,"count",tweetcount)
+            getids = self.getcursor()
+            getids.execute(
+                "select id from features where user=%s "
+                "order by combined_count desc limit %s",
+                (user, limit)
+            )
+            upd = self.getcursor()
+            for row in getids:
+                ids.append(int(row[0]))
+                upd.execute("update features set selected=date(now()) where id=%s", (row[0],))
+            getids.close()
+            self._commit()
+            upd.close()
+
+        # always save ids pairs in ascending order
+        ids.sort()
+        return ids
+
+    def all_pairs(self, ids):
+        """
+        generates the full upper triangle of pairs for the sorted list of ids
+        """
+        for i in xrange(len(ids)):
+            for j in xrange(i+1,len(ids)):
+                yield (ids[i], ids[j])
+
+    def load_vectors(self, ids):
+        """
+        loads words for the given ids from features as a ygvectors matrix
+        """
+        selected = set(ids)
+        get = self.getcursor()
+        get.execute("select id,words from features where selected is not null order by id")
+        vectors = ygvectors()
+        for row in get:
+            tweetid, wordjson = row
+            if tweetid in selected:
+                vectors.add(tweetid, json.loads(wordjson))
+        get.close()
+        return vectors
+
+    def link_pairs(self, ids):
+        """
+        set of (id1, id2) pairs of the given ids that share at least one link
+        """
+        selected = set(ids)
+        get = self.getcursor()
+        get.execute(
+            "select a.id,a.link from links a join features b on a.id=b.id "
+            "where b.selected is not null"
+        )
+        common = {}
+        for row in get:
+            tweetid, link = row
+            if tweetid in selected:
+                common.setdefault(link, set()).add(tweetid)
+        get.close()
+
+        pairs = set()
+        for tweetids in common.itervalues():
+            tweetids = sorted(tweetids)
+            for i in xrange(len(tweetids)):
+                for j in xrange(i+1,len(tweetids)):
+                    pairs.add((tweetids[i], tweetids[j]))
+        return pairs
+
+    def lsh_pairs(self, ids, recall=False):
+        """
+        candidate pairs from minhash/lsh on features.words plus any pairs sharing a link
+        optionally measures recall against the exhaustive pairs for self.epsilon
+        """
+        vectors = self.load_vectors(ids)
+        lsh = yglsh(bands=self.bands, rows=self.rows)
+        yglog.vprint("lsh",lsh.bands,"bands",lsh.rows,"rows",
+            "p(epsilon)",lsh.probability(yglsh.threshold(self.epsilon)))
+        linked = self.link_pairs(ids)
+        pairs = lsh.candidates(vectors, ids) | linked
+        if recall:
+            self.lsh_recall(ids, vectors, linked, pairs)
+        return sorted(pairs)
+
+    def lsh_recall(self, ids, vectors, linked, pairs):
+        """
+        compare lsh candidates with the pairs the exhaustive mode
+        would have saved to similarity for self.epsilon
+        """
+        found = set(
+            pair for pair, jaccard in vectors.all_pairs(ids).iteritems()
+            if (self.epsilon == 0.0 and jaccard > 0.0) or
+                (self.epsilon > 0.0 and jaccard >= self.epsilon)
+        ) | linked
+        exhaustive = len(ids) * (len(ids) - 1) / 2
+        if len(found) > 0:
+            recall = float(len(found & pairs))/float(len(found))
+        else:
+            recall = 1.0
+        sys.stderr.write(
+            "ygpairs lsh recall {:.4f} ({} of {} similar pairs) "
+            "candidates {} of {} exhaustive pairs\n".format(
+                recall, len(found & pairs), len(found), len(pairs), exhaustive
+            )
+        )
+        self.recall = recall
+        return recall
+
+    def add_pairs(self, th=None, mt=0, mode=ALL_PAIRS, recall=False):
         """
         grab all ids from features using combined_count thresholds
         these can be temporarily set
         optionally set the threshold and maximum tweets to process
+
+        mode is ALL_PAIRS for every pair of selected ids,
+        LSH_PAIRS for only likely candidates (see yglsh) or
+        CYCLE_PAIRS to save the ids as a cycle rather than writing any pairs
         """
         if th is not None: 
             try:
@@ -160,57 +531,27 @@ class ygpairs(ygcursors):
             threshold = self.threshold
 
         try:
-            # want to get the top N tweets per user
-            get = self.getcursor()
-            yglog.vprint("threshold",threshold)
-            get.execute(
-                "select user,count(*) from user_features "
-                "where combined_count/combined_av > %s "
-                "group by user", (threshold,)
-            )
-            alltweets = 0
-            tweetcounts = {}
-            for row in get:
-                user, tweetcount = row
-                yglog.vprint(user, tweetcount)
-                tweetcounts[user] = int(tweetcount)
-                alltweets += int(tweetcount)
-            get.close()
-
             maxtweets = mt if mt > 0 else self.maxtweets
-            ids = []
-            upd = self.getcursor()
-            upd.execute("update features set selected=null where selected is not null")
-            upd.close()
-            self._commit()
-            for user, tweetcount in tweetcounts.iteritems():
-                limit = math.ceil(float(maxtweets) * float(tweetcount)/float(alltweets))
-                yglog.vprint("user",user,"limit",limit,"out of",maxtweets,"all",alltweets,"count",tweetcount)
-                getids = self.getcursor()
-                getids.execute(
-                    "select id from features where user=%s "
-                    "order by combined_count desc limit %s",
-                    (user, limit)
-                )
-                upd = self.getcursor()
-                for row in getids:
-                    ids.append(int(row[0]))
-                    upd.execute("update features set selected=date(now()) where id=%s", (row[0],))
-                getids.close()
-                self._commit()
-                upd.close()
-
-            sorted(ids)
+            ids = self.select_tweets(threshold, maxtweets)
+
+            if mode == CYCLE_PAIRS:
+                self.add_cycle(ids)
+                return
+
+            if mode == LSH_PAIRS:
+                candidates = self.lsh_pairs(ids, recall)
+            else:
+                candidates = self.all_pairs(ids)
+
             pairs = []
             paircount = 0
-            for i in xrange(len(ids)):
-                for j in xrange(i+1,len(ids)):
-                    pairs.append((ids[i], ids[j]))
-                    paircount += 1
-                    if len(pairs) >= self.save_threshold:
-                        self.insert_pairs(pairs)
-                        yglog.vprint("pairs now", paircount)
-                        pairs = []
+            for pair in candidates:
+                pairs.append(pair)
+                paircount += 1
+                if len(pairs) >= self.save_threshold:
+                    self.insert_pairs(pairs)
+                    yglog.vprint("pairs now", paircount)
+                    pairs = []
             yglog.vprint("pairs at end", paircount)
             self.insert_pairs(pairs)
         except Exception as e:
@@ -229,14 +570,30 @@ if __name__ == '__main__':
         "--threshold",type=int,
         help="combined_count/combined_av threshold",default=DEF_THRESHOLD)
     parser.add_argument("--clean",action='store_true',help="delete pairs table before regenerating")
+    parser.add_argument("--mode",choices=[ALL_PAIRS,LSH_PAIRS,CYCLE_PAIRS],default=ALL_PAIRS,
+        help="all pairs of selected tweets, only lsh candidates or a cycle of pair ranges")
+    parser.add_argument("--progress",action='store_true',
+        help="json dump progress of each cycle instead of adding pairs")
+    parser.add_argument("--epsilon",type=float,default=DEF_EPSILON,
+        help="ygsim epsilon the lsh candidates are aimed at")
+    parser.add_argument("--bands",type=int,default=LSH_BANDS,help="number of lsh bands")
+    parser.add_argument("--rows",type=int,default=LSH_ROWS,help="minhash values per lsh band")
+    parser.add_argument("--recall",action='store_true',
+        help="report lsh recall against the exhaustive pairs")
     parser.add_argument("--verbose",action='store_true',help="print lots of debug info")
     args = parser.parse_args()
 
     yglog.verbose = args.verbose
     pairs = ygpairs(
         threshold=args.threshold,
-        maxtweets=args.maxtweets
+        maxtweets=args.maxtweets,
+        epsilon=args.epsilon,
+        bands=args.bands,
+        rows=args.rows
     )
+    if args.progress:
+        print json.dumps(pairs.cycle_progress(), indent=4)
+        sys.exit(0)
     if args.clean: pairs.cleanup_pairs()
-    pairs.add_pairs()
+    pairs.add_pairs(mode=args.mode, recall=args.recall)
 
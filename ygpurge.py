@@ -11,14 +11,40 @@ start = time.time()
 conn = ygdb.conn()
 cleanup = conn.cursor()
 print "purging features"
-cleanup.execute("delete from features where created_at < now() - interval 2 day")
+# one cutoff for everything so a tweet can't age past it between statements
+cleanup.execute("select now() - interval 2 day")
+cutoff = cleanup.fetchone()[0]
+# take the purged tweets off the users' running totals (see ygfeatures.user_deltas)
+cleanup.execute(
+    "update users a,(select user,ifnull(sum(combined_count),0) csum,count(combined_count) cnum "
+    "from features where created_at < %s group by user) b "
+    "set a.combined_sum=a.combined_sum-b.csum,a.combined_num=a.combined_num-b.cnum "
+    "where a.screen_name=b.user",
+    (cutoff,)
+)
+cleanup.execute(
+    "update users set combined_av=if(combined_num>0,combined_sum/combined_num,null)"
+)
+cleanup.execute("delete from features where created_at < %s", (cutoff,))
 conn.commit()
 elapsed = time.time() - start
 print "purging tweets",elapsed,"s"
-cleanup.execute("delete from tweets where id not in (select id from features)")
+# tweets fetched but not scanned yet have no features, since_id has moved past them
+# so they would never be fetched again, only drop them once they are as old as the features
+cleanup.execute(
+    "delete from tweets where id not in (select id from features) "
+    "and (scanned=1 or imported < %s)",
+    (cutoff,)
+)
 conn.commit()
 elapsed = time.time() - start
 print "purging tweetwords",elapsed,"s"
+cleanup.execute(
+    "update words a,(select term,count(*) num from tweetwords "
+    "where id not in (select id from features) group by term) b "
+    "set a.num=a.num-b.num where a.term=b.term"
+)
+cleanup.execute("delete from words where num <= 0")
 cleanup.execute("delete from tweetwords where id not in (select id from features)")
 conn.commit()
 elapsed = time.time() - start
@@ -27,6 +53,12 @@ cleanup.execute("delete from links where id not in (select id from features)")
 conn.commit()
 elapsed = time.time() - start
 print "purging tweetbigrams",elapsed,"s"
+cleanup.execute(
+    "update bigrams a,(select term,count(*) num from tweetbigrams "
+    "where id not in (select id from features) group by term) b "
+    "set a.num=a.num-b.num where a.term=b.term"
+)
+cleanup.execute("delete from bigrams where num <= 0")
 cleanup.execute("delete from tweetbigrams where id not in (select id from features)")
 conn.commit()
 elapsed = time.time() - start
@@ -35,6 +67,14 @@ cleanup.execute("delete from similarity where id1 not in (select id from feature
 cleanup.execute("delete from similarity where id2 not in (select id from features)")
 conn.commit()
 elapsed = time.time() - start
+print "purging cycles",elapsed,"s"
+cleanup.execute(
+    "delete from cycle_ranges where cycle in "
+    "(select cycle from cycles where added < now() - interval 2 day)"
+)
+cleanup.execute("delete from cycles where added < now() - interval 2 day")
+conn.commit()
+elapsed = time.time() - start
 print "purging pairs",elapsed,"s"
 # deleting stuff from the pairs table doesn't seem to be happening as expected ...
 # this takes a lot longer but is guaranteed to produce just what we want
@@ -13,24 +13,67 @@ have added bigrams to the word list to make comparisons more specific
 words and bigrams are weighted
 
 """
-from ygpairs import ygpairs
+from ygpairs import ygpairs, triangle_pairs, LEASE
 from ygcursors import ygcursors
+import ygdb
+from ygvectors import ygvectors, yglinks
 import yglog
 import json
 import traceback
 import sys
 import argparse
 import time
+import os
+import multiprocessing
+from bisect import bisect_left, bisect_right
 
 SAVE_ME = 10000 # default number of pairs to collect before inserting
 INFINITY = 999
 
+# (vectors, linkcounts, epsilon) in shared memory for worker processes
+# set by ygsim.scan_workers before the workers are forked
+shared = None
+
+def is_similar(epsilon, jaccard, linkcount):
+    """
+    filter out stuff where there is no significant relationship
+    """
+    score = linkcount + jaccard
+    if (epsilon == 0.0 and score > epsilon) or \
+            (epsilon > 0.0 and score >= epsilon):
+        return True
+    return False
+
+def similar_pairs(vectors, linkcounts, epsilon, sample):
+    """
+    score a block of pairs and return (id1,id2,jaccard,linkcount)
+    for the ones that are similar enough to save
+    """
+    similarities = []
+    # most measures aren't working well with this data ...
+    jaccards = vectors.jaccard_pairs(sample)
+    counts = linkcounts.counts(sample)
+    for ids, jaccard, linkcount in zip(sample, jaccards, counts):
+        (id1, id2) = ids
+        if is_similar(epsilon, jaccard, linkcount):
+            similarities.append((id1,id2,jaccard,linkcount))
+            yglog.vprint("similarity",(id1,id2,jaccard,linkcount))
+    return similarities
+
+def compare_shared(sample):
+    """
+    worker process version of ygsim.compare_ids: uses the shared
+    vectors and link counts and leaves saving to the parent process
+    """
+    vectors, linkcounts, epsilon = shared
+    return similar_pairs(vectors, linkcounts, epsilon, sample)
+
 class ygsim(ygcursors):
     """
     handles calculating similarity either using links
     or metrics related to words
     """
-    def __init__(self, ip, thread, wait=0.0, savesz=SAVE_ME, epsilon=None):
+    def __init__(self, ip, thread, wait=0.0, savesz=SAVE_ME, epsilon=None, snapshot=None):
         super(ygsim, self).__init__()
         self.savesz = savesz
         self.ip = ip
@@ -38,8 +81,11 @@ class ygsim(ygcursors):
         if epsilon is None: self.epsilon = 0.0
         else: self.epsilon = epsilon
         self.wait = wait
-        self.load_words()
-        self.load_linkcounts()
+        if snapshot is None:
+            self.load_words()
+            self.load_linkcounts()
+        else:
+            self.load_snapshot(snapshot)
 
     def calc_jaccard (self, list1, list2):
         """
@@ -48,6 +94,9 @@ class ygsim(ygcursors):
         enhanced by allowing separate weights for different kinds of terms
         result is |intersection|/(|union|-|intersection|)
         unlike a true set multiple matches of the same word count
+
+        this is the reference version - ygvectors does the same calculation
+        for blocks of pairs and is what compare_ids uses
         """
         intersectiondict = {}
         uniondict = {}
@@ -77,60 +126,180 @@ class ygsim(ygcursors):
     def load_words(self):
         """
         loads features table words field into memory
+        as a sparse term-weight matrix (see ygvectors)
         """
 
         get = self.getcursor()
         get.execute(
-            "select id,words from features"
+            "select id,words from features order by id"
         )
+        vectors = ygvectors()
+        for row in get:
+            tweetid, wordjson = row
+            vectors.add(tweetid, json.loads(wordjson))
+        get.close()
+        self.vectors = vectors
+
+    def load_linkcounts(self, links=None):
+        """
+        checks links table to find all tweets sharing links
+        keeps an index of the links for each tweet in memory (see ygvectors.yglinks)
+        links is an optional ygvectors of tweet id -> links to use instead of the table
+        """
+        if links is None:
+            links = ygvectors.build(self.fetch_links("select id,link from links"))
+        self.linkcounts = yglinks(links)
+
+    def fetch_words(self, query, args=None):
+        """
+        dict of tweet id -> words dict for the features rows returned by query
+        """
+        get = self.getcursor()
+        get.execute(query, args)
         words = {}
         for row in get:
             tweetid, wordjson = row
             words[tweetid] = json.loads(wordjson)
-        self.words = words
+        get.close()
+        return words
 
-    def load_linkcounts(self):
+    def fetch_links(self, query, args=None):
         """
-        checks links table to find all tweets sharing links
-        saves whole list into memory
+        dict of tweet id -> {link: 1} for the links rows returned by query
         """
         get = self.getcursor()
-        get.execute(
-            "select id,link from links"
-        )
-        common = {}
+        get.execute(query, args)
+        links = {}
         for row in get:
             tweetid, link = row
-            if link not in common:
-                common[link] = []
-            common[link].append(tweetid)
+            links.setdefault(tweetid, {})[link] = 1
+        get.close()
+        return links
+
+    def snapshot_changes(self, vectors, watermark):
+        """
+        features at or below the watermark that were added (scanned late)
+        or purged since the snapshot was saved
+
+        count(*) and sum(id) of a range of ids in features are checked against
+        the snapshot's rows and only ranges that differ are split further
+        so ids are only read for the small ranges around the changes
+        returns (late ids, purged ids)
+        """
+        ids = vectors.ids
+        dead = sorted(vectors.dead)
+        get = self.getcursor()
+        late = []
+        gone = []
+        ranges = [(0, watermark)]
+        while len(ranges) > 0:
+            lo, hi = ranges.pop()
+            first = bisect_left(ids, lo)
+            last = bisect_right(ids, hi)
+            rows = xrange(first, last)
+            if bisect_left(dead, first) < bisect_left(dead, last):
+                rows = [i for i in rows if i not in vectors.dead]
+            get.execute("select count(*),sum(id) from features where id >= %s and id <= %s", (lo, hi))
+            count, total = get.fetchone()
+            if count == len(rows) and (count == 0 or total == sum(ids[i] for i in rows)):
+                continue
+            if count == 0:
+                gone.extend(ids[i] for i in rows)
+            elif len(rows) <= SAVE_ME:
+                get.execute("select id from features where id >= %s and id <= %s", (lo, hi))
+                live = set(int(row[0]) for row in get)
+                mine = set(ids[i] for i in rows)
+                late.extend(live - mine)
+                gone.extend(mine - live)
+            else:
+                middle = ids[rows[len(rows) // 2]]
+                ranges.append((middle, hi))
+                ranges.append((lo, middle - 1))
         get.close()
+        return sorted(late), gone
+
+    def load_snapshot(self, path):
+        """
+        loads words and links from the snapshot directory path
+        instead of reading all of features and links
+
+        only features newer than the snapshot's watermark (the highest feature id
+        it holds) and ones that were scanned late with older ids are read
+        rows for purged features are tombstoned (see snapshot_changes)
+        the updated snapshot is saved back to path for the next run
+        """
+        start = time.time()
+        wordpath = os.path.join(path, 'words')
+        linkpath = os.path.join(path, 'links')
+        vectors, watermark = ygvectors.load(wordpath)
+        links, linkmark = ygvectors.load(linkpath)
+
+        if vectors is None or links is None or watermark != linkmark:
+            self.load_words()
+            vectors = self.vectors
+            watermark = vectors.ids[-1] if len(vectors) > 0 else 0
+            links = ygvectors.build(self.fetch_links(
+                "select id,link from links where id <= %s", (watermark,)))
+            started = "cold"
+            counts = (len(vectors), 0, 0)
+        else:
+            late, gone = self.snapshot_changes(vectors, watermark)
+            purged = 0
+            for matrix in (vectors, links):
+                for tweetid in gone:
+                    i = matrix.row(tweetid)
+                    if i is None: continue
+                    matrix.dead.add(i)
+                    if matrix is vectors: purged += 1
+
+            latewords = {}
+            latelinks = {}
+            for first in xrange(0, len(late), SAVE_ME):
+                chunk = late[first:first+SAVE_ME]
+                placeholders = ",".join(["%s"] * len(chunk))
+                latewords.update(self.fetch_words(
+                    "select id,words from features where id in ({})".format(placeholders), chunk))
+                latelinks.update(self.fetch_links(
+                    "select id,link from links where id in ({})".format(placeholders), chunk))
 
-        linkcounts = {}
-        for link in common:
-            ids = common[link]
-            # always save ids pairs in ascending order
-            sorted(ids)
-            for i in xrange(len(ids)):
-                for j in xrange(i+1,len(ids)):
-                    if ids[i] not in linkcounts:
-                        linkcounts[ids[i]] = {}
-                    if ids[j] not in linkcounts[ids[i]]:
-                        linkcounts[ids[i]][ids[j]] = 0
-                    linkcounts[ids[i]][ids[j]] += INFINITY
-        self.linkcounts = linkcounts
+            if len(latewords) > 0 or len(vectors.dead) > len(vectors) / 4:
+                vectors = vectors.compact(latewords)
+            if len(latelinks) > 0 or len(links.dead) > len(links) / 4:
+                links = links.compact(latelinks)
+
+            newwords = self.fetch_words(
+                "select id,words from features where id > %s order by id", (watermark,))
+            for tweetid in sorted(newwords):
+                vectors.add(tweetid, newwords[tweetid])
+            if len(newwords) > 0:
+                newlinks = self.fetch_links(
+                    "select id,link from links where id > %s and id <= %s",
+                    (watermark, max(newwords))
+                )
+                for tweetid in sorted(newlinks):
+                    links.add(tweetid, newlinks[tweetid])
+            started = "warm"
+            counts = (len(newwords), len(latewords), purged)
+
+        if len(vectors) > 0:
+            watermark = vectors.ids[-1]
+            vectors.save(wordpath, watermark)
+            links.save(linkpath, watermark)
+        self.vectors = vectors
+        self.load_linkcounts(links)
+        sys.stderr.write(
+            "ygsim {} start {:.2f}s watermark {} "
+            "{} new {} late {} purged features\n".format(
+                started, time.time() - start, watermark, *counts
+            )
+        )
 
     def get_linkcount(self, id1, id2):
         """
         check for number of common links between two tweets
-        always checks ids in ascending order
+        the order of the ids doesn't matter
         """
-        if id1 > id2:
-            (id1, id2) = (id2, id1)
-        if id1 in self.linkcounts:
-            if id2 in self.linkcounts[id1]:
-                return self.linkcounts[id1][id2]
-        return 0
+        return self.linkcounts.get(id1, id2)
 
     def compare_two(self, id1, id2):
         """
@@ -138,10 +307,7 @@ class ygsim(ygcursors):
         """
         try:
             # originally had many more measures none of which were that useful ...
-            if id1 in self.words and id2 in self.words:
-                jaccard = self.calc_jaccard(self.words[id1], self.words[id2])
-            else:
-                jaccard = 0.0
+            jaccard = self.vectors.jaccard(id1, id2)
             linkcount = self.get_linkcount(id1,id2)
 
             return jaccard, linkcount
@@ -166,40 +332,98 @@ class ygsim(ygcursors):
         ins.close()
         self._commit()
 
+    def is_similar(self, jaccard, linkcount):
+        """
+        filter out stuff where there is no significant relationship
+        """
+        return is_similar(self.epsilon, jaccard, linkcount)
+
+    def set_processed(self, ids):
+        """
+        mark the first id of each compared pair as processed
+        """
+        if len(ids) == 0: return
+        upd = self.getcursor()
+        upd.executemany(
+            "update features set processed=now() where id=%s",
+            [(tweetid,) for tweetid in sorted(ids)]
+        )
+        upd.close()
+        self._commit()
+
     def compare_ids(self, sample):
         """
         given a list of pairs of ids do pairwise comparisons
         save the results in the similarity table
         """
         yglog.vprint("sample",len(sample))
+        similarities = similar_pairs(self.vectors, self.linkcounts, self.epsilon, sample)
+        for start in xrange(0, len(similarities), self.savesz):
+            self.save_similarities(similarities[start:start+self.savesz])
+        self.set_processed(set(id1 for id1, id2 in sample))
+
+    def get_selected(self):
+        """
+        ids of the tweets picked by ygpairs.add_pairs in ascending order
+        """
+        get = self.getcursor()
+        get.execute("select id from features where selected is not null order by id")
+        ids = [int(row[0]) for row in get]
+        get.close()
+        return ids
+
+    def compare_selected(self, ids=None, join=False):
+        """
+        compare every pair of the selected tweets in one pass
+        without going through the pairs table
+
+        pairs that share no terms and no links have a score of 0
+        so only pairs found in the term index or the link counts are checked
+        gives the same similarity rows as add_pairs followed by scan_pairs
+
+        with join set ygvectors.join skips pairs that can't reach epsilon
+        and the pruning ratio is logged
+        """
+        if ids is None: ids = self.get_selected()
+        yglog.vprint("comparing",len(ids),"selected tweets")
+        if join:
+            scores = self.vectors.join(ids, self.epsilon)
+            stats = self.vectors.joinstats
+            pruned = 1.0
+            if stats['pairs'] > 0:
+                pruned = 1.0 - float(stats['candidates'])/float(stats['pairs'])
+            sys.stderr.write(
+                "ygsim join compared {} of {} pairs pruning ratio {:.4f} "
+                "found {} similar\n".format(
+                    stats['candidates'], stats['pairs'], pruned, stats['similar']
+                )
+            )
+        else:
+            scores = self.vectors.all_pairs(ids)
+        selected = set(ids)
+        missing = []
+        for key in self.linkcounts.pairs():
+            if key[0] not in selected or key[1] not in selected: continue
+            if key not in scores: missing.append(key)
+        # the join drops pairs below epsilon but a shared link still makes them similar
+        # so they need their real score, all_pairs already has every pair sharing a term
+        missing.sort()
+        if join:
+            scores.update(zip(missing, self.vectors.jaccard_pairs(missing)))
+        else:
+            scores.update((key, 0.0) for key in missing)
+
         similarities = []
-        for ids in sample:
-            (id1, id2) = ids
-            yglog.vprint("id1",id1,"id2",id2)
-            # most measures aren't working well with this data ...
-            jaccard, linkcount = self.compare_two(id1, id2)
-
-            # filter out stuff where there is no significant relationship
-            score = linkcount + jaccard
-            if (self.epsilon == 0.0 and score > self.epsilon) or \
-                    (self.epsilon > 0.0 and score >= self.epsilon): 
+        for (id1, id2) in sorted(scores):
+            jaccard = scores[(id1, id2)]
+            linkcount = self.get_linkcount(id1, id2)
+            if self.is_similar(jaccard, linkcount):
                 similarities.append((id1,id2,jaccard,linkcount))
-                yglog.vprint("similarity",(id1,id2,jaccard,linkcount))
-
             if len(similarities) >= self.savesz:
                 self.save_similarities(similarities)
                 similarities = []
-
         self.save_similarities(similarities)
-        upd = self.getcursor()
-        for ids in sample:
-            id1, id2 = ids
-            upd.execute(
-                "update features set processed=now() where id=%s",
-                (id1,)
-            )
-        upd.close()
-        self._commit()
+        self.set_processed(ids[:-1])
 
     def clean_similarities(self):
         """
@@ -209,32 +433,119 @@ class ygsim(ygcursors):
         rem = self.getcursor()
         rem.execute("drop table similarity")
         rem.execute("create table similarity (like similarity_template)")
-        rem.execute("update pairs set ip=null,thread=null,processed=null")
+        rem.execute("update pairs set ip=null,thread=null,processed=null,claim=null,expires=null")
+        rem.execute(
+            "update cycle_ranges set ip=null,thread=null,processed=null,"
+            "claim=null,expires=null,done=null"
+        )
         rem.close()
         self._commit()
         yglog.vprint("finished cleanup")
 
-    def scan_pairs(self, maxcount=None, clean=False):
+    def scan_pairs(self, maxcount=None, clean=False, lease=LEASE):
         """
-        using the ygpairs static method get_pairs
+        using the ygpairs static method claim_pairs
         do comparisons on each pair and save anything interesting
+        the claim is completed once the batch has been saved
+        """
+        if clean:
+            self.clean_similarities() # deletes all similarity data
+
+        claim, sample = ygpairs.claim_pairs(self.ip, self.thread, lease=lease)
+        while len(sample) > 0:
+            if self.wait is not None: time.sleep(self.wait)
+            self.compare_ids(sample)
+            ygpairs.complete_pairs(claim)
+
+            if maxcount is not None:
+                maxcount -= len(sample)
+                if maxcount <= 0: break
+
+            claim, sample = ygpairs.claim_pairs(self.ip, self.thread, lease=lease)
+
+    def scan_cycles(self, maxcount=None, clean=False, lease=LEASE):
+        """
+        like scan_pairs but claims ranges of a cycle from ygpairs.claim_range
+        and makes the pairs from the cycle's list of ids
         """
         if clean:
             self.clean_similarities() # deletes all similarity data
 
-        # sample = ygpairs.get_pairs(self.ip, self.thread)
-        pairs = ygpairs()
-        sample = ygpairs.get_pairs(self.ip, self.thread)
+        self.cycleids = {}
+        claim, sample = self.claim_sample(True, lease)
         while len(sample) > 0:
             if self.wait is not None: time.sleep(self.wait)
-            if len(sample) > 0:
-                self.compare_ids(sample)
+            self.compare_ids(sample)
+            ygpairs.complete_range(claim)
+
+            if maxcount is not None:
+                maxcount -= len(sample)
+                if maxcount <= 0: break
 
-                if maxcount is not None:
-                    maxcount -= len(sample)
-                    if maxcount <= 0: break
+            claim, sample = self.claim_sample(True, lease)
 
-            sample = ygpairs.get_pairs(self.ip, self.thread)
+    def claim_sample(self, cycles, lease):
+        """
+        claim the next batch of pairs from either the pairs table or a cycle
+        returns a claim and a list of pairs (empty when there is nothing left)
+        """
+        if not cycles:
+            return ygpairs.claim_pairs(self.ip, self.thread, lease=lease)
+        claimed = ygpairs.claim_range(self.ip, self.thread, lease=lease)
+        if claimed is None: return None, []
+        claim, cycle, start, end = claimed
+        if cycle not in self.cycleids:
+            self.cycleids = {cycle: ygpairs.get_cycle_ids(cycle)}
+        return claim, triangle_pairs(self.cycleids[cycle], start, end)
+
+    def scan_workers(self, workers, maxcount=None, clean=False, lease=LEASE, cycles=False):
+        """
+        like scan_pairs (or scan_cycles) but the comparisons are done
+        by a pool of worker processes
+
+        the term vectors and link counts are moved into shared memory once
+        and inherited by the workers when they are forked
+        this process claims batches, hands them out and is the only one
+        that writes to the db
+        """
+        global shared
+        if clean:
+            self.clean_similarities() # deletes all similarity data
+
+        self.vectors = self.vectors.share()
+        self.linkcounts = self.linkcounts.share()
+        shared = (self.vectors, self.linkcounts, self.epsilon)
+        self.cycleids = {}
+        # don't let the workers inherit our db connection
+        self.closedb()
+        pool = multiprocessing.Pool(workers)
+        try:
+            pending = []
+            finished = False
+            while True:
+                # keep a couple of batches per worker in flight
+                while not finished and len(pending) < 2 * workers:
+                    if maxcount is not None and maxcount <= 0:
+                        finished = True
+                        break
+                    claim, sample = self.claim_sample(cycles, lease)
+                    if len(sample) == 0:
+                        finished = True
+                        break
+                    if maxcount is not None: maxcount -= len(sample)
+                    pending.append((claim, sample, pool.apply_async(compare_shared, (sample,))))
+                if len(pending) == 0: break
+
+                claim, sample, result = pending.pop(0)
+                similarities = result.get()
+                for start in xrange(0, len(similarities), self.savesz):
+                    self.save_similarities(similarities[start:start+self.savesz])
+                self.set_processed(set(id1 for id1, id2 in sample))
+                if cycles: ygpairs.complete_range(claim)
+                else: ygpairs.complete_pairs(claim)
+        finally:
+            pool.close()
+            pool.join()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -244,12 +555,33 @@ if __name__ == '__main__':
     parser.add_argument('--thread',required=True,type=int,help="thread number for this node")
     parser.add_argument('--epsilon',type=float,help="minimum similarity value for saving a pair")
     parser.add_argument('--wait',type=float,help="wait time between samples")
+    parser.add_argument('--lease',type=int,default=LEASE,
+        help="seconds to hold claimed pairs before another instance can take them")
     parser.add_argument('--clean',action='store_true',help="delete data in similarity table")
+    parser.add_argument('--selected',action='store_true',
+        help="compare all selected tweets at once instead of reading the pairs table")
+    parser.add_argument('--snapshot',
+        help="directory to keep a snapshot of features words and links in for faster startup")
+    parser.add_argument('--workers',type=int,default=0,
+        help="number of worker processes to compare pairs with (0 to compare in this process)")
+    parser.add_argument('--cycles',action='store_true',
+        help="claim ranges of cycles made by ygpairs.py --mode=cycle instead of pairs")
+    parser.add_argument('--join',action='store_true',
+        help="like --selected but only compare pairs that could reach epsilon")
     parser.add_argument('--verbose',action='store_true',help="show lots of debug info")
     args = parser.parse_args()
 
     yglog.verbose = args.verbose
 
-    with ygsim(ip=args.ip, thread=args.thread, wait=args.wait, epsilon=args.epsilon) as sim:
-        sim.scan_pairs(clean=args.clean)
-
+    with ygsim(ip=args.ip, thread=args.thread, wait=args.wait, epsilon=args.epsilon,
+            snapshot=args.snapshot) as sim:
+        if args.selected or args.join:
+            if args.clean: sim.clean_similarities()
+            sim.compare_selected(join=args.join)
+        elif args.workers > 0:
+            sim.scan_workers(args.workers, clean=args.clean, lease=args.lease, cycles=args.cycles)
+        elif args.cycles:
+            sim.scan_cycles(clean=args.clean, lease=args.lease)
+        else:
+            sim.scan_pairs(clean=args.clean, lease=args.lease)
+    sys.stderr.write(ygdb.pool.report())
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+author: Cal Woodruff, cwoodruf@sfu.ca
+local stand in for twitter's statuses/user_timeline used to try out ygnews.py
+without using up the real rate limit
+
+every screen name gets a made up timeline that grows by --new statuses a minute
+latency, rate limiting (429 with x-rate-limit headers) and errors can be injected
+
+    ./ygstub.py --port=8080 --latency=0.5 --limit=100 --window=60 &
+    ./ygnews.py --ip=localhost --thread=1 --feeds=feeds.csv --api=http://localhost:8080 --log=-
+
+GET /stats returns the number of requests, rate limited responses etc. as json
+"""
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import urlparse
+import threading
+import random
+import math
+import json
+import time
+import zlib
+import sys
+import argparse
+
+TIMELINE = '/1.1/statuses/user_timeline.json'
+CREATED = '%a %b %d %H:%M:%S +0000 %Y'
+WORDS = (
+    'breaking news council vote city report police market storm school '
+    'election minister budget health court fire water game win loss'
+).split()
+
+class ygstub(object):
+    """
+    made up timelines and the rate limit bookkeeping for the stub server
+    """
+    def __init__(self, latency=0.0, jitter=0.0, limit=0, window=900, errors=0.0, initial=50, new=1.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.limit = limit
+        self.window = window
+        self.errors = errors
+        self.initial = initial
+        self.new = new
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.windowstart = self.started
+        self.used = 0
+        self.stats = {'requests':0, 'limited':0, 'errors':0, 'statuses':0, 'bytes':0, 'inflight':0, 'maxinflight':0}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+            if name == 'inflight':
+                self.stats['maxinflight'] = max(self.stats['maxinflight'], self.stats['inflight'])
+
+    def ratelimit(self):
+        """
+        uses up one request from the current window
+        returns (allowed, headers)
+        """
+        with self.lock:
+            now = time.time()
+            if now >= self.windowstart + self.window:
+                self.windowstart = now
+                self.used = 0
+            reset = int(math.ceil(self.windowstart + self.window))
+            if self.limit <= 0:
+                return True, {}
+            allowed = self.used < self.limit
+            if allowed: self.used += 1
+            return allowed, {
+                'x-rate-limit-limit': self.limit,
+                'x-rate-limit-remaining': self.limit - self.used,
+                'x-rate-limit-reset': reset,
+            }
+
+    def total(self):
+        """
+        number of statuses every timeline has at the moment
+        """
+        return self.initial + int((time.time() - self.started) * self.new / 60.0)
+
+    def status(self, user, k, tag, now):
+        """
+        the k-th status of user's timeline
+        about a third of them keep getting retweeted and favourited
+        """
+        statusid = (k + 1) * 65536 + tag
+        created = self.started + (k - self.initial) * 60.0 / max(self.new, 0.01)
+        age = max(0, int((now - created) / 60.0))
+        rand = random.Random(statusid)
+        return {
+            'id': statusid,
+            'id_str': str(statusid),
+            'created_at': time.strftime(CREATED, time.gmtime(created)),
+            'text': "{} {}".format(user, " ".join(rand.choice(WORDS) for i in xrange(8))),
+            'lang': 'en',
+            'retweet_count': (k % 3) * age,
+            'favorite_count': (k % 3) * age // 2,
+            'entities': {'urls': [], 'hashtags': [], 'user_mentions': []},
+            'user': {
+                'screen_name': user,
+                'favourites_count': tag % 1000,
+                'followers_count': tag,
+                'statuses_count': self.total(),
+            },
+        }
+
+    def timeline(self, user, since_id=None, max_id=None, count=20):
+        """
+        newest first like twitter: statuses with since_id < id <= max_id
+        """
+        now = time.time()
+        tag = zlib.crc32(user.lower()) & 0xffff
+        k = self.total() - 1
+        if max_id is not None:
+            k = min(k, (max_id - tag) // 65536 - 1)
+        statuses = []
+        while k >= 0 and len(statuses) < count:
+            if since_id is not None and (k + 1) * 65536 + tag <= since_id: break
+            statuses.append(self.status(user, k, tag, now))
+            k -= 1
+        return statuses
+
+class ygstubhandler(BaseHTTPRequestHandler):
+
+    def reply(self, code, body, headers={}):
+        data = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json;charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.iteritems():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+        return len(data)
+
+    def do_GET(self):
+        stub = self.server.stub
+        url = urlparse.urlparse(self.path)
+        query = dict((k, v[-1]) for k, v in urlparse.parse_qs(url.query).iteritems())
+
+        if url.path == '/stats':
+            with stub.lock:
+                stats = dict(stub.stats)
+            self.reply(200, stats)
+            return
+        if url.path != TIMELINE:
+            self.reply(404, {'errors': [{'code': 34, 'message': 'Sorry, that page does not exist.'}]})
+            return
+
+        stub.count('requests')
+        stub.count('inflight')
+        try:
+            delay = stub.latency + random.uniform(0, stub.jitter)
+            if delay > 0: time.sleep(delay)
+
+            allowed, headers = stub.ratelimit()
+            if not allowed:
+                stub.count('limited')
+                self.reply(429, {'errors': [{'code': 88, 'message': 'Rate limit exceeded'}]}, headers)
+                return
+            if stub.errors > 0 and random.random() < stub.errors:
+                stub.count('errors')
+                self.reply(503, {'errors': [{'code': 130, 'message': 'Over capacity'}]}, headers)
+                return
+            if 'screen_name' not in query:
+                self.reply(400, {'errors': [{'code': 44, 'message': 'screen_name parameter is missing'}]}, headers)
+                return
+
+            getint = lambda name: int(query[name]) if name in query else None
+            statuses = stub.timeline(
+                query['screen_name'],
+                since_id=getint('since_id'),
+                max_id=getint('max_id'),
+                count=min(200, getint('count') or 20)
+            )
+            stub.count('statuses', len(statuses))
+            stub.count('bytes', self.reply(200, statuses, headers))
+        finally:
+            stub.count('inflight', -1)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class ygstubserver(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serve(stub, port=0, verbose=False):
+    """
+    start a stub server in a background thread
+    returns the server, its port is server.server_address[1]
+    """
+    server = ygstubserver(('127.0.0.1', port), ygstubhandler)
+    server.stub = stub
+    server.verbose = verbose
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="stub twitter statuses/user_timeline server for testing ygnews.py")
+    parser.add_argument('--port',type=int,default=8080,help="port to listen on")
+    parser.add_argument('--latency',type=float,default=0.0,help="seconds added to every request")
+    parser.add_argument('--jitter',type=float,default=0.0,help="up to this many more random seconds per request")
+    parser.add_argument('--limit',type=int,default=0,help="requests allowed per window before 429s (0 for no limit)")
+    parser.add_argument('--window',type=int,default=900,help="rate limit window in seconds")
+    parser.add_argument('--errors',type=float,default=0.0,help="fraction of requests that get a 503")
+    parser.add_argument('--initial',type=int,default=50,help="statuses in each timeline at start")
+    parser.add_argument('--new',type=float,default=1.0,help="new statuses per timeline per minute")
+    parser.add_argument('--verbose',action='store_true',help="log every request")
+    args = parser.parse_args()
+
+    stub = ygstub(
+        latency=args.latency, jitter=args.jitter, limit=args.limit, window=args.window,
+        errors=args.errors, initial=args.initial, new=args.new
+    )
+    server = serve(stub, args.port, args.verbose)
+    sys.stderr.write("ygstub: listening on http://127.0.0.1:{}{}\n".format(server.server_address[1], TIMELINE))
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        sys.stderr.write("ygstub: {}\n".format(json.dumps(stub.stats)))
+        server.shutdown()
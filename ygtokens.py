@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+author: Cal Woodruff, cwoodruf@sfu.ca
+one pass tokenizer for the text of tweets used by ygfeatures
+
+gives the same words as the original chain of re.subs (see slow_words):
+urls are dropped, &amp; becomes "and", other entities and punctuation split words
+and cliches such as "need to know" are joined into a single word with underscores
+
+run with --bench to compare the two on a corpus of tweet texts
+and with --check to test both against the saved words in ygtokens-corpus.json
+"""
+from ygcursors import ygcursors
+import json
+import re
+import sys
+import time
+import argparse
+import os
+
+CLICHES = ('need to know',) # always used even if the cliches table is empty
+WORDWEIGHT = 1
+BIGRAMWEIGHT = 2
+
+# the only parts of a tweet that don't simply split words
+SPECIAL = re.compile(r'https?://\S*|&amp;|&quot;|&nbsp;|&')
+REPLACEMENTS = {'&amp;': 'and'}
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ygtokens-corpus.json')
+WORD = re.compile(r'[^\s"\'!?\.,;:\-\~\$\%\^\&\*\(\)\{\}\[\]\|\\<>/]+')
+
+def special(match):
+    text = match.group(0)
+    if text[0] == 'h': return ''
+    return REPLACEMENTS.get(text, ' ')
+
+def slow_words(rawtext):
+    """
+    the original tokenizer kept to check ygtokenizer against
+    """
+    words = rawtext.lower()
+    words = re.sub(r'https?://\S*','',words)
+    words = re.sub(r'&amp;','and',words)
+    words = re.sub(r'&quot;','"',words)
+    words = re.sub(r'&nbsp;',' ',words)
+    words = re.sub(r'"', ' ', words)
+    words = re.sub(r"'", ' ', words)
+    words = re.sub(r'[!?\.]+',' ',words)
+    words = re.sub(r'[,;:\-\~\$\%\^\&\*\(\)\{\}\[\]\|\\<>/]', ' ', words)
+    words = re.sub(r'\s+', ' ', words)
+    words = re.sub(r'need to know','need_to_know', words)
+    return words.split()
+
+def phrase(text):
+    """
+    normalize a cliche the same way tweet text is
+    """
+    return ' '.join(text.lower().split())
+
+class ygtokenizer(object):
+    """
+    turns tweet text into a word list and then into word, bigram and term counts
+    """
+    def __init__(self, cliches=None):
+        phrases = set(phrase(c) for c in CLICHES)
+        if cliches is not None:
+            phrases.update(phrase(c) for c in cliches)
+        phrases.discard('')
+        # longest first so a cliche inside a longer one doesn't win
+        phrases = sorted(phrases, key=lambda p: (-len(p), p))
+        self.cliches = re.compile('|'.join(re.escape(p) for p in phrases)) if phrases else None
+
+    def words(self, rawtext):
+        """
+        list of words in the text
+        """
+        text = rawtext.lower()
+        if 'http' in text or '&' in text:
+            text = SPECIAL.sub(special, text)
+        wordlist = WORD.findall(text)
+        if self.cliches is not None:
+            # cliches can start or end part way through a word as they always could
+            joined = ' '.join(wordlist)
+            if self.cliches.search(joined) is not None:
+                wordlist = self.cliches.sub(lambda m: m.group(0).replace(' ', '_'), joined).split()
+        return wordlist
+
+    def count(self, wordlist, stopwords):
+        """
+        returns the word counts, bigram counts and the weighted terms saved in features.words
+        stopwords are skipped and bigrams are made from the words either side of them
+        """
+        tweetbigrams = {}
+        tweetwords = {}
+        savedterms = {}
+        prevword = None
+
+        for word in wordlist:
+            if word in stopwords: continue
+
+            savedterms[word] = WORDWEIGHT
+
+            if prevword is not None:
+                bigram = prevword + ' ' + word
+                tweetbigrams[bigram] = tweetbigrams.get(bigram, 0) + 1
+                savedterms[bigram] = BIGRAMWEIGHT
+
+            tweetwords[word] = tweetwords.get(word, 0) + 1
+            prevword = word
+
+        return tweetwords, tweetbigrams, savedterms
+
+def tweet_text(raw):
+    """
+    the text ygfeatures tokenizes for a raw tweet
+    """
+    data = json.loads(raw)
+    rawtext = data['text'].encode('ascii','replace')
+    for sub in ('quoted_status', 'retweeted_status'):
+        if sub in data and 'text' in data[sub]:
+            rawtext += " " + data[sub]['text'].encode('ascii','replace')
+    return rawtext
+
+def bench(texts, repeat=3):
+    """
+    time slow_words and ygtokenizer.words on a list of texts
+    returns the tokens/second for each and the number of texts where they differ
+    """
+    tokenizer = ygtokenizer()
+    mismatches = 0
+    tokens = 0
+    for text in texts:
+        old = slow_words(text)
+        if tokenizer.words(text) != old: mismatches += 1
+        tokens += len(old)
+
+    rates = []
+    for words in (slow_words, tokenizer.words):
+        best = None
+        for r in xrange(repeat):
+            start = time.time()
+            for text in texts:
+                words(text)
+            elapsed = time.time() - start
+            if best is None or elapsed < best: best = elapsed
+        rates.append(tokens / max(best, 1e-6))
+    return rates[0], rates[1], mismatches
+
+def check(golden):
+    """
+    compare slow_words and ygtokenizer.words with the words saved for each text
+    in a file of {"text": ..., "words": [...]} records one per line
+    returns the texts and the number that didn't match
+    """
+    tokenizer = ygtokenizer()
+    texts = []
+    failed = 0
+    with open(golden) as fh:
+        for line in fh:
+            record = json.loads(line)
+            text = record['text'].encode('ascii')
+            words = [w.encode('ascii') for w in record['words']]
+            for name, got in (('original', slow_words(text)), ('one pass', tokenizer.words(text))):
+                if got != words:
+                    failed += 1
+                    sys.stderr.write("{} tokenizer gave {!r} for {!r} expected {!r}\n".format(name, got, text, words))
+            texts.append(text)
+    return texts, failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("compare the one pass tokenizer with the original")
+    parser.add_argument('--bench',action='store_true',help="time both tokenizers and check they agree")
+    parser.add_argument('--check',nargs='?',const=GOLDEN,metavar='FILE',help="check both tokenizers against saved words (default: %s)" % os.path.basename(GOLDEN))
+    parser.add_argument('--corpus',help="file of tweet texts one per line (default: tweets table)")
+    parser.add_argument('--limit',type=int,default=10000,help="number of tweets to read from the db")
+    args = parser.parse_args()
+
+    if args.check:
+        texts, failed = check(args.check)
+        old, new, mismatches = bench(texts, repeat=20)
+        print "{} texts: {} wrong original {:.0f} tokens/s one pass {:.0f} tokens/s ({:.1f}x)".format(
+            len(texts), failed, old, new, new / old
+        )
+        if failed: sys.exit(1)
+
+    elif args.bench:
+        if args.corpus:
+            with open(args.corpus) as fh:
+                texts = [line.rstrip("\n") for line in fh]
+        else:
+            with ygcursors() as db:
+                get = db.getcursor()
+                get.execute("select raw from tweets limit %s", (args.limit,))
+                texts = [tweet_text(row[0]) for row in get]
+                get.close()
+        old, new, mismatches = bench(texts)
+        print "{} texts: original {:.0f} tokens/s one pass {:.0f} tokens/s ({:.1f}x) mismatches {}".format(
+            len(texts), old, new, new / old, mismatches
+        )
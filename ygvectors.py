@@ -0,0 +1,496 @@
+"""
+author: Cal Woodruff, cwoodruf@sfu.ca
+compact term vectors for the words dicts saved in features
+
+each tweet's words dict is turned into a row of a sparse matrix:
+term ids and weights are saved in flat arrays with an offset per row
+(the usual compressed sparse row layout)
+
+this lets ygsim compare whole blocks of pairs without the
+nested loops in ygsim.calc_jaccard and without holding a dict per tweet
+
+the flat arrays can be moved into shared memory with share() so forked
+worker processes all read the same copy
+
+they can also be saved to a snapshot directory with save() and memory
+mapped back in with load() so ygsim doesn't have to rebuild them every run
+"""
+from array import array
+from bisect import bisect_left
+from multiprocessing.sharedctypes import RawArray
+import ctypes
+import mmap
+import json
+import os
+import shutil
+
+INFINITY = 999 # same as ygsim.INFINITY
+ARRAYS = ('ids', 'offsets', 'terms', 'weights', 'sizes')
+
+def score(intersection, union):
+    """
+    turns an intersection and union weight into the jaccard value used by ygsim
+    this must stay identical to the end of ygsim.calc_jaccard
+    """
+    if union == 0:
+        return 0
+    if intersection == union:
+        return INFINITY
+    if intersection > union:
+        raise(Exception(
+            "jaccard error intersection {} union {}".format(intersection, union)))
+    return float(intersection)/(float(union) - float(intersection))
+
+class ygvectors(object):
+    """
+    sparse term-weight matrix with one row per tweet
+
+    rows are kept in ascending tweet id order
+    terms in each row are sorted by term id
+    weights in features.words are a function of the term (words 1, bigrams 2)
+    so the weight of a shared term is the same in both rows
+    """
+    def __init__(self):
+        self.vocab = {}                 # term -> term id
+        self.ids = array('l')           # tweet id for each row
+        self.offsets = array('l', [0])  # row i is terms[offsets[i]:offsets[i+1]]
+        self.terms = array('l')
+        self.weights = array('l')
+        self.sizes = array('l')         # total weight of each row
+        self.dead = set()               # rows for tweets that have been purged
+
+    @classmethod
+    def build(cls, words):
+        """
+        makes a matrix from a dict of tweet id -> words dict
+        """
+        vectors = cls()
+        for tweetid in sorted(words):
+            vectors.add(tweetid, words[tweetid])
+        return vectors
+
+    def __len__(self):
+        return len(self.ids)
+
+    def share(self):
+        """
+        read only copy of the matrix with its arrays in shared memory
+        child processes forked after this is called use the same memory
+        the copy has no vocab so rows can't be added to it
+        """
+        shared = ygvectors()
+        shared.vocab = None
+        shared.dead = self.dead
+        for name in ARRAYS:
+            setattr(shared, name, RawArray('l', getattr(self, name)))
+        return shared
+
+    def save(self, path, watermark=None):
+        """
+        writes the matrix to the snapshot directory path
+        the arrays are saved as raw machine longs so load can memory map them
+        watermark defaults to the highest tweet id
+        the new snapshot is written beside the old one and then swapped in
+        """
+        if watermark is None:
+            watermark = self.ids[-1] if len(self.ids) > 0 else 0
+        tmp = path + '.new'
+        if os.path.isdir(tmp): shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for name in ARRAYS:
+            with open(os.path.join(tmp, name), 'wb') as fh:
+                fh.write(buffer(getattr(self, name)))
+        terms = [None] * len(self.vocab)
+        for term, termid in self.vocab.iteritems():
+            terms[termid] = term
+        with open(os.path.join(tmp, 'vocab.json'), 'w') as fh:
+            json.dump(terms, fh)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as fh:
+            json.dump({
+                'watermark': watermark,
+                'rows': len(self.ids),
+                'dead': sorted(self.dead),
+            }, fh)
+        if os.path.isdir(path):
+            old = path + '.old'
+            if os.path.isdir(old): shutil.rmtree(old)
+            os.rename(path, old)
+            os.rename(tmp, path)
+            shutil.rmtree(old)
+        else:
+            os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        memory maps a snapshot made by save
+        returns the matrix and its watermark or (None, None) if there is no snapshot
+        pages are copy on write so the files are never changed
+        """
+        metafile = os.path.join(path, 'meta.json')
+        if not os.path.isfile(metafile): return None, None
+        with open(metafile, 'r') as fh:
+            meta = json.load(fh)
+        vectors = cls()
+        with open(os.path.join(path, 'vocab.json'), 'r') as fh:
+            vectors.vocab = dict((term, termid) for termid, term in enumerate(json.load(fh)))
+        vectors.dead = set(meta['dead'])
+        itemsize = array('l').itemsize
+        for name in ARRAYS:
+            filename = os.path.join(path, name)
+            size = os.path.getsize(filename)
+            if size == 0:
+                setattr(vectors, name, array('l'))
+                continue
+            with open(filename, 'rb') as fh:
+                mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_COPY)
+            setattr(vectors, name, (ctypes.c_long * (size / itemsize)).from_buffer(mapped))
+        return vectors, meta['watermark']
+
+    def thaw(self):
+        """
+        turns memory mapped or shared arrays back into arrays that can grow
+        """
+        for name in ARRAYS:
+            current = getattr(self, name)
+            if not isinstance(current, array):
+                copy = array('l')
+                copy.fromstring(buffer(current))
+                setattr(self, name, copy)
+
+    def kill(self, tweetid):
+        """
+        tombstones the row for a purged tweet
+        """
+        i = self.row(tweetid)
+        if i is not None: self.dead.add(i)
+
+    def live_rows(self):
+        """
+        row numbers that haven't been tombstoned
+        """
+        return [i for i in xrange(len(self.ids)) if i not in self.dead]
+
+    def compact(self, words=None):
+        """
+        copy of the matrix without tombstoned rows
+        words is an optional dict of tweet id -> words dict of extra rows
+        which don't need to be newer than the existing rows
+
+        terms only the dropped rows used are left out of the vocab
+        the rest are numbered in the same order as before so rows stay sorted
+        """
+        if words is None: words = {}
+        rows = self.live_rows()
+        used = set()
+        for i in rows:
+            used.update(self.terms[self.offsets[i]:self.offsets[i+1]])
+        used = sorted(used)
+        renumber = dict((termid, n) for n, termid in enumerate(used))
+        compacted = ygvectors()
+        for term, termid in self.vocab.iteritems():
+            if termid in renumber: compacted.vocab[term] = renumber[termid]
+        extra = sorted(words)
+        r = 0
+        e = 0
+        while r < len(rows) or e < len(extra):
+            if e >= len(extra) or (r < len(rows) and self.ids[rows[r]] < extra[e]):
+                i = rows[r]
+                start, end = self.offsets[i], self.offsets[i+1]
+                compacted.terms.extend([renumber[termid] for termid in self.terms[start:end]])
+                compacted.weights.extend(self.weights[start:end])
+                compacted.ids.append(self.ids[i])
+                compacted.offsets.append(len(compacted.terms))
+                compacted.sizes.append(self.sizes[i])
+                r += 1
+            else:
+                if self.row(extra[e]) is None:
+                    compacted.add(extra[e], words[extra[e]])
+                e += 1
+        return compacted
+
+    def __contains__(self, tweetid):
+        return self.row(tweetid) is not None
+
+    def add(self, tweetid, termdict):
+        """
+        appends a row - tweet ids must be added in ascending order
+        """
+        self.thaw()
+        if len(self.ids) > 0 and tweetid <= self.ids[-1]:
+            raise(Exception("ygvectors.add: {} added out of order".format(tweetid)))
+        row = []
+        for term, weight in termdict.iteritems():
+            if term not in self.vocab:
+                self.vocab[term] = len(self.vocab)
+            row.append((self.vocab[term], int(weight)))
+        row.sort()
+        for termid, weight in row:
+            self.terms.append(termid)
+            self.weights.append(weight)
+        self.ids.append(tweetid)
+        self.offsets.append(len(self.terms))
+        self.sizes.append(sum(weight for termid, weight in row))
+
+    def row(self, tweetid):
+        """
+        find the row number for a tweet id or None if we don't have it
+        """
+        i = bisect_left(self.ids, tweetid)
+        if i < len(self.ids) and self.ids[i] == tweetid and i not in self.dead:
+            return i
+        return None
+
+    def rowdict(self, i):
+        """
+        term id -> weight dict for row i
+        """
+        start, end = self.offsets[i], self.offsets[i+1]
+        return dict(zip(self.terms[start:end], self.weights[start:end]))
+
+    def intersection(self, rowdict, j):
+        """
+        weight of terms in row j that are also in rowdict
+        """
+        inter = 0
+        weights = self.weights
+        terms = self.terms
+        for k in xrange(self.offsets[j], self.offsets[j+1]):
+            if terms[k] in rowdict:
+                inter += weights[k]
+        return inter
+
+    def jaccard(self, id1, id2):
+        """
+        same result as ygsim.calc_jaccard(words[id1], words[id2])
+        tweets we don't have score 0.0 as in ygsim.compare_two
+        """
+        i = self.row(id1)
+        j = self.row(id2)
+        if i is None or j is None:
+            return 0.0
+        inter = self.intersection(self.rowdict(i), j)
+        return score(inter, self.sizes[i] + self.sizes[j] - inter)
+
+    def jaccard_pairs(self, pairs):
+        """
+        score a block of (id1, id2) pairs returning a list of jaccard values
+        in the same order as pairs
+
+        the row dict for id1 is reused for consecutive pairs with the same id1
+        so ordering pairs by id1 (as ygpairs.get_pairs does) keeps this cheap
+        """
+        scores = []
+        lastid = None
+        i = None
+        rowdict = None
+        for id1, id2 in pairs:
+            if id1 != lastid:
+                lastid = id1
+                i = self.row(id1)
+                if i is not None: rowdict = self.rowdict(i)
+            j = self.row(id2)
+            if i is None or j is None:
+                scores.append(0.0)
+                continue
+            inter = self.intersection(rowdict, j)
+            scores.append(score(inter, self.sizes[i] + self.sizes[j] - inter))
+        return scores
+
+    def postings(self, rows=None):
+        """
+        inverted index of term id -> list of rows containing that term
+        rows is an optional list of row numbers to restrict the index to
+        """
+        if rows is None: rows = self.live_rows()
+        index = {}
+        terms = self.terms
+        for i in rows:
+            for k in xrange(self.offsets[i], self.offsets[i+1]):
+                index.setdefault(terms[k], []).append(i)
+        return index
+
+    def intersections(self, rows=None):
+        """
+        weighted intersection for every pair of rows sharing at least one term
+        returns a dict of (row1, row2) -> weight with row1 < row2
+        pairs that share nothing are not listed as their intersection is 0
+        """
+        index = self.postings(rows)
+        weights = {}
+        for k in xrange(len(self.terms)):
+            weights[self.terms[k]] = self.weights[k]
+        inter = {}
+        for termid, posting in index.iteritems():
+            w = weights[termid]
+            posting.sort()
+            for a in xrange(len(posting)):
+                ra = posting[a]
+                for b in xrange(a+1, len(posting)):
+                    key = (ra, posting[b])
+                    inter[key] = inter.get(key, 0) + w
+        return inter
+
+    def all_pairs(self, ids=None):
+        """
+        jaccard for every pair of the given tweet ids (default all rows)
+        returns a dict of (id1, id2) -> jaccard with id1 < id2
+        pairs not listed have a jaccard of 0.0
+        """
+        if ids is None:
+            rows = self.live_rows()
+        else:
+            rows = [i for i in (self.row(tweetid) for tweetid in ids) if i is not None]
+        scores = {}
+        for (i, j), inter in self.intersections(rows).iteritems():
+            scores[(self.ids[i], self.ids[j])] = \
+                score(inter, self.sizes[i] + self.sizes[j] - inter)
+        return scores
+
+    def join(self, ids=None, epsilon=0.0):
+        """
+        exact similarity join in the style of AllPairs/PPJoin
+
+        returns a dict of (id1, id2) -> jaccard with id1 < id2 holding every pair
+        of the given tweet ids (default all rows) whose jaccard could reach epsilon
+        (jaccard > 0 when epsilon is 0) - all other pairs provably can't
+
+        jaccard >= e is the same as a weighted |intersection|/|union| >= e/(1+e) = t
+        so the intersection must be at least t * the larger row size:
+
+        size filter - rows are probed in ascending size order and indexed rows
+        smaller than t * size of the probing row are skipped
+
+        prefix filter - terms are ordered from rarest to most common and only the
+        prefix of each row whose remaining weight could still reach t * size is
+        indexed and probed: two rows that are similar enough must share a prefix term
+
+        counts of the work done are saved in self.joinstats
+        """
+        if ids is None:
+            rows = self.live_rows()
+        else:
+            rows = [i for i in (self.row(tweetid) for tweetid in ids) if i is not None]
+        rows = [i for i in rows if self.sizes[i] > 0]
+
+        if epsilon > 0.0:
+            # a little slack so rounding never drops a pair calc_jaccard would keep
+            threshold = float(epsilon)/(1.0 + float(epsilon)) * (1.0 - 1e-9)
+        else:
+            threshold = 0.0
+
+        # global ordering: rarest terms first
+        freq = {}
+        for i in rows:
+            for k in xrange(self.offsets[i], self.offsets[i+1]):
+                termid = self.terms[k]
+                freq[termid] = freq.get(termid, 0) + 1
+        rank = lambda k: (freq[self.terms[k]], self.terms[k])
+
+        rows.sort(key=lambda i: (self.sizes[i], i))
+        index = {}
+        candidates = 0
+        scores = {}
+        for i in rows:
+            size = self.sizes[i]
+            minsize = threshold * size
+            remaining = size
+            rowdict = None
+            seen = set()
+            for k in sorted(xrange(self.offsets[i], self.offsets[i+1]), key=rank):
+                if remaining < minsize: break
+                remaining -= self.weights[k]
+                termid = self.terms[k]
+                posting = index.setdefault(termid, [])
+                for j in posting:
+                    if j in seen or self.sizes[j] < minsize: continue
+                    seen.add(j)
+                    if rowdict is None: rowdict = self.rowdict(i)
+                    inter = self.intersection(rowdict, j)
+                    if inter == 0 or inter < threshold * (size + self.sizes[j] - inter):
+                        continue
+                    if self.ids[i] < self.ids[j]: key = (self.ids[i], self.ids[j])
+                    else: key = (self.ids[j], self.ids[i])
+                    scores[key] = score(inter, size + self.sizes[j] - inter)
+                posting.append(i)
+            candidates += len(seen)
+
+        self.joinstats = {
+            'rows': len(rows),
+            'pairs': len(rows) * (len(rows) - 1) / 2,
+            'candidates': candidates,
+            'similar': len(scores),
+        }
+        return scores
+
+class yglinks(object):
+    """
+    index of the links shared by tweets
+
+    links is a ygvectors matrix with a row of link ids (weight 1) per tweet
+    the link -> tweet ids direction comes from its postings when needed
+    memory depends on the number of links rather than on the number
+    of pairs of tweets sharing a link
+
+    the count for a pair is INFINITY per shared link (see ygsim.get_linkcount)
+    """
+    def __init__(self, links):
+        self.links = links
+
+    def share(self):
+        """
+        moves the link matrix into shared memory (see ygvectors.share)
+        """
+        self.links = self.links.share()
+        return self
+
+    def get(self, id1, id2):
+        """
+        INFINITY times the number of links the two tweets share
+        """
+        links = self.links
+        i = links.row(id1)
+        if i is None: return 0
+        j = links.row(id2)
+        if j is None: return 0
+        return INFINITY * links.intersection(links.rowdict(i), j)
+
+    def counts(self, pairs):
+        """
+        link counts for a block of (id1, id2) pairs in the same order as pairs
+        like ygvectors.jaccard_pairs the row for id1 is reused while id1 doesn't change
+        """
+        links = self.links
+        counts = []
+        lastid = None
+        rowdict = None
+        for id1, id2 in pairs:
+            if id1 != lastid:
+                lastid = id1
+                i = links.row(id1)
+                rowdict = None if i is None else links.rowdict(i)
+            if rowdict is None:
+                counts.append(0)
+                continue
+            j = links.row(id2)
+            if j is None:
+                counts.append(0)
+                continue
+            counts.append(INFINITY * links.intersection(rowdict, j))
+        return counts
+
+    def pairs(self):
+        """
+        every (id1, id2) pair with id1 < id2 sharing at least one link
+        pairs sharing several links are only listed once
+        """
+        ids = self.links.ids
+        seen = set()
+        for rows in self.links.postings().itervalues():
+            rows.sort()
+            for a in xrange(len(rows)):
+                for b in xrange(a+1, len(rows)):
+                    pair = (ids[rows[a]], ids[rows[b]])
+                    if pair in seen: continue
+                    seen.add(pair)
+                    yield pair